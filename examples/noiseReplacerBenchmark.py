@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+#
+# LSST Data Management System
+# Copyright 2008-2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+"""
+Time NoiseReplacer's insertSource()/removeSource() on a crowded simulated image, with and without
+precomputed pixel indices (NoiseReplacerConfig.precomputePixelIndices), against the original
+implementation that saved a HeavyFootprint of each source and inserted it with HeavyFootprint.insert().
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+import lsst.geom
+import lsst.afw.detection
+import lsst.afw.geom
+import lsst.afw.table
+import lsst.meas.base
+import lsst.meas.base.tests
+
+
+def makeDataset(nFamilies, nChildren, seed=1):
+    """Make a TestDataset with nFamilies blends of nChildren sources each, on a grid"""
+    rng = np.random.RandomState(seed)
+    side = int(np.ceil(np.sqrt(nFamilies)))
+    spacing = 60
+    bbox = lsst.geom.Box2I(lsst.geom.Point2I(0, 0), lsst.geom.Extent2I(side*spacing, side*spacing))
+    dataset = lsst.meas.base.tests.TestDataset(bbox)
+    for i in range(nFamilies):
+        center = lsst.geom.Point2D((i % side + 0.5)*spacing, (i//side + 0.5)*spacing)
+        with dataset.addBlend() as family:
+            for j in range(nChildren):
+                offset = lsst.geom.Extent2D(*rng.uniform(-12.0, 12.0, size=2))
+                family.addChild(rng.uniform(5E4, 2E5), center + offset,
+                                lsst.afw.geom.Quadrupole(*rng.uniform(3.0, 6.0, size=2), 0.0))
+    return dataset
+
+
+class HeavyFootprintReplacer:
+    """The original NoiseReplacer insertion path, kept here as the baseline
+
+    A HeavyFootprint of the original pixels and one of noise are made for each source which is a
+    parent or already has a HeavyFootprint; insertSource() and removeSource() follow the parent chain
+    and insert them with HeavyFootprint.insert().  The noise pixels are copied from noiseReplacer, so
+    that both implementations leave identical images.
+    """
+
+    def __init__(self, exposure, footprints, noiseReplacer):
+        self.exposure = exposure
+        self.footprints = footprints
+        mi = exposure.getMaskedImage()
+        mask = mi.getMask()
+        self.removeplanes = []
+        bitmasks = []
+        for maskname in ['THISDET', 'OTHERDET']:
+            try:
+                plane = mask.getMaskPlane(maskname)
+            except Exception:
+                plane = mask.addMaskPlane(maskname)
+                self.removeplanes.append(maskname)
+            mask.clearMaskPlane(plane)
+            bitmasks.append(mask.getPlaneBitMask(maskname))
+        self.thisbitmask, self.otherbitmask = bitmasks
+        self.heavies = {}
+        for id, fp in footprints.items():
+            if fp[1].isHeavy():
+                self.heavies[id] = fp[1]
+            elif fp[0] == 0:
+                self.heavies[id] = lsst.afw.detection.makeHeavyFootprint(fp[1], mi)
+        self.heavyNoise = {}
+        for id in self.heavies:
+            fp = footprints[id][1]
+            noiseFp = lsst.afw.detection.makeHeavyFootprint(fp, mi)
+            noiseFp.getImageArray()[:] = noiseReplacer._getNoisePixels(id)
+            self.heavyNoise[id] = noiseFp
+            noiseFp.insert(mi.getImage())
+            fp.spans.setMask(mask, self.otherbitmask)
+
+    def _getHeavyId(self, id):
+        usedid = id
+        while self.footprints[usedid][0] != 0 and usedid not in self.heavies:
+            usedid = self.footprints[usedid][0]
+        return usedid
+
+    def insertSource(self, id):
+        mi = self.exposure.getMaskedImage()
+        fp = self.heavies[self._getHeavyId(id)]
+        fp.insert(mi.getImage())
+        fp.spans.setMask(mi.getMask(), self.thisbitmask)
+        fp.spans.clearMask(mi.getMask(), self.otherbitmask)
+
+    def removeSource(self, id):
+        mi = self.exposure.getMaskedImage()
+        fp = self.heavyNoise[self._getHeavyId(id)]
+        fp.insert(mi.getImage())
+        fp.spans.clearMask(mi.getMask(), self.thisbitmask)
+        fp.spans.setMask(mi.getMask(), self.otherbitmask)
+
+    def end(self):
+        mi = self.exposure.getMaskedImage()
+        for id, fp in self.footprints.items():
+            if fp[0] == 0:
+                self.heavies[id].insert(mi.getImage())
+        for maskname in self.removeplanes:
+            mi.getMask().removeAndClearMaskPlane(maskname, True)
+
+
+def timeReplacer(makeReplacer, exposure, catalog, nRepeats):
+    """Time the construction of a replacer and nRepeats insert/remove passes over the catalog
+
+    Returns the setup time, the loop time and a copy of the noise-replaced image.
+    """
+    image = exposure.clone()
+    start = time.perf_counter()
+    replacer = makeReplacer(image)
+    setupTime = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(nRepeats):
+        for record in catalog:
+            replacer.insertSource(record.getId())
+            replacer.removeSource(record.getId())
+    loopTime = time.perf_counter() - start
+    replaced = image.getMaskedImage().getImage().getArray().copy()
+    replacer.end()
+    return setupTime, loopTime, replaced
+
+
+def run(nFamilies, nChildren, nRepeats):
+    dataset = makeDataset(nFamilies, nChildren)
+    schema = lsst.afw.table.SourceTable.makeMinimalSchema()
+    exposure, catalog = dataset.realize(10.0, schema, randomSeed=0)
+    footprints = {record.getId(): (record.getParent(), record.getFootprint()) for record in catalog}
+    # The baseline reuses the noise of a NoiseReplacer with the same config, so its setup time does
+    # not include drawing the noise.
+    noiseReplacer = lsst.meas.base.NoiseReplacer(lsst.meas.base.NoiseReplacerConfig(), exposure.clone(),
+                                                 footprints)
+    baseSetup, baseLoop, baseline = timeReplacer(
+        lambda image: HeavyFootprintReplacer(image, footprints, noiseReplacer), exposure, catalog, nRepeats)
+    noiseReplacer.end()
+    print("HeavyFootprint.insert        setup %8.4f s  insert/remove %8.4f s (%d sources x %d)" %
+          (baseSetup, baseLoop, len(catalog), nRepeats))
+    for precompute in (False, True):
+        config = lsst.meas.base.NoiseReplacerConfig()
+        config.precomputePixelIndices = precompute
+        setupTime, loopTime, replaced = timeReplacer(
+            lambda image: lsst.meas.base.NoiseReplacer(config, image, footprints),
+            exposure, catalog, nRepeats)
+        print("precomputePixelIndices=%-5s  setup %8.4f s  insert/remove %8.4f s (%.2fx baseline); "
+              "identical to baseline: %s" %
+              (precompute, setupTime, loopTime, baseLoop/loopTime, np.array_equal(replaced, baseline)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--families", type=int, default=100, help="Number of blended families")
+    parser.add_argument("--children", type=int, default=20, help="Number of children per family")
+    parser.add_argument("--repeats", type=int, default=5, help="Number of passes over the catalog")
+    args = parser.parse_args()
+    run(args.families, args.children, args.repeats)
+
+
+if __name__ == "__main__":
+    main()
@@ -104,6 +104,23 @@ public:
      */
     virtual void measureN(afw::table::SourceCatalog const& measCat,
                           afw::image::Exposure<float> const& exposure) const;
+
+    /**
+     *  Called to measure a batch of sources independently, in a single image.
+     *
+     *  This is equivalent to calling measure() on each record in measCat in turn (which is
+     *  usually a contiguous slice or subset of the full catalog), but avoids a round trip
+     *  through the Python measurement framework for every record.  It is only called when the
+     *  sources do not need to be isolated from their neighbors by noise replacement.
+     *
+     *  The default implementation loops over the records, calling measure() on each, and
+     *  handles failures itself by calling fail() on the offending record, so the batch
+     *  continues past any MeasurementError or other ordinary exception.  FatalAlgorithmError
+     *  and std::bad_alloc are propagated to the caller.  Algorithms that can measure many
+     *  sources more efficiently at once may override this.
+     */
+    virtual void measureMany(afw::table::SourceCatalog const& measCat,
+                             afw::image::Exposure<float> const& exposure) const;
 };
 
 /**
@@ -153,6 +170,20 @@ public:
                                 afw::image::Exposure<float> const& exposure,
                                 afw::table::SourceCatalog const& refRecord,
                                 afw::geom::SkyWcs const& refWcs) const;
+
+    /**
+     *  Called to measure a batch of sources independently, in a single image.
+     *
+     *  measCat and refCat must have the same length, with each reference record corresponding
+     *  to the measurement record at the same position.  As with SingleFrameAlgorithm::measureMany,
+     *  the default implementation simply calls measureForced() on each pair of records, and
+     *  calls fail() on any record for which that throws an exception other than
+     *  FatalAlgorithmError or std::bad_alloc.
+     */
+    virtual void measureManyForced(afw::table::SourceCatalog const& measCat,
+                                   afw::image::Exposure<float> const& exposure,
+                                   afw::table::SourceCatalog const& refCat,
+                                   afw::geom::SkyWcs const& refWcs) const;
 };
 
 /**
@@ -182,6 +213,13 @@ public:
                                 afw::geom::SkyWcs const& refWcs) const {
         measureN(measCat, exposure);
     }
+
+    virtual void measureManyForced(afw::table::SourceCatalog const& measCat,
+                                   afw::image::Exposure<float> const& exposure,
+                                   afw::table::SourceCatalog const& refCat,
+                                   afw::geom::SkyWcs const& refWcs) const {
+        measureMany(measCat, exposure);
+    }
 };
 
 }  // namespace base
@@ -51,6 +51,8 @@ from .transform import *
 
 from .apCorrRegistry import *
 from .pluginRegistry import *
+from .pluginMetrics import *
+from .familyIndex import *
 from .baseMeasurement import *
 from .pluginsBase import *
 from .sfm import *
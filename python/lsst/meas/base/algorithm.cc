@@ -46,9 +46,12 @@ PYBIND11_MODULE(algorithm, mod) {
     clsBaseAlgorithm.def("getLogName", &SimpleAlgorithm::getLogName);
 
     clsSingleFrameAlgorithm.def("measure", &SingleFrameAlgorithm::measure, "record"_a, "exposure"_a);
+    clsSingleFrameAlgorithm.def("measureMany", &SingleFrameAlgorithm::measureMany, "measCat"_a, "exposure"_a);
 
     clsSimpleAlgorithm.def("measureForced", &SimpleAlgorithm::measureForced, "measRecord"_a, "exposure"_a,
                            "refRecord"_a, "refWcs"_a);
+    clsSimpleAlgorithm.def("measureManyForced", &SimpleAlgorithm::measureManyForced, "measCat"_a,
+                           "exposure"_a, "refCat"_a, "refWcs"_a);
 }
 
 }  // namespace base
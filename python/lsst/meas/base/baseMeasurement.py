@@ -22,6 +22,10 @@
 #
 """Base measurement task, which subclassed by the single frame and forced measurement tasks.
 """
+import collections
+import copy
+
+import lsst.log
 import lsst.pipe.base
 import lsst.pex.config
 
@@ -29,6 +33,7 @@ from .pluginRegistry import PluginMap
 from .exceptions import FatalAlgorithmError, MeasurementError
 from .pluginsBase import BasePluginConfig, BasePlugin
 from .noiseReplacer import NoiseReplacerConfig
+from .pluginMetrics import PluginMetrics
 
 __all__ = ("BaseMeasurementPluginConfig", "BaseMeasurementPlugin",
            "BaseMeasurementConfig", "BaseMeasurementTask")
@@ -36,6 +41,19 @@ __all__ = ("BaseMeasurementPluginConfig", "BaseMeasurementPlugin",
 # Exceptions that the measurement tasks should always propagate up to their callers
 FATAL_EXCEPTIONS = (MemoryError, FatalAlgorithmError)
 
+## One plugin's step in an ExecutionPlan: the plugin, its bound measure (or measureN) and fail methods,
+## and the logger to report its failures to.
+PlanStep = collections.namedtuple("PlanStep", ("plugin", "measure", "fail", "log"))
+
+## The plugins to run for a range of execution orders, as tuples of PlanSteps: single holds the
+## measure() steps of every active plugin and multi the measureN() steps of those with doMeasureN set.
+## The single steps are also divided into three tiers for the measurement drivers: isolated steps must
+## be run on each source in turn with its neighbors replaced by noise, while catalogBefore and
+## catalogAfter steps (for plugins with needsIsolatedPixels False) can be run over the whole catalog
+## before or after that loop, respectively.
+ExecutionPlan = collections.namedtuple("ExecutionPlan",
+                                       ("single", "multi", "isolated", "catalogBefore", "catalogAfter"))
+
 
 class BaseMeasurementPluginConfig(BasePluginConfig):
     """!
@@ -63,7 +81,34 @@ class BaseMeasurementPlugin(BasePlugin):
     measurement plugins and is implemented for symmetry with the measurement base plugin
     configuration class
     '''
-    pass
+
+    # Set to False by plugins that do not read the pixels of the source being measured (e.g. those that
+    # only transform a centroid), allowing them to be run over the whole catalog outside the loop in
+    # which neighbors are replaced with noise.
+    needsIsolatedPixels = True
+
+    # Set to False by plugins that do not read the temporary THISDET and OTHERDET mask planes maintained
+    # by the NoiseReplacer; if no plugin reads them, the NoiseReplacer does not maintain them.
+    usesNoiseReplacerMaskPlanes = True
+
+    # Set to True by plugins with a measureMany() method that measures a batch of independent
+    # records in one call, handling per-record failures itself (see callMeasureMany).
+    hasMeasureMany = False
+
+    def getCutoutPadding(self, exposure):
+        """!
+        Return the number of pixels beyond a source's Footprint this plugin needs to see.
+
+        Used to size the per-family cutouts measured when SingleFrameMeasurementConfig.doMeasureInCutouts
+        is set (the PSF size is already accounted for by the task).  None indicates that the padding is
+        unknown, in which case the task measures on the full exposure; this is the default, so plugins
+        must override this to be run on cutouts, returning 0 if they read no pixels beyond the
+        Footprint and the PSF size, or a bound on how far they do (e.g. for large apertures or
+        background annuli).
+
+        @param[in]  exposure   The exposure to be measured.
+        """
+        return None
 
 
 class SourceSlotConfig(lsst.pex.config.Config):
@@ -156,6 +201,11 @@ class BaseMeasurementConfig(lsst.pex.config.Config):
         dtype=str, default="undeblended_",
         doc="Prefix to give undeblended plugins"
     )
+    doPluginMetrics = lsst.pex.config.Field(
+        dtype=bool, default=False,
+        doc="Accumulate per-plugin timing, call and failure counts, and the IDs of the slowest sources, "
+            "and write them to the task metadata (under 'pluginMetrics') at the end of each run?"
+    )
 
     def validate(self):
         lsst.pex.config.Config.validate(self)
@@ -211,10 +261,133 @@ class BaseMeasurementTask(lsst.pipe.base.Task):
         if algMetadata is None:
             algMetadata = lsst.daf.base.PropertyList()
         self.algMetadata = algMetadata
+        self._executionPlans = {}
+        self._pluginMetrics = {}
 
     def getPluginLogName(self, pluginName):
         return self.log.getName() + '.' + pluginName
 
+    def getExecutionPlan(self, beginOrder=None, endOrder=None):
+        """!
+        Return the ExecutionPlan for the plugins with beginOrder <= executionOrder < endOrder.
+
+        @param[in]  beginOrder     beginning execution order (inclusive); None for no limit.
+        @param[in]  endOrder       ending execution order (exclusive); None for no limit.
+
+        Plans are compiled on first use and cached until clearExecutionPlans() is called, which the
+        derived classes do at the start of each run(), so the per-source loops need only iterate over
+        a tuple of bound methods.
+        """
+        key = (beginOrder, endOrder)
+        plan = self._executionPlans.get(key)
+        if plan is None:
+            single = []
+            multi = []
+            for plugin in self.plugins.values():
+                if beginOrder is not None and plugin.getExecutionOrder() < beginOrder:
+                    continue
+                if endOrder is not None and plugin.getExecutionOrder() >= endOrder:
+                    break
+                log = lsst.log.Log.getLogger(self.getPluginLogName(plugin.name))
+                if plugin.config.doMeasure:
+                    measure = plugin.measure
+                    if self.config.doPluginMetrics:
+                        measure = self.getPluginMetrics(plugin.name).wrap(measure)
+                    single.append(PlanStep(plugin, measure, plugin.fail, log))
+                if plugin.config.doMeasureN:
+                    measureN = plugin.measureN
+                    if self.config.doPluginMetrics:
+                        measureN = self.getPluginMetrics(plugin.name + ".measureN").wrap(measureN)
+                    multi.append(PlanStep(plugin, measureN, plugin.fail, log))
+            plan = ExecutionPlan(tuple(single), tuple(multi), *self._divideIntoTiers(single, multi))
+            self._executionPlans[key] = plan
+        return plan
+
+    def _divideIntoTiers(self, single, multi):
+        """Divide the single PlanSteps into (isolated, catalogBefore, catalogAfter) tuples.
+
+        Plugins that do not need isolated pixels run before the noise-replacement loop if they come before
+        every plugin that does, and after it otherwise - unless they are the target of a slot that a later
+        isolated plugin may read, in which case they stay in the loop to preserve the execution order.
+        """
+        isolatedOrders = [step.plugin.getExecutionOrder() for step in single
+                          if step.plugin.needsIsolatedPixels]
+        isolatedOrders.extend(step.plugin.getExecutionOrder() for step in multi)
+        isolated = []
+        catalogBefore = []
+        catalogAfter = []
+        for step in single:
+            executionOrder = step.plugin.getExecutionOrder()
+            if step.plugin.needsIsolatedPixels:
+                isolated.append(step)
+            elif not isolatedOrders or executionOrder < min(isolatedOrders):
+                catalogBefore.append(step)
+            elif self._isSlotTarget(step.plugin.name) and executionOrder < max(isolatedOrders):
+                isolated.append(step)
+            else:
+                catalogAfter.append(step)
+        return tuple(isolated), tuple(catalogBefore), tuple(catalogAfter)
+
+    def _isSlotTarget(self, pluginName):
+        """Return True if any slot is (or may be) set to an output of the named plugin."""
+        slots = self.config.slots
+        for slot in (slots.centroid, slots.shape, slots.psfFlux, slots.apFlux, slots.modelFlux,
+                     slots.gaussianFlux, slots.calibFlux):
+            if slot is not None and slot.startswith(pluginName):
+                return True
+        return False
+
+    def usesNoiseReplacerMaskPlanes(self):
+        """!
+        Return True if any of the plugins reads the THISDET or OTHERDET mask planes, which are
+        only maintained by the NoiseReplacer if this is the case.
+        """
+        return any(plugin.usesNoiseReplacerMaskPlanes for plugin in self.plugins.iter())
+
+    def clearExecutionPlans(self):
+        """!
+        Discard any cached ExecutionPlans, so they are recompiled from the current plugins.
+
+        This also resets any statistics accumulated by the PluginMetrics the plans report to.
+        """
+        self._executionPlans.clear()
+        self._pluginMetrics.clear()
+
+    def getPluginMetrics(self, name):
+        """!
+        Return the PluginMetrics that accumulate statistics under the given name, creating it if needed.
+
+        Names are plugin names, with ".measureN" appended for calls to measureN().
+        """
+        metrics = self._pluginMetrics.get(name)
+        if metrics is None:
+            metrics = PluginMetrics(name)
+            self._pluginMetrics[name] = metrics
+        return metrics
+
+    def popPluginMetrics(self):
+        """!
+        Return copies of the PluginMetrics accumulated so far, by name, and reset the originals.
+
+        Together with mergePluginMetrics(), this lets statistics gathered in worker processes be
+        collected by the process that started them.
+        """
+        popped = {}
+        for name, metrics in self._pluginMetrics.items():
+            popped[name] = copy.copy(metrics)
+            metrics.reset()
+        return popped
+
+    def mergePluginMetrics(self, metricsByName):
+        """!Add the statistics in a dict of {name: PluginMetrics} (see popPluginMetrics()) to this task's."""
+        for name, metrics in metricsByName.items():
+            self.getPluginMetrics(name).merge(metrics)
+
+    def writePluginMetrics(self):
+        """!Write the statistics accumulated since the last clearExecutionPlans() to the task metadata."""
+        for metrics in self._pluginMetrics.values():
+            metrics.writeMetadata(self.metadata)
+
     def initializePlugins(self, **kwds):
         """Initialize the plugins (and slots) according to the configuration.
 
@@ -252,6 +425,7 @@ class BaseMeasurementTask(lsst.pipe.base.Task):
             undeblendedName = self.config.undeblendedPrefix + name
             self.undeblendedPlugins[name] = PluginClass(config, undeblendedName, metadata=self.algMetadata,
                                                         **kwds)
+        self.clearExecutionPlans()
 
     def callMeasure(self, measRecord, *args, **kwds):
         """!
@@ -260,11 +434,13 @@ class BaseMeasurementTask(lsst.pipe.base.Task):
         @param[in,out]  measRecord     lsst.afw.table.SourceRecord that corresponds to the object being
                                        measured, and where outputs should be written.
         @param[in]      *args          Positional arguments forwarded to Plugin.measure()
-        @param[in]      **kwds         Keyword arguments. Two are handled locally:
+        @param[in]      **kwds         Keyword arguments. Three are handled locally:
                                        - beginOrder: beginning execution order (inclusive): measurements with
                                          executionOrder < beginOrder are not executed. None for no limit.
                                        - endOrder: ending execution order (exclusive): measurements with
                                          executionOrder >= endOrder are not executed. None for no limit.
+                                       - tier: the ExecutionPlan field holding the plugins to run; the
+                                         default, "single", runs all of them.
                                        the rest are forwarded to Plugin.measure()
 
         This method can be used with plugins that have different signatures; the only requirement is that
@@ -273,14 +449,9 @@ class BaseMeasurementTask(lsst.pipe.base.Task):
 
         This method should be considered "protected"; it is intended for use by derived classes, not users.
         """
-        beginOrder = kwds.pop("beginOrder", None)
-        endOrder = kwds.pop("endOrder", None)
-        for plugin in self.plugins.iter():
-            if beginOrder is not None and plugin.getExecutionOrder() < beginOrder:
-                continue
-            if endOrder is not None and plugin.getExecutionOrder() >= endOrder:
-                break
-            self.doMeasurement(plugin, measRecord, *args, **kwds)
+        plan = self.getExecutionPlan(kwds.pop("beginOrder", None), kwds.pop("endOrder", None))
+        for plugin, measure, fail, log in getattr(plan, kwds.pop("tier", "single")):
+            self._runMeasure(plugin, measure, fail, log, measRecord, *args, **kwds)
 
     def doMeasurement(self, plugin, measRecord, *args, **kwds):
         """!
@@ -298,20 +469,27 @@ class BaseMeasurementTask(lsst.pipe.base.Task):
 
         This method should be considered "protected"; it is intended for use by derived classes, not users.
         """
+        self._runMeasure(plugin, plugin.measure, plugin.fail, None, measRecord, *args, **kwds)
+
+    def _runMeasure(self, plugin, measure, fail, log, measRecord, *args, **kwds):
+        """Run one measure() call, calling fail() on the record if it raises a non-fatal exception.
+
+        This is the single implementation behind callMeasure() (which passes the bound, possibly
+        metrics-wrapped, methods of an ExecutionPlan step) and doMeasurement() (which passes the plugin's
+        own methods and a log of None, to look the plugin's logger up only when it is needed).
+        """
         try:
-            plugin.measure(measRecord, *args, **kwds)
+            measure(measRecord, *args, **kwds)
         except FATAL_EXCEPTIONS:
             raise
         except MeasurementError as error:
-            lsst.log.Log.getLogger(self.getPluginLogName(plugin.name)).debug(
-                "MeasurementError in %s.measure on record %s: %s"
-                % (plugin.name, measRecord.getId(), error))
-            plugin.fail(measRecord, error)
+            self._getStepLog(plugin, log).debug("MeasurementError in %s.measure on record %s: %s"
+                                                % (plugin.name, measRecord.getId(), error))
+            fail(measRecord, error)
         except Exception as error:
-            lsst.log.Log.getLogger(self.getPluginLogName(plugin.name)).debug(
-                "Exception in %s.measure on record %s: %s"
-                % (plugin.name, measRecord.getId(), error))
-            plugin.fail(measRecord)
+            self._getStepLog(plugin, log).debug("Exception in %s.measure on record %s: %s"
+                                                % (plugin.name, measRecord.getId(), error))
+            fail(measRecord)
 
     def callMeasureN(self, measCat, *args, **kwds):
         """!
@@ -338,14 +516,9 @@ class BaseMeasurementTask(lsst.pipe.base.Task):
 
         This method should be considered "protected"; it is intended for use by derived classes, not users.
         """
-        beginOrder = kwds.pop("beginOrder", None)
-        endOrder = kwds.pop("endOrder", None)
-        for plugin in self.plugins.iterN():
-            if beginOrder is not None and plugin.getExecutionOrder() < beginOrder:
-                continue
-            if endOrder is not None and plugin.getExecutionOrder() >= endOrder:
-                break
-            self.doMeasurementN(plugin, measCat, *args, **kwds)
+        plan = self.getExecutionPlan(kwds.pop("beginOrder", None), kwds.pop("endOrder", None))
+        for plugin, measureN, fail, log in plan.multi:
+            self._runMeasureN(plugin, "measureN", measureN, fail, log, measCat, *args, **kwds)
 
     def doMeasurementN(self, plugin, measCat, *args, **kwds):
         """!
@@ -364,20 +537,104 @@ class BaseMeasurementTask(lsst.pipe.base.Task):
 
         This method should be considered "protected"; it is intended for use by derived classes, not users.
         """
+        self._runMeasureN(plugin, "measureN", plugin.measureN, plugin.fail, None, measCat, *args, **kwds)
+
+    def _runMeasureN(self, plugin, methodName, measureN, fail, log, measCat, *args, **kwds):
+        """Run one measureN() or measureMany() call, calling fail() on every record in the catalog if it
+        raises a non-fatal exception.
+
+        This is the single implementation behind callMeasureN(), doMeasurementN() and doMeasurementMany();
+        methodName is only used in log messages, and log may be None as for _runMeasure().
+        """
         try:
-            plugin.measureN(measCat, *args, **kwds)
+            measureN(measCat, *args, **kwds)
         except FATAL_EXCEPTIONS:
             raise
-
         except MeasurementError as error:
+            self._getStepLog(plugin, log).debug("MeasurementError in %s.%s on records %s-%s: %s"
+                                                % (plugin.name, methodName, measCat[0].getId(),
+                                                   measCat[-1].getId(), error))
             for measRecord in measCat:
-                lsst.log.Log.getLogger(self.getPluginLogName(plugin.name)).debug(
-                    "MeasurementError in %s.measureN on records %s-%s: %s"
-                    % (plugin.name, measCat[0].getId(), measCat[-1].getId(), error))
-                plugin.fail(measRecord, error)
+                fail(measRecord, error)
         except Exception as error:
+            self._getStepLog(plugin, log).debug("Exception in %s.%s on records %s-%s: %s"
+                                                % (plugin.name, methodName, measCat[0].getId(),
+                                                   measCat[-1].getId(), error))
+            for measRecord in measCat:
+                fail(measRecord)
+
+    def _getPlanStep(self, plugin):
+        """Return the single-object PlanStep of a plugin from the full ExecutionPlan, whose measure
+        records plugin metrics if they are enabled, or a step with the plugin's own methods if the
+        plugin is not part of it (e.g. an undeblended plugin)."""
+        for step in self.getExecutionPlan().single:
+            if step.plugin is plugin:
+                return step
+        return PlanStep(plugin, plugin.measure, plugin.fail, None)
+
+    def _getStepLog(self, plugin, log):
+        """Return log, or the plugin's logger if it is None."""
+        if log is None:
+            log = lsst.log.Log.getLogger(self.getPluginLogName(plugin.name))
+        return log
+
+    def callMeasureMany(self, measCat, *args, **kwds):
+        """!
+        Measure every record in a catalog with all plugins, handling exceptions in a consistent way.
+
+        @param[in,out]  measCat        lsst.afw.table.SourceCatalog containing the records to be measured
+                                       (usually a slice or subset of the full catalog), where outputs
+                                       should be written.
+        @param[in]      *args          Positional arguments forwarded to Plugin.measureMany()
+        @param[in]      **kwds         Keyword arguments. Three are handled locally:
+                                       - beginOrder: beginning execution order (inclusive): measurements with
+                                         executionOrder < beginOrder are not executed. None for no limit.
+                                       - endOrder: ending execution order (exclusive): measurements with
+                                         executionOrder >= endOrder are not executed. None for no limit.
+                                       - tier: the ExecutionPlan field holding the plugins to run; the
+                                         default, "single", runs all of them.
+                                       the rest are forwarded to Plugin.measureMany()
+
+        The records are measured independently, with all records measured by one plugin before moving on
+        to the next, so this is equivalent to calling callMeasure() on each record only when no noise
+        replacement is needed between them.
+
+        This method should be considered "protected"; it is intended for use by derived classes, not users.
+        """
+        plan = self.getExecutionPlan(kwds.pop("beginOrder", None), kwds.pop("endOrder", None))
+        for step in getattr(plan, kwds.pop("tier", "single")):
+            # Plugins without measureMany() are measured record by record, and their metrics are
+            # recorded per call by the plan step's measure (see doMeasurementMany()).
+            if not self.config.doPluginMetrics or not step.plugin.hasMeasureMany:
+                self.doMeasurementMany(step.plugin, measCat, *args, **kwds)
+                continue
+            with self.getPluginMetrics(step.plugin.name + ".measureMany").timing(measCat, batch=True):
+                self.doMeasurementMany(step.plugin, measCat, *args, **kwds)
+
+    def doMeasurementMany(self, plugin, measCat, *args, **kwds):
+        """!
+        Call the measureMany() method on the nominated plugin, handling exceptions in a consistent way.
+
+        @param[in]      plugin         Plugin that will measure
+        @param[in,out]  measCat        lsst.afw.table.SourceCatalog containing the records to be measured,
+                                       and where outputs should be written.
+        @param[in]      *args          Positional arguments forwarded to plugin.measureMany()
+        @param[in]      **kwds         Keyword arguments forwarded to plugin.measureMany()
+
+        Plugins without a measureMany() method (hasMeasureMany is False) are measured on each record in
+        turn, with the same measure() as callMeasure() (so any plugin metrics are recorded per record).
+        Plugins with one are expected to call fail() on individual records
+        themselves; any non-fatal exception that nonetheless escapes is treated as a failure of every
+        record in the batch.
+
+        This method should be considered "protected"; it is intended for use by derived classes, not users.
+        """
+        if not plugin.hasMeasureMany:
+            step = self._getPlanStep(plugin)
             for measRecord in measCat:
-                plugin.fail(measRecord)
-                lsst.log.Log.getLogger(self.getPluginLogName(plugin.name)).debug(
-                    "Exception in %s.measureN on records %s-%s: %s"
-                    % (plugin.name, measCat[0].getId(), measCat[-1].getId(), error))
+                self._runMeasure(plugin, step.measure, step.fail, step.log, measRecord, *args, **kwds)
+            return
+        if len(measCat) == 0:
+            return
+        self._runMeasureN(plugin, "measureMany", plugin.measureMany, plugin.fail, None, measCat,
+                          *args, **kwds)
@@ -6,6 +6,7 @@ import lsst.daf.base
 
 from .pluginsBase import BasePlugin, BasePluginConfig
 from .pluginRegistry import PluginRegistry, PluginMap
+from .pluginMetrics import PluginMetrics
 from . import FatalAlgorithmError, MeasurementError
 
 # Exceptions that the measurement tasks should always propagate up to their callers
@@ -111,6 +112,10 @@ class CatalogCalculationConfig(lsst.pex.config.Config):
         default=["base_ClassificationExtendedness",
                  "base_FootprintArea"],
         doc="Plugins to be run and their configuration")
+    doPluginMetrics = lsst.pex.config.Field(
+        dtype=bool, default=False,
+        doc="Accumulate per-plugin timing, call and failure counts, and the IDs of the slowest sources, "
+            "and write them to the task metadata (under 'pluginMetrics') at the end of each run?")
 
 
 class CatalogCalculationTask(lsst.pipe.base.Task):
@@ -181,13 +186,31 @@ class CatalogCalculationTask(lsst.pipe.base.Task):
         Run each of the plugins on the catalog
         @param[in] catalog  The catalog on which the plugins will operate
         '''
+        pluginMetrics = {}
         for runlevel in sorted(self.executionDict):
             # Run all of the plugins which take a whole catalog first
             for plug in self.executionDict[runlevel].multi:
+                calculate = self._getCalculate(plug, pluginMetrics, batch=True)
                 with CCContext(plug, catalog, self.log):
-                    plug.calculate(catalog)
+                    calculate(catalog)
             # Run all the plugins which take single catalog entries
+            single = [(plug, self._getCalculate(plug, pluginMetrics))
+                      for plug in self.executionDict[runlevel].single]
             for measRecord in catalog:
-                for plug in self.executionDict[runlevel].single:
+                for plug, calculate in single:
                     with CCContext(plug, measRecord, self.log):
-                        plug.calculate(measRecord)
+                        calculate(measRecord)
+        for metrics in pluginMetrics.values():
+            metrics.writeMetadata(self.metadata)
+
+    def _getCalculate(self, plug, pluginMetrics, batch=False):
+        '''
+        Return the plugin's calculate method, wrapped to accumulate statistics in a PluginMetrics
+        (added to the pluginMetrics dict, keyed by plugin name) if config.doPluginMetrics is set;
+        batch should be True for plugins that take the whole catalog (see PluginMetrics.timing()).
+        '''
+        if not self.config.doPluginMetrics:
+            return plug.calculate
+        if plug.name not in pluginMetrics:
+            pluginMetrics[plug.name] = PluginMetrics(plug.name)
+        return pluginMetrics[plug.name].wrap(plug.calculate, batch=batch)
@@ -0,0 +1,186 @@
+#
+# LSST Data Management System
+# Copyright 2008-2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+"""Array-based index of the deblend families in a source catalog.
+"""
+import numpy as np
+
+import lsst.afw.table
+
+__all__ = ("FamilyIndex",)
+
+
+class FamilyIndex:
+    """!
+    Precomputed parent/child structure of a catalog, built from its ID and parent columns.
+
+    The index holds a stable permutation that sorts the records by parent ID, in which the
+    parentless records come first, followed by the children of each parent in turn.  The
+    children of the i-th parent occupy [childBegin[i], childEnd[i]) in that permutation, so
+    iterating over the families requires no searches or catalog views beyond those the caller
+    asks for.  For a catalog that is already sorted by parent (as required by getChildren()) the
+    permutation is the identity, and getParents() and getChildren() return slices of the catalog.
+
+    Records whose parent is not in the catalog do not belong to any family; findBrokenChains()
+    and validate() can be used to detect them.
+    """
+
+    def __init__(self, ids, parents):
+        """!
+        @param[in]  ids      Array of record IDs, in catalog order.
+        @param[in]  parents  Array of parent IDs (0 for no parent), in catalog order.
+        """
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.parents = np.asarray(parents, dtype=np.int64)
+        if self.ids.shape != self.parents.shape:
+            raise ValueError("ID and parent arrays have different lengths (%d, %d)" %
+                             (len(self.ids), len(self.parents)))
+        self.isSorted = bool(np.all(self.parents[1:] >= self.parents[:-1]))
+        if self.isSorted:
+            self.order = np.arange(len(self.ids))
+        else:
+            self.order = np.argsort(self.parents, kind="stable")
+        sortedParents = self.parents[self.order]
+        nParents = np.searchsorted(sortedParents, 0, side="right")
+        self.parentIndices = self.order[:nParents]
+        parentIds = self.ids[self.parentIndices]
+        self.childBegin = np.searchsorted(sortedParents, parentIds, side="left")
+        self.childEnd = np.searchsorted(sortedParents, parentIds, side="right")
+
+    @classmethod
+    def fromCatalog(cls, catalog):
+        """!Construct from the ID and parent columns of a SourceCatalog."""
+        return cls(_getColumn(catalog, lsst.afw.table.SourceTable.getIdKey()),
+                   _getColumn(catalog, lsst.afw.table.SourceTable.getParentKey()))
+
+    def __len__(self):
+        """!Return the number of families, i.e. the number of parentless records."""
+        return len(self.parentIndices)
+
+    def getChildIndices(self, parentIdx):
+        """!Return the catalog indices of the children of the parentIdx-th parent, in catalog order."""
+        return self.order[self.childBegin[parentIdx]:self.childEnd[parentIdx]]
+
+    def getParents(self, catalog):
+        """!
+        Return the parentless records of catalog, as getChildren(0) would.
+
+        @param[in]  catalog  The catalog this index was built from, or one parallel to it.
+        """
+        if self.isSorted:
+            return catalog[:len(self.parentIndices)]
+        return _subset(catalog, self.parentIndices)
+
+    def getChildren(self, catalog, parentIdx):
+        """!
+        Return the children of the parentIdx-th parent, as getChildren(parentId) would.
+
+        @param[in]  catalog    The catalog this index was built from, or one parallel to it.
+        @param[in]  parentIdx  Index of the parent in getParents().
+        """
+        if self.isSorted:
+            return catalog[self.childBegin[parentIdx]:self.childEnd[parentIdx]]
+        return _subset(catalog, self.getChildIndices(parentIdx))
+
+    def getFamilyIndices(self, parentIdx):
+        """!Return the catalog indices of the parentIdx-th parent's children followed by the parent."""
+        return np.append(self.getChildIndices(parentIdx), self.parentIndices[parentIdx])
+
+    def _walkParentChains(self, stop=None):
+        """!
+        Follow the parent chain of every record at once.
+
+        @param[in]  stop   Boolean array; a chain ends at the first record for which this is True.
+
+        @return (indices of the records at which each chain ends, boolean array flagging chains that
+                 reach a parent not in the catalog, or that never end)
+        """
+        n = len(self.ids)
+        byId = np.argsort(self.ids, kind="stable")
+        sortedIds = self.ids[byId]
+        current = np.arange(n)
+        broken = np.zeros(n, dtype=bool)
+        active = self.parents != 0
+        if stop is not None:
+            active &= ~np.asarray(stop, dtype=bool)
+        for _ in range(n + 1):
+            if not active.any():
+                break
+            activeIndices = np.flatnonzero(active)
+            parentIds = self.parents[current[activeIndices]]
+            position = np.minimum(np.searchsorted(sortedIds, parentIds), max(n - 1, 0))
+            found = sortedIds[position] == parentIds
+            broken[activeIndices[~found]] = True
+            active[activeIndices[~found]] = False
+            foundIndices = activeIndices[found]
+            current[foundIndices] = byId[position[found]]
+            active[foundIndices] = self.parents[current[foundIndices]] != 0
+            if stop is not None:
+                active[foundIndices] &= ~stop[current[foundIndices]]
+        else:
+            broken |= active
+        return current, broken
+
+    def findBrokenChains(self):
+        """!Return a boolean array flagging the records for which a member of the parent chain is missing."""
+        return self._walkParentChains()[1]
+
+    def validate(self):
+        """!
+        Raise RuntimeError if any record's parent chain is broken.
+
+        This can occur at the boundaries of reference catalogs, when a parent lies outside the
+        region of interest but one of its children lies inside it.
+        """
+        if self.findBrokenChains().any():
+            raise RuntimeError("Reference catalog contains a child for which at least "
+                               "one parent in its parent chain is not in the catalog.")
+
+    def getAncestorIds(self, stop=None):
+        """!
+        Return the ID of the topmost ancestor of every record (the record's own ID for parentless
+        records).
+
+        @param[in]  stop   Optional boolean array; if given, the first record in each parent chain
+                           (starting with the record itself) for which this is True is returned
+                           instead.
+
+        A chain broken by a parent that is not in the catalog ends at the last record of that chain
+        that was found, so a record whose own parent is missing yields its own ID.
+        """
+        if stop is not None:
+            stop = np.asarray(stop, dtype=bool)
+        current, _ = self._walkParentChains(stop)
+        return self.ids[current]
+
+
+def _getColumn(catalog, key):
+    """Return a column of catalog as an array, whether or not the catalog is contiguous."""
+    if catalog.isContiguous():
+        return np.array(catalog[key])
+    return np.array([record.get(key) for record in catalog])
+
+
+def _subset(catalog, indices):
+    """Return a catalog that shares the records of catalog at the given indices."""
+    subset = type(catalog)(catalog.getTable())
+    subset.extend([catalog[int(i)] for i in indices])
+    return subset
@@ -54,6 +54,7 @@ from .pluginRegistry import PluginRegistry
 from .baseMeasurement import (BaseMeasurementPluginConfig, BaseMeasurementPlugin,
                               BaseMeasurementConfig, BaseMeasurementTask)
 from .noiseReplacer import NoiseReplacer, DummyNoiseReplacer
+from .familyIndex import FamilyIndex
 
 __all__ = ("ForcedPluginConfig", "ForcedPlugin",
            "ForcedMeasurementConfig", "ForcedMeasurementTask")
@@ -294,6 +295,9 @@ class ForcedMeasurementTask(BaseMeasurementTask):
            allow them to provide HeavyFootprints - for instance, ForcedPhotCoaddTask uses the HeavyFootprints
            from deblending run in the same band just before non-forced is run measurement in that band.
         """
+        # Recompile the plugin execution plans in case the plugins have been modified since the last run
+        self.clearExecutionPlans()
+
         # First check that the reference catalog does not contain any children for which
         # any member of their parent chain is not within the list.  This can occur at
         # boundaries when the parent is outside and one of the children is within.
@@ -303,15 +307,8 @@ class ForcedMeasurementTask(BaseMeasurementTask):
         #
         # I.e. this code checks that this precondition is satisfied by whatever reference
         # catalog provider is being paired with it.
-        refCatIdDict = {ref.getId(): ref.getParent() for ref in refCat}
-        for ref in refCat:
-            refId = ref.getId()
-            topId = refId
-            while(topId > 0):
-                if topId not in refCatIdDict:
-                    raise RuntimeError("Reference catalog contains a child for which at least "
-                                       "one parent in its parent chain is not in the catalog.")
-                topId = refCatIdDict[topId]
+        familyIndex = FamilyIndex.fromCatalog(refCat)
+        familyIndex.validate()
 
         # Construct a footprints dict which looks like
         # {ref.getId(): (ref.getParent(), source.getFootprint())}
@@ -324,7 +321,8 @@ class ForcedMeasurementTask(BaseMeasurementTask):
 
         if self.config.doReplaceWithNoise:
             noiseReplacer = NoiseReplacer(self.config.noiseReplacer, exposure,
-                                          footprints, log=self.log, exposureId=exposureId)
+                                          footprints, log=self.log, exposureId=exposureId,
+                                          maintainMaskPlanes=self.usesNoiseReplacerMaskPlanes())
             algMetadata = measCat.getTable().getMetadata()
             if algMetadata is not None:
                 algMetadata.addInt("NOISE_SEED_MULTIPLIER", self.config.noiseReplacer.noiseSeedMultiplier)
@@ -337,36 +335,129 @@ class ForcedMeasurementTask(BaseMeasurementTask):
 
         # Create parent cat which slices both the refCat and measCat (sources)
         # first, get the reference and source records which have no parent
-        refParentCat, measParentCat = refCat.getChildren(0, measCat)
-        for parentIdx, (refParentRecord, measParentRecord) in enumerate(zip(refParentCat, measParentCat)):
+        refParentCat = familyIndex.getParents(refCat)
+        measParentCat = familyIndex.getParents(measCat)
+        if isinstance(noiseReplacer, DummyNoiseReplacer):
+            self.measureAllInBatch(measCat, measParentCat, exposure, refCat, refParentCat, refWcs,
+                                   beginOrder=beginOrder, endOrder=endOrder, familyIndex=familyIndex)
+        else:
+            # Plugins that do not need each source isolated from its neighbors are run over the whole
+            # catalog outside the noise-replacement loop.
+            plan = self.getExecutionPlan(beginOrder, endOrder)
+            self.callMeasureMany(measCat, exposure, refCat, refWcs, beginOrder=beginOrder, endOrder=endOrder,
+                                 tier="catalogBefore")
+            if plan.isolated or plan.multi:
+                for parentIdx in range(len(refParentCat)):
+                    self.measureFamily(noiseReplacer, measCat, measParentCat, parentIdx, exposure,
+                                       refCat, refParentCat, refWcs, beginOrder=beginOrder, endOrder=endOrder,
+                                       familyIndex=familyIndex)
+            self.callMeasureMany(measCat, exposure, refCat, refWcs, beginOrder=beginOrder, endOrder=endOrder,
+                                 tier="catalogAfter")
+        noiseReplacer.end()
+
+        # Undeblended plugins only fire if we're running everything
+        if endOrder is None:
+            for measRecord, refRecord in zip(measCat, refCat):
+                for plugin in self.undeblendedPlugins.iter():
+                    self.doMeasurement(plugin, measRecord, exposure, refRecord, refWcs)
+
+        if self.config.doPluginMetrics:
+            self.writePluginMetrics()
+
+    def measureFamily(self, noiseReplacer, measCat, measParentCat, parentIdx, exposure,
+                      refCat, refParentCat, refWcs, beginOrder=None, endOrder=None, familyIndex=None):
+        """!Measure a single deblend family: each child in turn, then the parent, then the family
+        as a whole via measureN.
+
+        Only the plugins in the "isolated" tier of the execution plan are run on the individual
+        sources; the rest are run over the whole catalog by run().
+
+        @param[in]      noiseReplacer NoiseReplacer used to insert and remove sources.
+        @param[in,out]  measCat       Output SourceCatalog, as passed to run().
+        @param[in]      measParentCat Parentless records of measCat.
+        @param[in]      parentIdx     Index of the family's parent in measParentCat.
+        @param[in]      exposure      Image to be measured.
+        @param[in]      refCat        Reference SourceCatalog, parallel to measCat.
+        @param[in]      refParentCat  Parentless records of refCat, parallel to measParentCat.
+        @param[in]      refWcs        Wcs that defines the X,Y coordinate system of refCat.
+        @param[in]      beginOrder    beginning execution order (inclusive); None for no limit.
+        @param[in]      endOrder      ending execution order (exclusive); None for no limit.
+        @param[in]      familyIndex   FamilyIndex of refCat, used to find the children without
+                                      searching refCat; if None, refCat.getChildren() is used.
+        """
+        refParentRecord = refParentCat[parentIdx]
+        measParentRecord = measParentCat[parentIdx]
 
-            # first process the records which have the current parent as children
+        # first process the records which have the current parent as children
+        if familyIndex is None:
             refChildCat, measChildCat = refCat.getChildren(refParentRecord.getId(), measCat)
-            # TODO: skip this loop if there are no plugins configured for single-object mode
+        else:
+            refChildCat = familyIndex.getChildren(refCat, parentIdx)
+            measChildCat = familyIndex.getChildren(measCat, parentIdx)
+        if self.getExecutionPlan(beginOrder, endOrder).isolated:
             for refChildRecord, measChildRecord in zip(refChildCat, measChildCat):
                 noiseReplacer.insertSource(refChildRecord.getId())
                 self.callMeasure(measChildRecord, exposure, refChildRecord, refWcs,
-                                 beginOrder=beginOrder, endOrder=endOrder)
+                                 beginOrder=beginOrder, endOrder=endOrder, tier="isolated")
                 noiseReplacer.removeSource(refChildRecord.getId())
 
-            # then process the parent record
-            noiseReplacer.insertSource(refParentRecord.getId())
-            self.callMeasure(measParentRecord, exposure, refParentRecord, refWcs,
-                             beginOrder=beginOrder, endOrder=endOrder)
+        # then process the parent record
+        noiseReplacer.insertSource(refParentRecord.getId())
+        self.callMeasure(measParentRecord, exposure, refParentRecord, refWcs,
+                         beginOrder=beginOrder, endOrder=endOrder, tier="isolated")
+        self.callMeasureN(measParentCat[parentIdx:parentIdx+1], exposure,
+                          refParentCat[parentIdx:parentIdx+1],
+                          beginOrder=beginOrder, endOrder=endOrder)
+        # measure all the children simultaneously
+        self.callMeasureN(measChildCat, exposure, refChildCat,
+                          beginOrder=beginOrder, endOrder=endOrder)
+        noiseReplacer.removeSource(refParentRecord.getId())
+
+    def measureAllInBatch(self, measCat, measParentCat, exposure, refCat, refParentCat, refWcs,
+                          beginOrder=None, endOrder=None, familyIndex=None):
+        """!Measure all sources without noise replacement, one plugin at a time.
+
+        Each plugin measures every record in measCat via callMeasureMany(), which lets wrapped C++
+        algorithms loop over the records in C++; any measureN() plugins are then run on each family
+        as in run().  Only valid when no sources are replaced with noise.
+
+        @param[in,out]  measCat       Output SourceCatalog, as passed to run().
+        @param[in]      measParentCat Parentless records of measCat.
+        @param[in]      exposure      Image to be measured.
+        @param[in]      refCat        Reference SourceCatalog, parallel to measCat.
+        @param[in]      refParentCat  Parentless records of refCat, parallel to measParentCat.
+        @param[in]      refWcs        Wcs that defines the X,Y coordinate system of refCat.
+        @param[in]      beginOrder    beginning execution order (inclusive); None for no limit.
+        @param[in]      endOrder      ending execution order (exclusive); None for no limit.
+        @param[in]      familyIndex   FamilyIndex of refCat; built from refCat if None.
+        """
+        self.callMeasureMany(measCat, exposure, refCat, refWcs, beginOrder=beginOrder, endOrder=endOrder)
+        if not any(True for _ in self.plugins.iterN()):
+            return
+        if familyIndex is None:
+            familyIndex = FamilyIndex.fromCatalog(refCat)
+        for parentIdx in range(len(refParentCat)):
+            refChildCat = familyIndex.getChildren(refCat, parentIdx)
+            measChildCat = familyIndex.getChildren(measCat, parentIdx)
             self.callMeasureN(measParentCat[parentIdx:parentIdx+1], exposure,
                               refParentCat[parentIdx:parentIdx+1],
                               beginOrder=beginOrder, endOrder=endOrder)
-            # measure all the children simultaneously
             self.callMeasureN(measChildCat, exposure, refChildCat,
                               beginOrder=beginOrder, endOrder=endOrder)
-            noiseReplacer.removeSource(refParentRecord.getId())
-        noiseReplacer.end()
 
-        # Undeblended plugins only fire if we're running everything
-        if endOrder is None:
+    def doMeasurementMany(self, plugin, measCat, exposure, refCat, refWcs):
+        """!Call the measureMany() method on the nominated plugin, handling exceptions in a consistent way.
+
+        As BaseMeasurementTask.doMeasurementMany, except that plugins without a measureMany() method
+        are passed the reference record matching each measurement record.
+        """
+        if not plugin.hasMeasureMany:
+            step = self._getPlanStep(plugin)
             for measRecord, refRecord in zip(measCat, refCat):
-                for plugin in self.undeblendedPlugins.iter():
-                    self.doMeasurement(plugin, measRecord, exposure, refRecord, refWcs)
+                self._runMeasure(plugin, step.measure, step.fail, step.log, measRecord, exposure, refRecord,
+                                 refWcs)
+            return
+        BaseMeasurementTask.doMeasurementMany(self, plugin, measCat, exposure, refCat, refWcs)
 
     def generateMeasCat(self, exposure, refCat, refWcs, idFactory=None):
         """!Initialize an output SourceCatalog using information from the reference catalog.
@@ -390,9 +481,13 @@ class ForcedMeasurementTask(BaseMeasurementTask):
         table = measCat.table
         table.setMetadata(self.algMetadata)
         table.preallocate(len(refCat))
-        for ref in refCat:
-            newSource = measCat.addNew()
-            newSource.assign(ref, self.mapper)
+        if isinstance(refCat, lsst.afw.table.SourceCatalog):
+            # Let afw allocate and fill all of the records in one call, rather than one at a time
+            measCat.extend(refCat, mapper=self.mapper)
+        else:
+            for ref in refCat:
+                newSource = measCat.addNew()
+                newSource.assign(ref, self.mapper)
         return measCat
 
     def attachTransformedFootprints(self, sources, refCat, exposure, refWcs):
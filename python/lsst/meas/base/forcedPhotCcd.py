@@ -22,6 +22,8 @@
 #
 import collections
 
+import numpy as np
+
 import lsst.pex.config
 import lsst.pex.exceptions
 from lsst.log import Log
@@ -33,6 +35,8 @@ import lsst.afw.table
 import lsst.sphgeom
 
 from .forcedPhotImage import ForcedPhotImageTask, ForcedPhotImageConfig
+from .references import skyMapCache
+from .familyIndex import _getColumn
 
 try:
     from lsst.meas.mosaic import applyMosaicResults
@@ -70,7 +74,8 @@ class PerTractCcdDataIdContainer(lsst.pipe.base.DataIdContainer):
                 # Discover which tracts the data overlaps
                 log.info("Reading WCS for components of dataId=%s to determine tracts", dict(dataId))
                 if skymap is None:
-                    skymap = namespace.butler.get(namespace.config.coaddName + "Coadd_skyMap")
+                    skymap = skyMapCache.getSkyMap(namespace.butler,
+                                                   namespace.config.coaddName + "Coadd_skyMap")
 
                 for ref in namespace.butler.subset("calexp", dataId=dataId):
                     if not ref.datasetExists("calexp"):
@@ -199,19 +204,26 @@ class ForcedPhotCcdTask(ForcedPhotImageTask):
         All work is delegated to the references subtask; see CoaddSrcReferencesTask for information
         about the default behavior.
         """
-        references = lsst.afw.table.SourceCatalog(self.references.schema)
-        badParents = set()
-        unfiltered = self.references.fetchInBox(dataRef, exposure.getBBox(), exposure.getWcs())
-        for record in unfiltered:
-            if record.getFootprint() is None or record.getFootprint().getArea() == 0:
-                if record.getParent() != 0:
-                    self.log.warn("Skipping reference %s (child of %s) with bad Footprint",
-                                  record.getId(), record.getParent())
-                else:
-                    self.log.warn("Skipping reference parent %s with bad Footprint", record.getId())
-                    badParents.add(record.getId())
-            elif record.getParent() not in badParents:
-                references.append(record)
+        references = self.references.fetchInBox(dataRef, exposure.getBBox(), exposure.getWcs())
+        if not isinstance(references, lsst.afw.table.SourceCatalog):
+            # Collect the records in a catalog without copying them
+            catalog = lsst.afw.table.SourceCatalog(self.references.schema)
+            catalog.extend(references)
+            references = catalog
+        # The catalog returned by fetchInBox is usually a subset, which is not contiguous, so the
+        # columns are read record by record rather than copying the records to make it contiguous.
+        ids = _getColumn(references, lsst.afw.table.SourceTable.getIdKey())
+        parents = _getColumn(references, lsst.afw.table.SourceTable.getParentKey())
+        bad = np.array([record.getFootprint() is None or record.getFootprint().getArea() == 0
+                        for record in references], dtype=bool)
+        for i in np.flatnonzero(bad):
+            if parents[i] != 0:
+                self.log.warn("Skipping reference %s (child of %s) with bad Footprint", ids[i], parents[i])
+            else:
+                self.log.warn("Skipping reference parent %s with bad Footprint", ids[i])
+        # Children of parents with bad Footprints are dropped too, wherever they are in the catalog.
+        bad |= np.isin(parents, ids[bad & (parents == 0)])
+        references = references.subset(~bad)
         # catalog must be sorted by parent ID for lsst.afw.table.getChildren to work
         references.sort(lsst.afw.table.SourceTable.getParentKey())
         return references
@@ -27,6 +27,7 @@ import lsst.coadd.utils
 import lsst.afw.table
 
 from .forcedPhotImage import ForcedPhotImageConfig, ForcedPhotImageTask
+from .references import skyMapCache
 
 __all__ = ("ForcedPhotCoaddConfig", "ForcedPhotCoaddTask")
 
@@ -140,10 +141,8 @@ class ForcedPhotCoaddTask(ForcedPhotImageTask):
         All work is delegated to the references subtask; see CoaddSrcReferencesTask for information
         about the default behavior.
         """
-        skyMap = dataRef.get(self.dataPrefix + "skyMap", immediate=True)
-        tractInfo = skyMap[dataRef.dataId["tract"]]
-        patch = tuple(int(v) for v in dataRef.dataId["patch"].split(","))
-        patchInfo = tractInfo.getPatchInfo(patch)
+        patchInfo = skyMapCache.getPatchInfo(dataRef, self.dataPrefix + "skyMap", dataRef.dataId["tract"],
+                                             dataRef.dataId["patch"])
         references = lsst.afw.table.SourceCatalog(self.references.schema)
         references.extend(self.references.fetchInPatches(dataRef, patchList=[patchInfo]))
         return references
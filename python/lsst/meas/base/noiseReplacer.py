@@ -21,14 +21,20 @@
 # see <https://www.lsstcorp.org/LegalNotices/>.
 #
 
+import concurrent.futures
 import math
+import tempfile
+
+import numpy as np
 
 import lsst.afw.detection as afwDet
 import lsst.afw.image as afwImage
 import lsst.afw.math as afwMath
 import lsst.pex.config
 
-__all__ = ("NoiseReplacerConfig", "NoiseReplacer", "DummyNoiseReplacer")
+from .familyIndex import FamilyIndex
+
+__all__ = ("NoiseReplacerConfig", "NoiseReplacer", "DummyNoiseReplacer", "NoiseReplacerList")
 
 
 class NoiseReplacerConfig(lsst.pex.config.Config):
@@ -52,6 +58,58 @@ class NoiseReplacerConfig(lsst.pex.config.Config):
         "   >= 1: set the seed deterministically based on exposureId\n"
         "      0: fall back to the afw.math.Random default constructor (which uses a seed value of 1)"
     )
+    lazyNoise = lsst.pex.config.Field(
+        dtype=bool, default=False,
+        doc="Regenerate the noise pixels of each source whenever they are needed, from a seed derived\n"
+        "from the exposure ID, noiseSeedMultiplier and the source ID, rather than keeping them in\n"
+        "memory for the whole run.  This gives a different (but equally reproducible) noise\n"
+        "realization from the default, in exchange for a much smaller memory footprint."
+    )
+    noiseRandomGenerator = lsst.pex.config.ChoiceField(
+        dtype=str, default="sequential",
+        doc="How to generate the random numbers for the noise",
+        allowed={
+            "sequential": "Draw the noise for all sources in turn from a single afw.math.Random "
+                          "generator, so the noise of each source depends on the processing order",
+            "counter": "Draw the noise for each source from a counter-based (Philox) generator keyed by "
+                       "the exposure-level seed and the source ID, so the noise of each source depends "
+                       "only on its identity",
+        },
+    )
+    noiseStatisticsSampleSize = lsst.pex.config.Field(
+        dtype=int, default=0,
+        doc="Maximum number of pixels from which to measure the clipped mean and standard deviation\n"
+        "when noiseSource='measure'; larger images are subsampled on a regular grid.  The relative\n"
+        "statistical error of the standard deviation is about 1/sqrt(2*N) (0.07% for N = 10**6).\n"
+        "0 to use every pixel."
+    )
+    cacheNoiseStatistics = lsst.pex.config.Field(
+        dtype=bool, default=False,
+        doc="Record the clipped mean and standard deviation measured when noiseSource='measure' in\n"
+        "the exposure metadata (NOISE_MEASURED_MEAN, NOISE_MEASURED_STDEV, NOISE_MEASURED_NPIX), and\n"
+        "reuse them when later NoiseReplacers are constructed for the same exposure.  Only safe if\n"
+        "the image is not modified in between."
+    )
+    noiseBankSize = lsst.pex.config.Field(
+        dtype=int, default=0,
+        doc="If positive, draw a single square tile of this many pixels on a side of unit Gaussian\n"
+        "deviates once per exposure, and fill each footprint with the deviates at its pixel coordinates\n"
+        "modulo the tile size (scaled according to noiseSource), instead of drawing new random numbers\n"
+        "for every footprint.  The noise is then periodic on this scale, so it should be much larger\n"
+        "than any footprint; 0 to draw fresh random numbers for every footprint."
+    )
+    maxPixelStoreMemory = lsst.pex.config.Field(
+        dtype=int, default=None, optional=True,
+        doc="Maximum size in MiB of the in-memory store of the original pixels of the sources, including\n"
+        "their precomputed pixel indices (see precomputePixelIndices).  Larger stores are backed by\n"
+        "memory-mapped temporary files instead.  None for no limit."
+    )
+    precomputePixelIndices = lsst.pex.config.Field(
+        dtype=bool, default=True,
+        doc="Precompute the index of every source pixel in the image, so that sources are inserted and\n"
+        "removed with NumPy fancy indexing rather than by walking their spans.  This costs 4 bytes\n"
+        "of memory per source pixel (8 for images of more than 2**31 pixels)."
+    )
 
 
 class NoiseReplacer:
@@ -76,7 +134,8 @@ class NoiseReplacer:
 
     ConfigClass = NoiseReplacerConfig
 
-    def __init__(self, config, exposure, footprints, noiseImage=None, exposureId=None, log=None):
+    def __init__(self, config, exposure, footprints, noiseImage=None, exposureId=None, log=None,
+                 maintainMaskPlanes=True):
         """!
         Initialize the NoiseReplacer.
 
@@ -87,6 +146,10 @@ class NoiseReplacer:
                                      (for tests only)
         @param[in]      log          Log object to use for status messages; no status messages
                                      will be printed if None
+        @param[in]      maintainMaskPlanes  If True, add the temporary THISDET and OTHERDET mask planes
+                                     and keep them up to date as sources are inserted and removed.
+                                     The measurement tasks only set this if one of their plugins
+                                     uses these planes.
 
         'footprints' is a dict of {id: (parent, footprint)}; when used in SFM, the ID will be the
         source ID, but in forced photometry, this will be the reference ID, as that's what we used to
@@ -105,6 +168,10 @@ class NoiseReplacer:
         self.noiseSource = config.noiseSource
         self.noiseOffset = config.noiseOffset
         self.noiseSeedMultiplier = config.noiseSeedMultiplier
+        self.lazyNoise = config.lazyNoise
+        self.noiseRandomGenerator = config.noiseRandomGenerator
+        self.noiseStatisticsSampleSize = config.noiseStatisticsSampleSize
+        self.cacheNoiseStatistics = config.cacheNoiseStatistics
         self.noiseGenMean = None
         self.noiseGenStd = None
         self.log = log
@@ -117,9 +184,13 @@ class NoiseReplacer:
         im = mi.getImage()
         mask = mi.getMask()
         # Add temporary Mask planes for THISDET and OTHERDET
+        self.maintainMaskPlanes = maintainMaskPlanes
         self.removeplanes = []
         bitmasks = []
         for maskname in ['THISDET', 'OTHERDET']:
+            if not maintainMaskPlanes:
+                bitmasks.append(0)
+                continue
             try:
                 # does it already exist?
                 plane = mask.getMaskPlane(maskname)
@@ -137,47 +208,82 @@ class NoiseReplacer:
                                maskname, plane, bitmask, bitmask)
         self.thisbitmask, self.otherbitmask = bitmasks
         del bitmasks
-        self.heavies = {}
-        # Start by creating HeavyFootprints for each source which has no parent
+        # Start by saving the original pixels of each source which has no parent
         # and just use them for children which do not already have heavy footprints.
-        # If a heavy footprint is available for a child, we will use it. Otherwise,
+        # If a heavy footprint is available for a child, we will use its pixels. Otherwise,
         # we use the first parent in the parent chain which has a heavy footprint,
         # which with the one level deblender will alway be the topmost parent
         # NOTE: heavy footprints get destroyed by the transform process in forcedPhotImage.py,
         # so they are never available for forced measurements.
 
-        # Create in the dict heavies = {id:heavyfootprint}
+        # Only the image pixels are saved (the mask and variance planes are never modified), in a
+        # single buffer: heavies = PixelStore of {id: pixels}
+        spansById = {id: fp[1].spans for id, fp in footprints.items() if fp[1].isHeavy() or fp[0] == 0}
+        maxBytes = None
+        if config.maxPixelStoreMemory is not None:
+            maxBytes = config.maxPixelStoreMemory*1024*1024
+        self.heavies = PixelStore(spansById, dtype=im.getArray().dtype, maxBytes=maxBytes,
+                                  bbox=im.getBBox() if config.precomputePixelIndices else None)
+        if self.log and self.heavies.isMapped:
+            self.log.debug('Saving %d source pixels in memory-mapped files', self.heavies.size)
         for id, fp in footprints.items():
+            if id not in self.heavies:
+                continue
             if fp[1].isHeavy():
-                self.heavies[id] = fp[1]
-            elif fp[0] == 0:
-                self.heavies[id] = afwDet.makeHeavyFootprint(fp[1], mi)
-
-        # ## FIXME: the heavy footprint includes the mask
-        # ## and variance planes, which we shouldn't need
-        # ## (I don't think we ever want to modify them in
-        # ## the input image).  Copying them around is
-        # ## wasteful.
-
-        # We now create a noise HeavyFootprint for each source with has a heavy footprint.
-        # We'll put the noise footprints in a dict heavyNoise = {id:heavyNoiseFootprint}
+                self.heavies.setPixels(id, fp[1].getImageArray())
+            else:
+                self.heavies.copyFrom(id, im)
+        self._heavyIds = self._findHeavyIds()
+
+        # We now create noise pixels for each source with has a heavy footprint.
+        # We'll put the flattened noise pixels in a dict heavyNoise = {id:noisePixels},
+        # unless they are to be regenerated on demand by _getNoisePixels.
         self.heavyNoise = {}
         noisegen = self.getNoiseGenerator(exposure, noiseImage, noiseMeanVar, exposureId=exposureId)
+        if config.noiseBankSize > 0 and isinstance(noisegen, GaussianNoiseGenerator):
+            noisegen.makeNoiseBank(config.noiseBankSize)
+        self.noiseGenerator = noisegen
+        self.noiseSeed = self.getNoiseSeed(exposureId)
         #  The noiseGenMean and Std are used by the unit tests
         self.noiseGenMean = noisegen.mean
         self.noiseGenStd = noisegen.std
         if self.log:
             self.log.debug('Using noise generator: %s', str(noisegen))
-        for id in self.heavies:
-            fp = footprints[id][1]
-            noiseFp = noisegen.getHeavyFootprint(fp)
-            self.heavyNoise[id] = noiseFp
-            # Also insert the noisy footprint into the image now.
-            # Notice that we're just inserting it into "im", ie,
-            # the Image, not the MaskedImage.
-            noiseFp.insert(im)
-            # Also set the OTHERDET bit
-            fp.spans.setMask(mask, self.otherbitmask)
+        if not self.lazyNoise:
+            for id in self.heavies:
+                self.heavyNoise[id] = self._getNoisePixels(id)
+        # Also insert the noise pixels into the image now.
+        # Notice that we're just inserting them into "im", ie,
+        # the Image, not the MaskedImage.
+        self._noiseOrder = self._findNoiseOrder()
+        self._insertAllNoise(im, mask)
+        self.isSuspended = False
+
+    def suspend(self):
+        """!
+        Temporarily restore the original pixels and mask of the exposure
+
+        This puts the exposure in the same state as end() does, but keeps all the saved pixels,
+        so resume() can replace the sources with noise again without repeating the work done at
+        construction.  Does nothing if the NoiseReplacer is already suspended.
+        """
+        if self.isSuspended:
+            return
+        self._restoreOriginals()
+        if self.maintainMaskPlanes:
+            mask = self.exposure.getMaskedImage().getMask()
+            mask.getArray()[:] &= ~(self.thisbitmask | self.otherbitmask)
+        self.isSuspended = True
+
+    def resume(self):
+        """!
+        Replace all sources with noise again after suspend(); does nothing if not suspended.
+        """
+        if not self.isSuspended:
+            return
+        mi = self.exposure.getMaskedImage()
+        self._insertAllNoise(mi.getImage(), mi.getMask())
+        self.isSuspended = False
 
     def insertSource(self, id):
         """!
@@ -187,20 +293,7 @@ class NoiseReplacer:
 
         Also adjusts the mask plane to show the source of this footprint.
         """
-        # Copy this source's pixels into the image
-        mi = self.exposure.getMaskedImage()
-        im = mi.getImage()
-        mask = mi.getMask()
-        # usedid can point either to this source, or to the first parent in the
-        # parent chain which has a heavy footprint (or to the topmost parent,
-        # which always has one)
-        usedid = id
-        while self.footprints[usedid][0] != 0 and usedid not in self.heavies:
-            usedid = self.footprints[usedid][0]
-        fp = self.heavies[usedid]
-        fp.insert(im)
-        fp.spans.setMask(mask, self.thisbitmask)
-        fp.spans.clearMask(mask, self.otherbitmask)
+        self._insertSource(id, self.exposure.getMaskedImage())
 
     def removeSource(self, id):
         """!
@@ -210,50 +303,179 @@ class NoiseReplacer:
 
         Also restore the mask plane.
         """
+        self._removeSource(id, self.exposure.getMaskedImage())
+
+    def makeCutoutReplacer(self, cutout):
+        """!
+        Return an object that inserts and removes sources in a cutout of the exposure
+
+        @param[in,out]  cutout   Deep copy of a subimage of the (noise-replaced) exposure, which
+                                 must contain the Footprints of all sources later inserted.
+
+        The returned object shares all of this NoiseReplacer's state, and has the same
+        insertSource() and removeSource() methods; its end() does nothing, as the cutout is
+        simply discarded when it is no longer needed.
+        """
+        return CutoutNoiseReplacer(self, cutout)
+
+    def _getHeavyId(self, id):
+        """!
+        Return the id of the source whose HeavyFootprint is used when inserting the given source
+
+        This can point either to the source itself, or to the first parent in the parent chain
+        which has a heavy footprint (or to the topmost parent, which always has one).
+        """
+        return self._heavyIds[id]
+
+    def _findHeavyIds(self):
+        """!
+        Return a dict of {id: id of the source whose HeavyFootprint is used to insert it}
+
+        The parent chains of all sources are followed at once by a FamilyIndex, rather than
+        one source at a time on every insertion and removal.
+        """
+        ids = np.fromiter(self.footprints.keys(), dtype=np.int64, count=len(self.footprints))
+        parents = np.fromiter((fp[0] for fp in self.footprints.values()), dtype=np.int64,
+                              count=len(self.footprints))
+        hasHeavy = np.fromiter((id in self.heavies for id in self.footprints.keys()), dtype=bool,
+                               count=len(self.footprints))
+        heavyIds = FamilyIndex(ids, parents).getAncestorIds(stop=hasHeavy)
+        return dict(zip(ids.tolist(), heavyIds.tolist()))
+
+    def _findNoiseOrder(self):
+        """!
+        Return the IDs of the sources with saved pixels, in the order in which their noise is inserted
+
+        The most deeply nested children come first and the topmost parents last (ordered by ID within
+        each level), so the pixels shared by a blend always end up holding the noise of its topmost
+        parent, which is also what removeSource() leaves behind.  The result therefore does not depend
+        on the order of the footprints dict.
+        """
+        depths = {}
+        for id in self.footprints:
+            chain = []
+            current = id
+            while current not in depths:
+                parent = self.footprints[current][0]
+                if parent == 0 or parent not in self.footprints:
+                    depths[current] = 0
+                    break
+                chain.append(current)
+                current = parent
+            depth = depths[current]
+            for member in reversed(chain):
+                depth += 1
+                depths[member] = depth
+        return sorted(self.heavies, key=lambda id: (-depths[id], id))
+
+    def _insertAllNoise(self, im, mask):
+        """!Replace every source with noise, and set the OTHERDET bit, in _findNoiseOrder() order."""
+        for id in self._noiseOrder:
+            self.heavies.insertPixels(id, im, self._getNoisePixels(id))
+            if self.maintainMaskPlanes:
+                self.heavies.setMask(id, mask, self.otherbitmask)
+
+    def _getNoisePixels(self, id):
+        """!
+        Return the noise pixels that replace the pixels of the given source, in the order of
+        SpanSet.flatten()
+
+        In lazy noise mode these are regenerated from the source's own seed on every call, so the
+        same pixels are produced each time without being stored.  With the "counter" random number
+        generator they are always a pure function of the exposure-level seed and the source ID.
+        """
+        if id in self.heavyNoise:
+            return self.heavyNoise[id]
+        footprint = self.footprints[id][1]
+        if self.noiseRandomGenerator == "counter":
+            return self.noiseGenerator.getSourcePixels(footprint, (self.noiseSeed, id))
+        if self.lazyNoise:
+            self.noiseGenerator.setSeed(self.getSourceNoiseSeed(id))
+        return self.noiseGenerator.getHeavyFootprint(footprint).getImageArray()
+
+    def getNoiseSeed(self, exposureId=None):
+        """!
+        Return the seed from which the random number generator is initialized
+
+        This is derived from the exposure ID and config.noiseSeedMultiplier; it is 1 (the default
+        seed of afw.math.Random) if noiseSeedMultiplier is 0.
+        """
+        if not self.noiseSeedMultiplier:
+            return 1
+        if exposureId is not None and exposureId != 0:
+            return exposureId*self.noiseSeedMultiplier
+        return self.noiseSeedMultiplier
+
+    def getSourceNoiseSeed(self, id):
+        """!
+        Return the seed used to generate the noise for the given source in lazy noise mode
+
+        The exposure-level seed and the source ID are combined with the SplitMix64 finalizer, so
+        that the seeds of neighboring sources are unrelated.  The result is a nonzero 32-bit value,
+        as accepted by all of the afw.math.Random algorithms.
+        """
+        mask = 0xFFFFFFFFFFFFFFFF
+        value = (self.noiseSeed*0x9E3779B97F4A7C15 + id) & mask
+        value = ((value ^ (value >> 30))*0xBF58476D1CE4E5B9) & mask
+        value = ((value ^ (value >> 27))*0x94D049BB133111EB) & mask
+        value ^= value >> 31
+        return (value & 0xFFFFFFFF) or 1
+
+    def _insertSource(self, id, mi):
+        # Copy this source's pixels into the image
+        im = mi.getImage()
+        mask = mi.getMask()
+        heavyId = self._getHeavyId(id)
+        self.heavies.insert(heavyId, im)
+        if self.maintainMaskPlanes:
+            self.heavies.setMask(heavyId, mask, self.thisbitmask)
+            self.heavies.clearMask(heavyId, mask, self.otherbitmask)
+
+    def _removeSource(self, id, mi):
         # remove a single source
         # (Replace this source's pixels by noise again.)
         # Do this by finding the source's top-level ancestor
-        mi = self.exposure.getMaskedImage()
         im = mi.getImage()
         mask = mi.getMask()
-
-        # use the same algorithm as in remove Source to find the heavy noise footprint
+        # use the same algorithm as in insertSource to find the heavy noise footprint
         # which will undo what insertSource(id) does
-        usedid = id
-        while self.footprints[usedid][0] != 0 and usedid not in self.heavies:
-            usedid = self.footprints[usedid][0]
+        heavyId = self._getHeavyId(id)
         # Re-insert the noise pixels
-        fp = self.heavyNoise[usedid]
-        fp.insert(im)
+        self.heavies.insertPixels(heavyId, im, self._getNoisePixels(heavyId))
         # Clear the THISDET mask plane.
-        fp.spans.clearMask(mask, self.thisbitmask)
-        fp.spans.setMask(mask, self.otherbitmask)
+        if self.maintainMaskPlanes:
+            self.heavies.clearMask(heavyId, mask, self.thisbitmask)
+            self.heavies.setMask(heavyId, mask, self.otherbitmask)
 
     def end(self):
         """!
         End the NoiseReplacer.
 
-        Restore original data to the exposure from the heavies dictionary
+        Restore original data to the exposure from the heavies store
         Restore the mask planes to their original state
         """
         # restores original image, cleans up temporaries
-        # (ie, replace all the top-level pixels)
-        mi = self.exposure.getMaskedImage()
-        im = mi.getImage()
-        mask = mi.getMask()
-        for id in self.footprints.keys():
-            if self.footprints[id][0] != 0:
-                continue
-            self.heavies[id].insert(im)
+        if not self.isSuspended:
+            self._restoreOriginals()
+        mask = self.exposure.getMaskedImage().getMask()
         for maskname in self.removeplanes:
             mask.removeAndClearMaskPlane(maskname, True)
 
         del self.removeplanes
         del self.thisbitmask
         del self.otherbitmask
+        self.heavies.close()
         del self.heavies
         del self.heavyNoise
 
+    def _restoreOriginals(self):
+        # (ie, replace all the top-level pixels)
+        im = self.exposure.getMaskedImage().getImage()
+        for id in self.footprints.keys():
+            if self.footprints[id][0] != 0:
+                continue
+            self.heavies.insert(id, im)
+
     def getNoiseGenerator(self, exposure, noiseImage, noiseMeanVar, exposureId=None):
         """!
         Generate noise image using parameters given
@@ -263,11 +485,7 @@ class NoiseReplacer:
         rand = None
         if self.noiseSeedMultiplier:
             # default plugin, our seed
-            if exposureId is not None and exposureId != 0:
-                seed = exposureId*self.noiseSeedMultiplier
-            else:
-                seed = self.noiseSeedMultiplier
-            rand = afwMath.Random(afwMath.Random.MT19937, seed)
+            rand = afwMath.Random(afwMath.Random.MT19937, self.getNoiseSeed(exposureId))
         if noiseMeanVar is not None:
             try:
                 # Assume noiseMeanVar is an iterable of floats
@@ -308,49 +526,295 @@ class NoiseReplacer:
             var = exposure.getMaskedImage().getVariance()
             return VariancePlaneNoiseGenerator(var, mean=offset, rand=rand)
 
-        # Compute an image-wide clipped variance.
+        noiseMean, noiseStd = self.getImageStatistics(exposure)
+        return FixedGaussianNoiseGenerator(noiseMean + offset, noiseStd, rand=rand)
+
+    def getImageStatistics(self, exposure):
+        """!
+        Return the image-wide clipped mean and standard deviation of the exposure
+
+        The statistics are measured from a regular subsample of at most noiseStatisticsSampleSize
+        pixels (all pixels if that is 0).  If cacheNoiseStatistics is set, they are read from the
+        exposure metadata when they have already been recorded there for the same sample size,
+        and recorded there otherwise.
+        """
         im = exposure.getMaskedImage().getImage()
+        array = im.getArray()
+        step = 1
+        if self.noiseStatisticsSampleSize > 0 and array.size > self.noiseStatisticsSampleSize:
+            step = int(math.ceil(math.sqrt(array.size/self.noiseStatisticsSampleSize)))
+        nPix = len(range(0, array.shape[0], step))*len(range(0, array.shape[1], step))
+        meta = exposure.getMetadata() if self.cacheNoiseStatistics else None
+        if (meta is not None and meta.exists("NOISE_MEASURED_NPIX") and
+                meta.getAsInt("NOISE_MEASURED_NPIX") == nPix):
+            noiseMean = meta.getAsDouble("NOISE_MEASURED_MEAN")
+            noiseStd = meta.getAsDouble("NOISE_MEASURED_STDEV")
+            if self.log:
+                self.log.debug("Using clipped mean = %g, stdev = %g from exposure metadata",
+                               noiseMean, noiseStd)
+            return noiseMean, noiseStd
+
+        # Compute an image-wide clipped variance.
+        if step > 1:
+            im = afwImage.ImageF(np.ascontiguousarray(array[::step, ::step], dtype=np.float32))
         s = afwMath.makeStatistics(im, afwMath.MEANCLIP | afwMath.STDEVCLIP)
         noiseMean = s.getValue(afwMath.MEANCLIP)
         noiseStd = s.getValue(afwMath.STDEVCLIP)
         if self.log:
-            self.log.debug("Measured from image: clipped mean = %g, stdev = %g",
-                           noiseMean, noiseStd)
-        return FixedGaussianNoiseGenerator(noiseMean + offset, noiseStd, rand=rand)
+            self.log.debug("Measured from image (%d pixels): clipped mean = %g, stdev = %g",
+                           nPix, noiseMean, noiseStd)
+        if meta is not None:
+            meta.set("NOISE_MEASURED_NPIX", nPix)
+            meta.set("NOISE_MEASURED_MEAN", noiseMean)
+            meta.set("NOISE_MEASURED_STDEV", noiseStd)
+        return noiseMean, noiseStd
+
+
+class PixelStore:
+    """!
+    Image pixels within a set of SpanSets, saved in a single contiguous buffer
+
+    The buffer holds the pixels of each SpanSet in turn, in the order of SpanSet.flatten(); the
+    offset of each SpanSet's pixels is computed once, when the store is created.
+
+    If a bounding box is given, the flat index of every pixel within an image with that bounding
+    box is also computed once, in a second buffer parallel to the first.  If the buffers would
+    together be larger than maxBytes, both are backed by memory-mapped temporary files (deleted
+    by close()) rather than by memory.  Pixels and mask bits are
+    then scattered into such images with a single NumPy fancy-index assignment, rather than by
+    walking the spans; other images (e.g. cutouts) and SpanSets that extend beyond the bounding
+    box fall back to the SpanSet methods.
+    """
+
+    def __init__(self, spansById, dtype=np.float32, maxBytes=None, bbox=None):
+        """!
+        @param[in]  spansById   dict of {id: SpanSet}
+        @param[in]  dtype       data type of the pixels
+        @param[in]  maxBytes    maximum total size of the in-memory buffers; None for no limit.
+        @param[in]  bbox        Box2I of the images for which to precompute pixel indices;
+                                None to always use the SpanSet methods.
+        """
+        self._spans = spansById
+        self._offsets = {}
+        size = 0
+        for id, spans in spansById.items():
+            area = spans.getArea()
+            self._offsets[id] = (size, size + area)
+            size += area
+        self.size = size
+        dtype = np.dtype(dtype)
+        nBytes = size*dtype.itemsize
+        if bbox is not None:
+            indexType = np.dtype(np.int32 if bbox.getArea() < 2**31 else np.int64)
+            nBytes += size*indexType.itemsize
+        self._files = []
+        self.isMapped = maxBytes is not None and nBytes > maxBytes
+        self._buffer = self._allocate(size, dtype)
+        self._bbox = bbox
+        self._indices = None
+        self._indexed = set()
+        if bbox is not None:
+            width = bbox.getWidth()
+            self._indices = self._allocate(size, indexType)
+            for id, spans in spansById.items():
+                if not bbox.contains(spans.getBBox()):
+                    continue
+                begin, end = self._offsets[id]
+                ys, xs = spans.indices()
+                self._indices[begin:end] = (ys - bbox.getMinY())*width + (xs - bbox.getMinX())
+                self._indexed.add(id)
+
+    def _allocate(self, size, dtype):
+        """Return an uninitialized array, backed by a temporary file if the store is memory-mapped."""
+        if not self.isMapped:
+            return np.empty(size, dtype=dtype)
+        self._files.append(tempfile.TemporaryFile())
+        return np.memmap(self._files[-1], dtype=dtype, mode="w+", shape=(size,))
+
+    def __contains__(self, id):
+        return id in self._offsets
+
+    def __iter__(self):
+        return iter(self._offsets)
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def getSpans(self, id):
+        """!Return the SpanSet of the given ID."""
+        return self._spans[id]
+
+    def getPixels(self, id):
+        """!Return a view of the saved pixels of the given ID, in the order of SpanSet.flatten()."""
+        begin, end = self._offsets[id]
+        return self._buffer[begin:end]
+
+    def setPixels(self, id, pixels):
+        """!Save the given flattened pixels (e.g. HeavyFootprint.getImageArray()) for the given ID."""
+        self.getPixels(id)[:] = pixels
+
+    def _getFlatIndices(self, id, image):
+        """!
+        Return (flattened view of image's array, flat indices of the given ID's pixels within it),
+        or (None, None) if the indices cannot be used for this image.
+        """
+        if id not in self._indexed or image.getBBox() != self._bbox:
+            return None, None
+        array = image.getArray()
+        if not array.flags.c_contiguous:
+            return None, None
+        begin, end = self._offsets[id]
+        return array.reshape(-1), self._indices[begin:end]
+
+    def copyFrom(self, id, image):
+        """!Save the pixels of the given image within the SpanSet of the given ID."""
+        flat, indices = self._getFlatIndices(id, image)
+        if indices is not None:
+            self.getPixels(id)[:] = flat[indices]
+        else:
+            self._spans[id].flatten(self.getPixels(id), image.getArray(), image.getXY0())
+
+    def insertPixels(self, id, image, pixels):
+        """!Copy the given flattened pixels into the image, within the SpanSet of the given ID."""
+        flat, indices = self._getFlatIndices(id, image)
+        if indices is not None:
+            flat[indices] = pixels
+        else:
+            self._spans[id].unflatten(image.getArray(), pixels, image.getXY0())
+
+    def insert(self, id, image):
+        """!Copy the saved pixels of the given ID into the image."""
+        self.insertPixels(id, image, self.getPixels(id))
+
+    def setMask(self, id, mask, bitmask):
+        """!Set the given bits of the mask within the SpanSet of the given ID."""
+        flat, indices = self._getFlatIndices(id, mask)
+        if indices is not None:
+            flat[indices] |= bitmask
+        else:
+            self._spans[id].setMask(mask, bitmask)
+
+    def clearMask(self, id, mask, bitmask):
+        """!Clear the given bits of the mask within the SpanSet of the given ID."""
+        flat, indices = self._getFlatIndices(id, mask)
+        if indices is not None:
+            flat[indices] &= ~bitmask
+        else:
+            self._spans[id].clearMask(mask, bitmask)
+
+    def close(self):
+        """!Release the buffers, deleting their temporary files if they have them."""
+        self._buffer = None
+        self._indices = None
+        for file in self._files:
+            file.close()
+        self._files = []
+
+
+class CutoutNoiseReplacer:
+    """!
+    Inserts and removes sources in a cutout of an exposure whose sources have been replaced by a
+    NoiseReplacer; see NoiseReplacer.makeCutoutReplacer().
+    """
+
+    def __init__(self, noiseReplacer, cutout):
+        self.noiseReplacer = noiseReplacer
+        self.exposure = cutout
+
+    def insertSource(self, id):
+        self.noiseReplacer._insertSource(id, self.exposure.getMaskedImage())
+
+    def removeSource(self, id):
+        self.noiseReplacer._removeSource(id, self.exposure.getMaskedImage())
+
+    def end(self):
+        pass
 
 
 class NoiseReplacerList(list):
     """Syntactic sugar that makes a list of NoiseReplacers (for multiple exposures)
     behave like a single one.
 
-    This is only used in the multifit driver, but the logic there is already pretty
-    complex, so it's nice to have this to simplify it.
+    One NoiseReplacer is made for each exposure, seeded with that exposure's ID.  Each source is
+    only inserted into and removed from the exposures it lands on, so the caller traverses the
+    families of the union of their sources once rather than once per exposure.  The whole-image
+    work (construction, suspend(), resume() and end()) can be spread over a pool of threads; the
+    insertion and removal of single sources is done in the calling thread, as it touches too few
+    pixels for dispatching it to the pool to pay off.
     """
 
-    def __init__(self, exposuresById, footprintsByExp):
-        # exposuresById --- dict of {exposureId: exposure} (possibly subimages)
-        # footprintsByExp --- nested dict of {exposureId: {objId: (parent, footprint)}}
+    def __init__(self, config, exposuresById, footprintsByExp, log=None, maintainMaskPlanes=True,
+                 numThreads=1):
+        """!
+        @param[in]      config           instance of NoiseReplacerConfig, used for every exposure
+        @param[in,out]  exposuresById    dict of {exposureId: exposure} (possibly subimages);
+                                         all sources are replaced with noise on return
+        @param[in]      footprintsByExp  nested dict of {exposureId: {objId: (parent, footprint)}};
+                                         each exposure's dict only contains the sources that land on it
+        @param[in]      log              Log object to use for status messages, or None
+        @param[in]      maintainMaskPlanes  passed to each NoiseReplacer
+        @param[in]      numThreads       number of threads over which to spread the whole-image work;
+                                         if more than one, the exposures must not share any pixels
+        """
         list.__init__(self)
-        for expId, exposure in exposuresById.items():
-            self.append(NoiseReplacer(exposure, footprintsByExp[expId]), expId)
+        self.exposureIds = list(exposuresById.keys())
+        self._executor = None
+        if numThreads > 1 and len(self.exposureIds) > 1:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(numThreads, len(self.exposureIds)))
+
+        def makeReplacer(expId):
+            return NoiseReplacer(config, exposuresById[expId], footprintsByExp[expId], exposureId=expId,
+                                 log=log, maintainMaskPlanes=maintainMaskPlanes)
+        self.extend(self._map(makeReplacer, self.exposureIds))
+
+        # Map each source to the replacers of the exposures it lands on
+        self._replacersBySource = {}
+        for expId, replacer in zip(self.exposureIds, self):
+            for objId in footprintsByExp[expId]:
+                self._replacersBySource.setdefault(objId, []).append(replacer)
+
+    def _map(self, function, items):
+        """Call function on each of items, in the thread pool if there is one, and return the results."""
+        items = list(items)
+        if self._executor is None or len(items) < 2:
+            return [function(item) for item in items]
+        return list(self._executor.map(function, items))
+
+    def getExposureIds(self, id):
+        """!Return the IDs of the exposures a source (by id) lands on."""
+        return [expId for expId, replacer in zip(self.exposureIds, self)
+                if replacer in self._replacersBySource.get(id, ())]
 
     def insertSource(self, id):
-        """Insert the original pixels for a given source (by id) into the original exposure.
+        """Insert the original pixels for a given source (by id) into every exposure it lands on.
         """
-        for item in self:
-            self.insertSource(id)
+        for replacer in self._replacersBySource.get(id, ()):
+            replacer.insertSource(id)
 
     def removeSource(self, id):
-        """Insert the noise pixels for a given source (by id) into the original exposure.
+        """Insert the noise pixels for a given source (by id) into every exposure it lands on.
+        """
+        for replacer in self._replacersBySource.get(id, ()):
+            replacer.removeSource(id)
+
+    def suspend(self):
+        """Temporarily restore the original pixels of all the exposures (see NoiseReplacer.suspend).
+        """
+        self._map(lambda replacer: replacer.suspend(), self)
+
+    def resume(self):
+        """Replace all sources with noise again after suspend().
         """
-        for item in self:
-            self.removeSource(id)
+        self._map(lambda replacer: replacer.resume(), self)
 
     def end(self):
         """Cleanup when the use of the Noise replacer is done.
         """
-        for item in self:
-            self.end()
+        self._map(lambda replacer: replacer.end(), self)
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
 
 
 class NoiseGenerator:
@@ -373,6 +837,20 @@ class NoiseGenerator:
     def getImage(self, bb):
         return None
 
+    def setSeed(self, seed):
+        """!Restart the generator's random number sequence from the given seed (if it has one)."""
+        pass
+
+    def getSourcePixels(self, fp, key):
+        """!
+        Return the flattened noise pixels for a Footprint as a pure function of the given key
+
+        @param[in]  fp    Footprint for which to generate noise.
+        @param[in]  key   (seed, source ID) pair identifying the random numbers to use; ignored by
+                          generators that do not draw random numbers.
+        """
+        return self.getHeavyFootprint(fp).getImageArray()
+
 
 class ImageNoiseGenerator(NoiseGenerator):
     """
@@ -402,12 +880,53 @@ class GaussianNoiseGenerator(NoiseGenerator):
         if rand is None:
             rand = afwMath.Random()
         self.rand = rand
+        self.bank = None
+
+    def setSeed(self, seed):
+        self.rand = afwMath.Random(self.rand.getAlgorithm(), seed)
+
+    def makeNoiseBank(self, size):
+        """!
+        Draw a size x size tile of unit Gaussian deviates from the generator's current random number
+        sequence, from which all later noise is taken (by pixel coordinates modulo size) instead of
+        drawing new random numbers.
+        """
+        tile = afwImage.ImageF(size, size)
+        afwMath.randomGaussianImage(tile, self.rand)
+        self.bank = tile.getArray().copy()
+
+    def getSourcePixels(self, fp, key):
+        if self.bank is not None:
+            # The noise bank is addressed by pixel coordinates, which are already independent of order
+            size = self.bank.shape[0]
+            ys, xs = fp.spans.indices()
+            deviates = self.bank[ys % size, xs % size]
+        else:
+            # The Philox key is the (seed, source ID) pair and the counter starts at zero, so the
+            # random numbers drawn for a source do not depend on those drawn for any other.
+            mask = 0xFFFFFFFFFFFFFFFF
+            bitGenerator = np.random.Philox(key=np.array([key[0] & mask, key[1] & mask], dtype=np.uint64))
+            deviates = np.random.Generator(bitGenerator).standard_normal(fp.getArea())
+        return self.scaleDeviates(fp.spans, deviates).astype(np.float32)
+
+    def scaleDeviates(self, spans, deviates):
+        """!
+        Turn unit Gaussian deviates for the pixels of a SpanSet (in the order of SpanSet.flatten())
+        into noise pixels.
+        """
+        raise NotImplementedError("GaussianNoiseGenerator is an abstract base class")
 
     def getRandomImage(self, bb):
         # Create an Image and fill it with Gaussian noise.
         rim = afwImage.ImageF(bb.getWidth(), bb.getHeight())
         rim.setXY0(bb.getMinX(), bb.getMinY())
-        afwMath.randomGaussianImage(rim, self.rand)
+        if self.bank is not None:
+            size = self.bank.shape[0]
+            ys = np.arange(bb.getMinY(), bb.getMaxY() + 1) % size
+            xs = np.arange(bb.getMinX(), bb.getMaxX() + 1) % size
+            rim.getArray()[:, :] = self.bank[np.ix_(ys, xs)]
+        else:
+            afwMath.randomGaussianImage(rim, self.rand)
         return rim
 
 
@@ -430,10 +949,16 @@ class FixedGaussianNoiseGenerator(GaussianNoiseGenerator):
         rim += self.mean
         return rim
 
+    def scaleDeviates(self, spans, deviates):
+        return deviates*self.std + self.mean
+
 
 class VariancePlaneNoiseGenerator(GaussianNoiseGenerator):
     """!
     Generates Gaussian noise whose variance matches that of the variance plane of the image.
+
+    The square root of the whole variance plane is computed once, the first time it is needed;
+    the noise for each bounding box is then scaled by a view into that image.
     """
 
     def __init__(self, var, mean=None, rand=None):
@@ -443,6 +968,7 @@ class VariancePlaneNoiseGenerator(GaussianNoiseGenerator):
         """
         super(VariancePlaneNoiseGenerator, self).__init__(rand=rand)
         self.var = var
+        self._stdev = None
         if mean is not None and mean == 0.:
             mean = None
         self.mean = mean
@@ -450,16 +976,31 @@ class VariancePlaneNoiseGenerator(GaussianNoiseGenerator):
     def __str__(self):
         return 'VariancePlaneNoiseGenerator: mean=' + str(self.mean)
 
+    def getStdev(self):
+        """!Return the square root of the variance plane, computing it on the first call."""
+        if self._stdev is None:
+            self._stdev = afwImage.ImageF(self.var, True)
+            self._stdev.sqrt()
+        return self._stdev
+
     def getImage(self, bb):
         rim = self.getRandomImage(bb)
         # Use the image's variance plane to scale the noise.
-        stdev = afwImage.ImageF(self.var, bb, afwImage.LOCAL, True)
-        stdev.sqrt()
+        stdev = afwImage.ImageF(self.getStdev(), bb, afwImage.PARENT, False)
         rim *= stdev
         if self.mean is not None:
             rim += self.mean
         return rim
 
+    def scaleDeviates(self, spans, deviates):
+        stdevImage = self.getStdev()
+        stdev = np.zeros(spans.getArea(), dtype=stdevImage.getArray().dtype)
+        spans.flatten(stdev, stdevImage.getArray(), stdevImage.getXY0())
+        pixels = deviates*stdev
+        if self.mean is not None:
+            pixels += self.mean
+        return pixels
+
 
 class DummyNoiseReplacer:
     """!
@@ -474,5 +1015,14 @@ class DummyNoiseReplacer:
     def removeSource(self, id):
         pass
 
+    def makeCutoutReplacer(self, cutout):
+        return self
+
+    def suspend(self):
+        pass
+
+    def resume(self):
+        pass
+
     def end(self):
         pass
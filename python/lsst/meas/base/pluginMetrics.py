@@ -0,0 +1,175 @@
+#
+# LSST Data Management System
+# Copyright 2008-2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+"""Timing and failure statistics for measurement and catalog calculation plugins.
+"""
+import contextlib
+import functools
+import heapq
+import time
+
+from .exceptions import FatalAlgorithmError, MeasurementError
+
+__all__ = ("PluginMetrics",)
+
+
+class PluginMetrics:
+    """!
+    Accumulate the wall-clock and CPU time, number of calls and number of failures of one plugin.
+
+    Calls that process a single source and batch calls that process many at once (e.g. measureMany())
+    are counted separately, as nCalls and nBatchCalls.  Only single-source calls are candidates for the
+    slowest calls, since the time of a batch call cannot be attributed to any one of its sources.
+
+    The measurement tasks create one of these per plugin when their doPluginMetrics config option is
+    set, and route every call to the plugin through wrap() or timing().  The statistics are written to
+    the task metadata by writeMetadata() at the end of each run.
+
+    Exceptions are only counted, never caught: the caller remains responsible for handling them.
+    Failures that a plugin handles itself (e.g. within a C++ measureMany() loop) are not seen.
+    """
+
+    def __init__(self, name, nSlowest=5):
+        """!
+        @param[in]  name      Name of the plugin.
+        @param[in]  nSlowest  Number of slowest calls for which to remember the source ID.
+        """
+        self.name = name
+        self.nSlowest = nSlowest
+        self.reset()
+
+    def reset(self):
+        """!Discard all statistics accumulated so far."""
+        self.nCalls = 0
+        self.nBatchCalls = 0
+        self.nMeasurementErrors = 0
+        self.nExceptions = 0
+        self.wallTime = 0.0
+        self.cpuTime = 0.0
+        self._slowest = []  # min-heap of (wallTime, sourceId)
+
+    def getSlowest(self):
+        """!Return (wallTime, sourceId) pairs for the slowest calls, slowest first."""
+        return sorted(self._slowest, reverse=True)
+
+    @staticmethod
+    def _getSourceId(target):
+        """Return the ID of a SourceRecord, or of the first record of a catalog (None if empty)."""
+        if hasattr(target, "getId"):
+            return target.getId()
+        for record in target:
+            return record.getId()
+        return None
+
+    def _isSlow(self, wallTime):
+        """Return whether a call taking wallTime would be among the slowest remembered."""
+        return self.nSlowest > 0 and (len(self._slowest) < self.nSlowest or wallTime > self._slowest[0][0])
+
+    def _pushSlowest(self, wallTime, sourceId):
+        if len(self._slowest) < self.nSlowest:
+            heapq.heappush(self._slowest, (wallTime, sourceId))
+        else:
+            heapq.heapreplace(self._slowest, (wallTime, sourceId))
+
+    def _record(self, target, wallTime, cpuTime, batch):
+        self.wallTime += wallTime
+        self.cpuTime += cpuTime
+        if batch:
+            self.nBatchCalls += 1
+        else:
+            self.nCalls += 1
+        if not batch and self._isSlow(wallTime):
+            sourceId = self._getSourceId(target)
+            if sourceId is not None:
+                self._pushSlowest(wallTime, sourceId)
+
+    def merge(self, other):
+        """!
+        Add the statistics accumulated by another PluginMetrics (e.g. in a worker process) to these.
+        """
+        self.nCalls += other.nCalls
+        self.nBatchCalls += other.nBatchCalls
+        self.nMeasurementErrors += other.nMeasurementErrors
+        self.nExceptions += other.nExceptions
+        self.wallTime += other.wallTime
+        self.cpuTime += other.cpuTime
+        for wallTime, sourceId in other._slowest:
+            if self._isSlow(wallTime):
+                self._pushSlowest(wallTime, sourceId)
+
+    @contextlib.contextmanager
+    def timing(self, target, batch=False):
+        """!
+        Context manager that times and counts one call to the plugin.
+
+        @param[in]  target   The SourceRecord or catalog being processed; used to record the source ID
+                             of the slowest calls.
+        @param[in]  batch    If True, the call processes all the sources in target at once, and is
+                             counted in nBatchCalls rather than nCalls and never recorded as one of
+                             the slowest calls.
+        """
+        wallStart = time.perf_counter()
+        cpuStart = time.process_time()
+        try:
+            yield
+        except (MemoryError, FatalAlgorithmError):
+            raise
+        except MeasurementError:
+            self.nMeasurementErrors += 1
+            raise
+        except Exception:
+            self.nExceptions += 1
+            raise
+        finally:
+            self._record(target, time.perf_counter() - wallStart, time.process_time() - cpuStart, batch)
+
+    def wrap(self, function, batch=False):
+        """!
+        Return a version of function(target, ...) that is timed and counted by this object.
+
+        @param[in]  batch    Whether function processes many sources at once (see timing()).
+        """
+        @functools.wraps(function)
+        def timedFunction(target, *args, **kwds):
+            with self.timing(target, batch=batch):
+                return function(target, *args, **kwds)
+        return timedFunction
+
+    def writeMetadata(self, metadata, prefix="pluginMetrics"):
+        """!
+        Write the statistics to a PropertySet or PropertyList.
+
+        Entries are named "<prefix>.<plugin name>.<statistic>"; the slowest source IDs (slowest first)
+        are written as an array entry named "slowestIds", with their times in "slowestWallTimes".
+        """
+        base = "%s.%s." % (prefix, self.name)
+        for name in ("slowestIds", "slowestWallTimes"):
+            if metadata.exists(base + name):
+                metadata.remove(base + name)
+        metadata.set(base + "nCalls", self.nCalls)
+        metadata.set(base + "nBatchCalls", self.nBatchCalls)
+        metadata.set(base + "nMeasurementErrors", self.nMeasurementErrors)
+        metadata.set(base + "nExceptions", self.nExceptions)
+        metadata.set(base + "wallTime", self.wallTime)
+        metadata.set(base + "cpuTime", self.cpuTime)
+        for wallTime, sourceId in self.getSlowest():
+            metadata.addLong(base + "slowestIds", sourceId)
+            metadata.add(base + "slowestWallTimes", wallTime)
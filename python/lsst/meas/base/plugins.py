@@ -34,7 +34,7 @@ import lsst.afw.geom
 
 from .pluginRegistry import register
 from .pluginsBase import BasePlugin
-from .baseMeasurement import BaseMeasurementPluginConfig
+from .baseMeasurement import BaseMeasurementPluginConfig, FATAL_EXCEPTIONS
 from .sfm import SingleFramePluginConfig, SingleFramePlugin
 from .forcedMeasurement import ForcedPluginConfig, ForcedPlugin
 from .wrappers import wrapSimpleAlgorithm, wrapTransform, GenericPlugin
@@ -71,32 +71,73 @@ __all__ = (
 
 # --- Wrapped C++ Plugins ---
 
+# How far beyond a source's Footprint each algorithm reads pixels, for measurement in cutouts (see
+# BaseMeasurementPlugin.getCutoutPadding()); the task already pads cutouts by the PSF size.  SdssShape,
+# GaussianFlux and Blendedness declare no padding: their adaptive weight function is truncated at four
+# times the sigma of the source's own moments, which may be hundreds of pixels for an extended source,
+# so they are always measured on the full exposure.
+
+
+def _noCutoutPadding(config, exposure):
+    # Reads pixels within the Footprint, or within a region around the centroid no larger than the
+    # PSF model image.
+    return 0
+
+
+def _getPsfSigma(exposure):
+    return exposure.getPsf().computeShape().getDeterminantRadius() if exposure.hasPsf() else 0.0
+
+
+def _getCircularApertureFluxPadding(config, exposure):
+    return int(np.ceil(max(config.radii))) if config.radii else 0
+
+
+def _getScaledApertureFluxPadding(config, exposure):
+    # The aperture radius is config.scale times the PSF FWHM
+    return int(np.ceil(config.scale*2.0*np.sqrt(2.0*np.log(2.0))*_getPsfSigma(exposure)))
+
+
+def _getLocalBackgroundPadding(config, exposure):
+    # The annulus radii are multiples of the PSF sigma
+    return int(np.ceil(config.annulusOuter*_getPsfSigma(exposure)))
+
+
 wrapSimpleAlgorithm(PsfFluxAlgorithm, Control=PsfFluxControl,
                     TransformClass=PsfFluxTransform, executionOrder=BasePlugin.FLUX_ORDER,
-                    shouldApCorr=True, hasLogName=True)
+                    shouldApCorr=True, hasLogName=True, usesNoiseReplacerMaskPlanes=False,
+                    cutoutPadding=_noCutoutPadding)
 wrapSimpleAlgorithm(PeakLikelihoodFluxAlgorithm, Control=PeakLikelihoodFluxControl,
-                    TransformClass=PeakLikelihoodFluxTransform, executionOrder=BasePlugin.FLUX_ORDER)
+                    TransformClass=PeakLikelihoodFluxTransform, executionOrder=BasePlugin.FLUX_ORDER,
+                    usesNoiseReplacerMaskPlanes=False, cutoutPadding=_noCutoutPadding)
 wrapSimpleAlgorithm(GaussianFluxAlgorithm, Control=GaussianFluxControl,
                     TransformClass=GaussianFluxTransform, executionOrder=BasePlugin.FLUX_ORDER,
-                    shouldApCorr=True)
+                    shouldApCorr=True, usesNoiseReplacerMaskPlanes=False)
 wrapSimpleAlgorithm(NaiveCentroidAlgorithm, Control=NaiveCentroidControl,
-                    TransformClass=NaiveCentroidTransform, executionOrder=BasePlugin.CENTROID_ORDER)
+                    TransformClass=NaiveCentroidTransform, executionOrder=BasePlugin.CENTROID_ORDER,
+                    usesNoiseReplacerMaskPlanes=False, cutoutPadding=_noCutoutPadding)
 wrapSimpleAlgorithm(SdssCentroidAlgorithm, Control=SdssCentroidControl,
-                    TransformClass=SdssCentroidTransform, executionOrder=BasePlugin.CENTROID_ORDER)
+                    TransformClass=SdssCentroidTransform, executionOrder=BasePlugin.CENTROID_ORDER,
+                    usesNoiseReplacerMaskPlanes=False, cutoutPadding=_noCutoutPadding)
 wrapSimpleAlgorithm(PixelFlagsAlgorithm, Control=PixelFlagsControl,
-                    executionOrder=BasePlugin.FLUX_ORDER)
+                    executionOrder=BasePlugin.FLUX_ORDER, usesNoiseReplacerMaskPlanes=False,
+                    cutoutPadding=_noCutoutPadding)
 wrapSimpleAlgorithm(SdssShapeAlgorithm, Control=SdssShapeControl,
-                    TransformClass=SdssShapeTransform, executionOrder=BasePlugin.SHAPE_ORDER)
+                    TransformClass=SdssShapeTransform, executionOrder=BasePlugin.SHAPE_ORDER,
+                    usesNoiseReplacerMaskPlanes=False)
 wrapSimpleAlgorithm(ScaledApertureFluxAlgorithm, Control=ScaledApertureFluxControl,
-                    TransformClass=ScaledApertureFluxTransform, executionOrder=BasePlugin.FLUX_ORDER)
+                    TransformClass=ScaledApertureFluxTransform, executionOrder=BasePlugin.FLUX_ORDER,
+                    usesNoiseReplacerMaskPlanes=False, cutoutPadding=_getScaledApertureFluxPadding)
 
 wrapSimpleAlgorithm(CircularApertureFluxAlgorithm, needsMetadata=True, Control=ApertureFluxControl,
-                    TransformClass=ApertureFluxTransform, executionOrder=BasePlugin.FLUX_ORDER)
+                    TransformClass=ApertureFluxTransform, executionOrder=BasePlugin.FLUX_ORDER,
+                    usesNoiseReplacerMaskPlanes=False, cutoutPadding=_getCircularApertureFluxPadding)
 wrapSimpleAlgorithm(BlendednessAlgorithm, Control=BlendednessControl,
-                    TransformClass=BaseTransform, executionOrder=BasePlugin.SHAPE_ORDER)
+                    TransformClass=BaseTransform, executionOrder=BasePlugin.SHAPE_ORDER,
+                    usesNoiseReplacerMaskPlanes=False)
 
 wrapSimpleAlgorithm(LocalBackgroundAlgorithm, Control=LocalBackgroundControl,
-                    TransformClass=LocalBackgroundTransform, executionOrder=BasePlugin.FLUX_ORDER)
+                    TransformClass=LocalBackgroundTransform, executionOrder=BasePlugin.FLUX_ORDER,
+                    usesNoiseReplacerMaskPlanes=False, cutoutPadding=_getLocalBackgroundPadding)
 
 wrapTransform(PsfFluxTransform)
 wrapTransform(PeakLikelihoodFluxTransform)
@@ -108,6 +149,51 @@ wrapTransform(ScaledApertureFluxTransform)
 wrapTransform(ApertureFluxTransform)
 wrapTransform(LocalBackgroundTransform)
 
+
+def _measureEach(plugin, measArgs):
+    """Call plugin.measure(*args) for each args tuple in measArgs, calling plugin.fail() on the record
+    (the first argument) for any ordinary exception, as BaseMeasurementTask.doMeasurement does.
+
+    This is the fallback used by the measureMany() implementations below for records that cannot be
+    handled in bulk.
+    """
+    for args in measArgs:
+        try:
+            plugin.measure(*args)
+        except FATAL_EXCEPTIONS:
+            raise
+        except MeasurementError as error:
+            plugin.fail(args[0], error)
+        except Exception:
+            plugin.fail(args[0])
+
+
+def _getBulkRefCentroids(measCat, refCat):
+    """Return the slot centroid columns of refCat and a mask of the rows that can be processed in bulk,
+    or (None, None, None) if either catalog is not contiguous in memory or their lengths differ.
+    """
+    if len(measCat) != len(refCat) or not measCat.isContiguous():
+        return None, None, None
+    return _getBulkCentroids(refCat)
+
+
+def _measureEachForced(plugin, measCat, exposure, refCat, refWcs):
+    """Fallback for the forced measureMany() implementations: measure each record in turn."""
+    _measureEach(plugin, ((measRecord, exposure, refRecord, refWcs)
+                          for measRecord, refRecord in zip(measCat, refCat)))
+
+
+def _getBulkCentroids(measCat):
+    """Return the slot centroid columns of measCat and a mask of the rows that can be processed in bulk,
+    or (None, None, None) if measCat is not contiguous in memory.
+    """
+    if not measCat.isContiguous():
+        return None, None, None
+    x = measCat.getX()
+    y = measCat.getY()
+    return x, y, np.isfinite(x) & np.isfinite(y)
+
+
 # --- Single-Frame Measurement Plugins ---
 
 
@@ -122,11 +208,18 @@ class SingleFrameFPPositionPlugin(SingleFramePlugin):
     '''
 
     ConfigClass = SingleFrameFPPositionConfig
+    needsIsolatedPixels = False
+    usesNoiseReplacerMaskPlanes = False
+    hasMeasureMany = True
 
     @classmethod
     def getExecutionOrder(cls):
         return cls.SHAPE_ORDER
 
+    def getCutoutPadding(self, exposure):
+        # Only transforms the centroid; reads no pixels
+        return 0
+
     def __init__(self, config, name, schema, metadata):
         SingleFramePlugin.__init__(self, config, name, schema, metadata)
         self.focalValue = lsst.afw.table.Point2DKey.addFields(schema, name, "Position on the focal plane",
@@ -145,6 +238,18 @@ class SingleFrameFPPositionPlugin(SingleFramePlugin):
             fp = det.transform(center, lsst.afw.cameraGeom.PIXELS, lsst.afw.cameraGeom.FOCAL_PLANE)
         measRecord.set(self.focalValue, fp)
 
+    def measureMany(self, measCat, exposure):
+        x, y, good = _getBulkCentroids(measCat)
+        det = exposure.getDetector()
+        if x is None or not det:
+            _measureEach(self, ((measRecord, exposure) for measRecord in measCat))
+            return
+        mapping = det.getTransform(lsst.afw.cameraGeom.PIXELS, lsst.afw.cameraGeom.FOCAL_PLANE).getMapping()
+        fpX, fpY = mapping.applyForward(np.array([x[good], y[good]]))
+        measCat[self.focalValue.getX()][good] = fpX
+        measCat[self.focalValue.getY()][good] = fpY
+        _measureEach(self, ((measRecord, exposure) for measRecord in measCat[~good]))
+
     def fail(self, measRecord, error=None):
         measRecord.set(self.focalFlag, True)
 
@@ -161,11 +266,18 @@ class SingleFrameJacobianPlugin(SingleFramePlugin):
     '''
 
     ConfigClass = SingleFrameJacobianConfig
+    needsIsolatedPixels = False
+    usesNoiseReplacerMaskPlanes = False
+    hasMeasureMany = True
 
     @classmethod
     def getExecutionOrder(cls):
         return cls.SHAPE_ORDER
 
+    def getCutoutPadding(self, exposure):
+        # Only evaluates the Wcs at the centroid; reads no pixels
+        return 0
+
     def __init__(self, config, name, schema, metadata):
         SingleFramePlugin.__init__(self, config, name, schema, metadata)
         self.jacValue = schema.addField(name + '_value', type="D", doc="Jacobian correction")
@@ -182,6 +294,34 @@ class SingleFrameJacobianPlugin(SingleFramePlugin):
             lsst.geom.arcseconds).getLinear().computeDeterminant())
         measRecord.set(self.jacValue, result)
 
+    def measureMany(self, measCat, exposure):
+        # Differentiate the WCS numerically with a single batched evaluation at the points a pixel
+        # on either side of each centroid; for any real WCS this agrees with linearizePixelToSky to
+        # well below the precision of the result.
+        x, y, good = _getBulkCentroids(measCat)
+        wcs = exposure.getWcs()
+        if x is None or wcs is None:
+            _measureEach(self, ((measRecord, exposure) for measRecord in measCat))
+            return
+        x = x[good]
+        y = y[good]
+        n = len(x)
+        offsets = np.array([[1.0, 0.0], [-1.0, 0.0], [0.0, 1.0], [0.0, -1.0]])
+        ra, dec = wcs.pixelToSkyArray(np.concatenate([x + dx for dx, _ in offsets]),
+                                      np.concatenate([y + dy for _, dy in offsets]))
+        ra = ra.reshape(4, n)
+        dec = dec.reshape(4, n)
+        cosDec = np.cos(0.5*(dec[0] + dec[1]))
+        # Wrap RA differences into [-pi, pi) in case a source straddles RA=0.
+        dRa_dx = 0.5*cosDec*(np.remainder(ra[0] - ra[1] + np.pi, 2*np.pi) - np.pi)
+        dRa_dy = 0.5*cosDec*(np.remainder(ra[2] - ra[3] + np.pi, 2*np.pi) - np.pi)
+        dDec_dx = 0.5*(dec[0] - dec[1])
+        dDec_dy = 0.5*(dec[2] - dec[3])
+        radToArcsec = (1.0*lsst.geom.radians).asArcseconds()
+        area = np.abs(dRa_dx*dDec_dy - dRa_dy*dDec_dx)*radToArcsec**2
+        measCat[self.jacValue][good] = self.scale*area
+        _measureEach(self, ((measRecord, exposure) for measRecord in measCat[~good]))
+
     def fail(self, measRecord, error=None):
         measRecord.set(self.jacFlag, True)
 
@@ -202,11 +342,19 @@ class VariancePlugin(GenericPlugin):
     ConfigClass = VarianceConfig
     FAILURE_BAD_CENTROID = 1
     FAILURE_EMPTY_FOOTPRINT = 2
+    # Only the variance and mask planes are read, and the NoiseReplacer modifies neither (apart from
+    # its own temporary mask planes), so the aperture may extend well beyond the Footprint.
+    needsIsolatedPixels = False
+    usesNoiseReplacerMaskPlanes = False
 
     @classmethod
     def getExecutionOrder(cls):
         return BasePlugin.FLUX_ORDER
 
+    def getCutoutPadding(self, exposure):
+        # The aperture is scaled from the source's shape, so it has no fixed bound
+        return None
+
     def __init__(self, config, name, schema, metadata):
         GenericPlugin.__init__(self, config, name, schema, metadata)
         self.varValue = schema.addField(name + '_value', type="D", doc="Variance at object position")
@@ -272,6 +420,8 @@ class InputCountPlugin(GenericPlugin):
     """
 
     ConfigClass = InputCountConfig
+    needsIsolatedPixels = False
+    usesNoiseReplacerMaskPlanes = False
     FAILURE_BAD_CENTROID = 1
     FAILURE_NO_INPUTS = 2
 
@@ -279,6 +429,10 @@ class InputCountPlugin(GenericPlugin):
     def getExecutionOrder(cls):
         return BasePlugin.SHAPE_ORDER
 
+    def getCutoutPadding(self, exposure):
+        # Only reads the coadd inputs; reads no pixels
+        return 0
+
     def __init__(self, config, name, schema, metadata):
         GenericPlugin.__init__(self, config, name, schema, metadata)
         self.numberKey = schema.addField(name + '_value', type="I",
@@ -325,11 +479,17 @@ class SingleFramePeakCentroidPlugin(SingleFramePlugin):
     """
 
     ConfigClass = SingleFramePeakCentroidConfig
+    needsIsolatedPixels = False
+    usesNoiseReplacerMaskPlanes = False
 
     @classmethod
     def getExecutionOrder(cls):
         return cls.CENTROID_ORDER
 
+    def getCutoutPadding(self, exposure):
+        # Only reads the Footprint's peaks; reads no pixels
+        return 0
+
     def __init__(self, config, name, schema, metadata):
         SingleFramePlugin.__init__(self, config, name, schema, metadata)
         self.keyX = schema.addField(name + "_x", type="D", doc="peak centroid", units="pixel")
@@ -361,11 +521,18 @@ class SingleFrameSkyCoordPlugin(SingleFramePlugin):
     """
 
     ConfigClass = SingleFrameSkyCoordConfig
+    needsIsolatedPixels = False
+    usesNoiseReplacerMaskPlanes = False
+    hasMeasureMany = True
 
     @classmethod
     def getExecutionOrder(cls):
         return cls.SHAPE_ORDER
 
+    def getCutoutPadding(self, exposure):
+        # Only transforms the centroid; reads no pixels
+        return 0
+
     def measure(self, measRecord, exposure):
         # there should be a base class method for handling this exception. Put this on a later ticket
         # Also, there should be a python Exception of the appropriate type for this error
@@ -373,6 +540,17 @@ class SingleFrameSkyCoordPlugin(SingleFramePlugin):
             raise Exception("Wcs not attached to exposure.  Required for " + self.name + " algorithm")
         measRecord.updateCoord(exposure.getWcs())
 
+    def measureMany(self, measCat, exposure):
+        x, y, good = _getBulkCentroids(measCat)
+        if x is None or not exposure.hasWcs():
+            _measureEach(self, ((measRecord, exposure) for measRecord in measCat))
+            return
+        ra, dec = exposure.getWcs().pixelToSkyArray(x[good], y[good])
+        coordKey = measCat.getTable().getCoordKey()
+        measCat[coordKey.getRa()][good] = ra
+        measCat[coordKey.getDec()][good] = dec
+        _measureEach(self, ((measRecord, exposure) for measRecord in measCat[~good]))
+
     def fail(self, measRecord, error=None):
         # Override fail() to do nothing in the case of an exception: this is not ideal,
         # but we don't have a place to put failures because we don't allocate any fields.
@@ -395,6 +573,8 @@ class ForcedPeakCentroidPlugin(ForcedPlugin):
     """
 
     ConfigClass = ForcedPeakCentroidConfig
+    needsIsolatedPixels = False
+    usesNoiseReplacerMaskPlanes = False
 
     @classmethod
     def getExecutionOrder(cls):
@@ -432,6 +612,9 @@ class ForcedTransformedCentroidPlugin(ForcedPlugin):
     """
 
     ConfigClass = ForcedTransformedCentroidConfig
+    needsIsolatedPixels = False
+    usesNoiseReplacerMaskPlanes = False
+    hasMeasureMany = True
 
     @classmethod
     def getExecutionOrder(cls):
@@ -465,6 +648,25 @@ class ForcedTransformedCentroidPlugin(ForcedPlugin):
         if self.flagKey is not None:
             measRecord.set(self.flagKey, refRecord.getCentroidFlag())
 
+    def measureMany(self, measCat, exposure, refCat, refWcs):
+        refX, refY, good = _getBulkRefCentroids(measCat, refCat)
+        if refX is None:
+            _measureEachForced(self, measCat, exposure, refCat, refWcs)
+            return
+        targetWcs = exposure.getWcs()
+        if refWcs == targetWcs:
+            # Coadd forced photometry measures on the reference image itself: just copy the columns.
+            x, y = refX[good], refY[good]
+        else:
+            pairTransform = lsst.afw.geom.makeWcsPairTransform(refWcs, targetWcs)
+            x, y = pairTransform.getMapping().applyForward(np.array([refX[good], refY[good]]))
+        measCat[self.centroidKey.getX()][good] = x
+        measCat[self.centroidKey.getY()][good] = y
+        if self.flagKey is not None:
+            for measRecord, refFlag in zip(measCat[good], refCat["slot_Centroid_flag"][good]):
+                measRecord.set(self.flagKey, bool(refFlag))
+        _measureEachForced(self, measCat[~good], exposure, refCat[~good], refWcs)
+
 
 class ForcedTransformedShapeConfig(ForcedPluginConfig):
     pass
@@ -479,6 +681,9 @@ class ForcedTransformedShapePlugin(ForcedPlugin):
     """
 
     ConfigClass = ForcedTransformedShapeConfig
+    needsIsolatedPixels = False
+    usesNoiseReplacerMaskPlanes = False
+    hasMeasureMany = True
 
     @classmethod
     def getExecutionOrder(cls):
@@ -514,3 +719,37 @@ class ForcedTransformedShapePlugin(ForcedPlugin):
             measRecord.set(self.shapeKey, refRecord.getShape())
         if self.flagKey is not None:
             measRecord.set(self.flagKey, refRecord.getShapeFlag())
+
+    def measureMany(self, measCat, exposure, refCat, refWcs):
+        refX, refY, good = _getBulkRefCentroids(measCat, refCat)
+        if refX is None:
+            _measureEachForced(self, measCat, exposure, refCat, refWcs)
+            return
+        ixx = refCat.getIxx()[good]
+        iyy = refCat.getIyy()[good]
+        ixy = refCat.getIxy()[good]
+        targetWcs = exposure.getWcs()
+        if not refWcs == targetWcs:
+            # Linearize the transform at every reference centroid at once, by central differences
+            # from a single batched evaluation of the transform one pixel either side of each.
+            mapping = lsst.afw.geom.makeWcsPairTransform(refWcs, targetWcs).getMapping()
+            x, y = refX[good], refY[good]
+            n = len(x)
+            outX, outY = mapping.applyForward(np.array([np.concatenate([x + 1.0, x - 1.0, x, x]),
+                                                        np.concatenate([y, y, y + 1.0, y - 1.0])]))
+            outX = outX.reshape(4, n)
+            outY = outY.reshape(4, n)
+            j00 = 0.5*(outX[0] - outX[1])
+            j01 = 0.5*(outX[2] - outX[3])
+            j10 = 0.5*(outY[0] - outY[1])
+            j11 = 0.5*(outY[2] - outY[3])
+            ixx, iyy, ixy = (j00*j00*ixx + 2.0*j00*j01*ixy + j01*j01*iyy,
+                             j10*j10*ixx + 2.0*j10*j11*ixy + j11*j11*iyy,
+                             j00*j10*ixx + (j00*j11 + j01*j10)*ixy + j01*j11*iyy)
+        measCat[self.shapeKey.getIxx()][good] = ixx
+        measCat[self.shapeKey.getIyy()][good] = iyy
+        measCat[self.shapeKey.getIxy()][good] = ixy
+        if self.flagKey is not None:
+            for measRecord, refFlag in zip(measCat[good], refCat["slot_Shape_flag"][good]):
+                measRecord.set(self.flagKey, bool(refFlag))
+        _measureEachForced(self, measCat[~good], exposure, refCat[~good], refWcs)
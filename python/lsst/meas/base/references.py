@@ -23,12 +23,261 @@
 """
 Subtasks for creating the reference catalogs used in forced measurement.
 """
+import collections
+import concurrent.futures
+import itertools
+import threading
+import weakref
+
+import numpy as np
 
 import lsst.geom
+import lsst.afw.table
 import lsst.pex.config
 import lsst.pipe.base
 
-__all__ = ("BaseReferencesTask", "CoaddSrcReferencesTask")
+__all__ = ("BaseReferencesTask", "CoaddSrcReferencesTask", "PatchCatalogCache", "SkyMapCache")
+
+_butlerKeys = weakref.WeakKeyDictionary()  # butler -> key assigned by _getButlerKey()
+_butlerKeyCounter = itertools.count(1)
+_butlerKeysLock = threading.Lock()
+_butlerKeyedCaches = weakref.WeakSet()
+
+
+def _getButlerKey(butler):
+    """Return an integer that identifies a butler (and so its data repository) in cache keys.
+
+    Unlike id(butler), a key is never reused for another butler, even after this one has been
+    garbage collected; at that point every _ButlerKeyedCache drops the entries cached under it.
+    """
+    with _butlerKeysLock:
+        key = _butlerKeys.get(butler)
+        if key is None:
+            key = next(_butlerKeyCounter)
+            _butlerKeys[butler] = key
+            weakref.finalize(butler, _forgetButlerKey, key)
+        return key
+
+
+def _forgetButlerKey(key):
+    # Finalizers may run while the same thread holds a cache's lock, so the caches are only told
+    # about the key here, and remove its entries the next time they are used.
+    for cache in list(_butlerKeyedCaches):
+        cache._deadButlerKeys.append(key)
+
+
+class _ButlerKeyedCache:
+    """Base class for the caches with keys that are tuples starting with a _getButlerKey() key, whose
+    entries are removed once the corresponding butler has been garbage collected."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._deadButlerKeys = []
+        _butlerKeyedCaches.add(self)
+
+    def _purgeDeadButlers(self):
+        """Remove the entries of garbage-collected butlers; must be called with the lock held."""
+        while self._deadButlerKeys:
+            self._removeButler(self._deadButlerKeys.pop())
+
+    def _removeButler(self, butlerKey):
+        raise NotImplementedError()
+
+    @staticmethod
+    def _hasButlerKey(key, butlerKey):
+        return isinstance(key, tuple) and len(key) > 0 and key[0] == butlerKey
+
+
+class SkyMapCache(_ButlerKeyedCache):
+    """!
+    A memo of the skymaps read by a process, and of the tracts and patches looked up in them.
+
+    Reading a skymap means unpickling it, which is expensive enough to dominate the per-image overhead
+    of forced photometry when it is repeated for every data reference.  The tasks that need a skymap
+    share the module-level instance skyMapCache, so each skymap dataset is read once per process and
+    data repository: skymaps are keyed by the butler they were read with as well as by dataset name
+    (e.g. "deepCoadd_skyMap"), and forgotten when that butler is garbage collected.
+    The returned objects are shared and must not be modified.
+    """
+
+    def __init__(self):
+        _ButlerKeyedCache.__init__(self)
+        self.clear()
+
+    def clear(self):
+        """!Forget all cached skymaps, tracts and patches."""
+        with self._lock:
+            self._skyMaps = {}
+            self._tracts = {}
+            self._patches = {}
+
+    @staticmethod
+    def _getKey(source, *args):
+        """Return the cache key for a butler or ButlerDataRef and the given additional key items."""
+        butlerSubset = getattr(source, "butlerSubset", None)
+        butler = butlerSubset.butler if butlerSubset is not None else source
+        return (_getButlerKey(butler),) + args
+
+    def getSkyMap(self, source, datasetName):
+        """!
+        Return a skymap, reading it if it has not been read before with the same butler.
+
+        @param[in] source       Butler or ButlerDataRef from which to read the skymap.
+        @param[in] datasetName  Name of the skymap dataset, e.g. coaddName + "Coadd_skyMap".
+        """
+        key = self._getKey(source, datasetName)
+        with self._lock:
+            self._purgeDeadButlers()
+            skyMap = self._skyMaps.get(key)
+            if skyMap is None:
+                skyMap = source.get(datasetName, immediate=True)
+                self._skyMaps[key] = skyMap
+            return skyMap
+
+    def getTractInfo(self, source, datasetName, tract):
+        """!Return the TractInfo of a tract (by ID) in a skymap; arguments are as for getSkyMap()."""
+        key = self._getKey(source, datasetName, tract)
+        tractInfo = self._tracts.get(key)
+        if tractInfo is None:
+            tractInfo = self.getSkyMap(source, datasetName)[tract]
+            self._tracts[key] = tractInfo
+        return tractInfo
+
+    def getWcs(self, source, datasetName, tract):
+        """!Return the WCS of a tract (by ID) in a skymap; arguments are as for getSkyMap()."""
+        return self.getTractInfo(source, datasetName, tract).getWcs()
+
+    def getPatchInfo(self, source, datasetName, tract, patch):
+        """!
+        Return the PatchInfo of a patch in a tract of a skymap.
+
+        @param[in] patch   Patch index, as a tuple of ints or a string like "1,2".
+        Other arguments are as for getTractInfo().
+        """
+        if isinstance(patch, str):
+            patch = tuple(int(v) for v in patch.split(","))
+        key = self._getKey(source, datasetName, tract, tuple(patch))
+        patchInfo = self._patches.get(key)
+        if patchInfo is None:
+            patchInfo = self.getTractInfo(source, datasetName, tract).getPatchInfo(patch)
+            self._patches[key] = patchInfo
+        return patchInfo
+
+    def _removeButler(self, butlerKey):
+        for entries in (self._skyMaps, self._tracts, self._patches):
+            for key in [key for key in entries if key[0] == butlerKey]:
+                del entries[key]
+
+
+skyMapCache = SkyMapCache()
+
+
+class PatchCatalogCache(_ButlerKeyedCache):
+    """!
+    A least-recently-used cache of reference catalogs, bounded by their estimated total size in bytes.
+
+    A single instance is shared by every CoaddSrcReferencesTask in a process (see
+    CoaddSrcReferencesTask.patchCache), so that the patch catalogs read for one data reference can
+    be reused for neighboring ones, even though the command-line task framework constructs a new
+    task for each data reference.  The records of cached catalogs are shared with the callers of
+    get(), and must not be modified.  Catalogs cached under a tuple key whose first element is a
+    _getButlerKey() key are removed when that butler is garbage collected.
+    """
+
+    def __init__(self, maxBytes=0):
+        """!
+        @param[in]  maxBytes   Maximum total estimated size of the cached catalogs; 0 disables caching.
+        """
+        _ButlerKeyedCache.__init__(self)
+        self._entries = collections.OrderedDict()  # key -> (catalog, nBytes), least recently used first
+        self.nBytes = 0
+        self.nHits = 0
+        self.nMisses = 0
+        self.maxBytes = maxBytes
+
+    def __len__(self):
+        with self._lock:
+            self._purgeDeadButlers()
+            return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def setMaxBytes(self, maxBytes):
+        """!Set the maximum total size of the cached catalogs, evicting catalogs if necessary."""
+        with self._lock:
+            self._purgeDeadButlers()
+            self.maxBytes = maxBytes
+            self._evict(0)
+
+    def get(self, key):
+        """!Return the catalog cached under key, or None if there is none."""
+        with self._lock:
+            self._purgeDeadButlers()
+            entry = self._entries.get(key)
+            if entry is None:
+                self.nMisses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.nHits += 1
+            return entry[0]
+
+    def put(self, key, catalog, nBytes=None):
+        """!
+        Add a catalog to the cache, evicting the least recently used catalogs to make room for it.
+
+        @param[in]  key       Hashable key; replaces any catalog already cached with that key.
+        @param[in]  catalog   Catalog to cache.
+        @param[in]  nBytes    Size of the catalog in bytes; estimated with estimateBytes() if None.
+
+        Catalogs larger than maxBytes are not cached.
+        """
+        if nBytes is None:
+            nBytes = self.estimateBytes(catalog)
+        with self._lock:
+            self._purgeDeadButlers()
+            if key in self._entries:
+                self.nBytes -= self._entries.pop(key)[1]
+            if nBytes > self.maxBytes:
+                return
+            self._evict(nBytes)
+            self._entries[key] = (catalog, nBytes)
+            self.nBytes += nBytes
+
+    def clear(self):
+        """!Remove all catalogs from the cache and reset the hit and miss counts."""
+        with self._lock:
+            self._entries.clear()
+            self.nBytes = 0
+            self.nHits = 0
+            self.nMisses = 0
+
+    def _removeButler(self, butlerKey):
+        for key in [key for key in self._entries if self._hasButlerKey(key, butlerKey)]:
+            self.nBytes -= self._entries.pop(key)[1]
+
+    def _evict(self, nBytes):
+        """Remove least recently used entries until another nBytes fit; must be called with the lock held."""
+        while self._entries and self.nBytes + nBytes > self.maxBytes:
+            _, (_, evictedBytes) = self._entries.popitem(last=False)
+            self.nBytes -= evictedBytes
+
+    @staticmethod
+    def estimateBytes(catalog):
+        """!
+        Estimate the memory used by a SourceCatalog: its records, and the spans, peaks and (for
+        HeavyFootprints) pixel values of their Footprints.
+        """
+        nBytes = len(catalog)*catalog.getSchema().getRecordSize()
+        for record in catalog:
+            footprint = record.getFootprint()
+            if footprint is None:
+                continue
+            nBytes += 12*len(footprint.getSpans()) + 64*len(footprint.getPeaks())
+            if footprint.isHeavy():
+                # image, mask and variance pixels
+                nBytes += 12*footprint.getArea()
+        return nBytes
 
 
 class BaseReferencesConfig(lsst.pex.config.Config):
@@ -134,27 +383,46 @@ class BaseReferencesTask(lsst.pipe.base.Task):
         is necessary to support ReplaceWithNoise in measurement, which requires all child sources have
         their parent present.
 
-        @return an iterable of filtered reference sources
+        @return a SourceCatalog of the filtered reference sources, in their original order
 
         This is not a part of the required BaseReferencesTask interface; it's a convenience function
         used in implementing fetchInBox that may be of use to subclasses.
         """
-        boxD = lsst.geom.Box2D(bbox)
-        # We're passed an arbitrary iterable, but we need a catalog so we can iterate
-        # over parents and then children.
-        catalog = lsst.afw.table.SourceCatalog(self.schema)
-        catalog.extend(sources)
-        # catalog must be sorted by parent ID for lsst.afw.table.getChildren to work
-        catalog.sort(lsst.afw.table.SourceTable.getParentKey())
-        # Iterate over objects that have no parent.
-        parentSources = catalog.getChildren(0)
-        skyCoordList = [source.getCoord() for source in parentSources]
-        pixelPosList = wcs.skyToPixel(skyCoordList)
-        for parent, pixel in zip(parentSources, pixelPosList):
-            if boxD.contains(pixel):
-                yield parent
-                for child in catalog.getChildren(parent.getId()):
-                    yield child
+        # We're passed an arbitrary iterable, but we need a contiguous catalog so we can work with
+        # its columns as arrays.
+        catalog = _makeContiguous(sources, self.schema)
+        if len(catalog) == 0:
+            return catalog
+        parents = catalog[lsst.afw.table.SourceTable.getParentKey()]
+        isParent = parents == 0
+        coordKey = catalog.getTable().getCoordKey()
+        x, y = wcs.skyToPixelArray(catalog[coordKey.getRa()][isParent], catalog[coordKey.getDec()][isParent])
+        selected = np.zeros(len(catalog), dtype=bool)
+        selected[isParent] = _boxContains(lsst.geom.Box2D(bbox), x, y)
+        # Include the children of the selected parents.
+        ids = catalog[lsst.afw.table.SourceTable.getIdKey()]
+        selected |= np.isin(parents, ids[selected]) & ~isParent
+        return catalog.subset(selected)
+
+
+def _makeContiguous(sources, schema):
+    """Return sources as a SourceCatalog that is contiguous in memory, copying it only if necessary."""
+    if isinstance(sources, lsst.afw.table.SourceCatalog) and sources.isContiguous():
+        return sources
+    if not hasattr(sources, "__len__"):
+        sources = list(sources)
+    catalog = lsst.afw.table.SourceCatalog(schema)
+    # Allocate all the records in one block, so the deep copy made by extend() is contiguous
+    catalog.reserve(len(sources))
+    catalog.extend(sources, deep=True)
+    return catalog
+
+
+def _boxContains(box, x, y):
+    """Return a boolean array indicating which of the points (x, y) a Box2D contains, as
+    Box2D.contains() would."""
+    return ((x >= box.getMinX()) & (x < box.getMaxX()) &
+            (y >= box.getMinY()) & (y < box.getMaxY()))
 
 
 class CoaddSrcReferencesConfig(BaseReferencesTask.ConfigClass):
@@ -168,6 +436,22 @@ class CoaddSrcReferencesConfig(BaseReferencesTask.ConfigClass):
         dtype=bool,
         default=False
     )
+    patchCacheMaxBytes = lsst.pex.config.Field(
+        doc="Maximum total size (bytes) of the patch reference catalogs kept in memory for reuse by later "
+            "data references processed in the same process; 0 disables the cache.  The cache is shared "
+            "by all references tasks in a process, and takes the largest size requested by any of them.",
+        dtype=int,
+        default=0,
+        check=lambda x: x >= 0,
+    )
+    numPatchReadThreads = lsst.pex.config.Field(
+        doc="Number of threads with which to read the patch catalogs of one request concurrently.  When "
+            "greater than 1, catalogs are read without first checking that they exist.  The order in which "
+            "sources are returned does not depend on this.",
+        dtype=int,
+        default=1,
+        check=lambda x: x >= 1,
+    )
 
     def validate(self):
         if (self.coaddName == "chiSquared") != (self.filter is None):
@@ -182,10 +466,17 @@ class CoaddSrcReferencesTask(BaseReferencesTask):
     """!
     A references task implementation that loads the coadd_datasetSuffix dataset directly from
     disk using the butler.
+
+    When config.patchCacheMaxBytes is nonzero, the patch catalogs (after removing patch overlaps, if
+    enabled) are kept in the process-wide patchCache, and the number of patches found in it and
+    read from disk by this task are written to the task metadata as "patchCacheHits" and
+    "patchCacheMisses".
     """
 
     ConfigClass = CoaddSrcReferencesConfig
     datasetSuffix = "src"  # Suffix to add to "Coadd_" for dataset name
+    patchCache = PatchCatalogCache()  # shared by all instances in a process
+    skyMapCache = skyMapCache
 
     def __init__(self, butler=None, schema=None, **kwargs):
         """! Initialize the task.
@@ -200,12 +491,16 @@ class CoaddSrcReferencesTask(BaseReferencesTask):
             schema = butler.get("{}Coadd_{}_schema".format(self.config.coaddName, self.datasetSuffix),
                                 immediate=True).getSchema()
         self.schema = schema
+        if self.config.patchCacheMaxBytes > self.patchCache.maxBytes:
+            self.patchCache.setMaxBytes(self.config.patchCacheMaxBytes)
+        self.nPatchCacheHits = 0
+        self.nPatchCacheMisses = 0
 
     def getWcs(self, dataRef):
         """Return the WCS for reference sources.  The given dataRef must include the tract in its dataId.
         """
-        skyMap = dataRef.get(self.config.coaddName + "Coadd_skyMap", immediate=True)
-        return skyMap[dataRef.dataId["tract"]].getWcs()
+        return self.skyMapCache.getWcs(dataRef, self.config.coaddName + "Coadd_skyMap",
+                                       dataRef.dataId["tract"])
 
     def fetchInPatches(self, dataRef, patchList):
         """!
@@ -217,25 +512,120 @@ class CoaddSrcReferencesTask(BaseReferencesTask):
         dataset = "{}Coadd_{}".format(self.config.coaddName, self.datasetSuffix)
         tract = dataRef.dataId["tract"]
         butler = dataRef.butlerSubset.butler
-        for patch in patchList:
-            dataId = {'tract': tract, 'patch': "%d,%d" % patch.getIndex()}
-            if self.config.filter is not None:
-                dataId['filter'] = self.config.filter
-
-            if not butler.datasetExists(dataset, dataId):
-                if self.config.skipMissing:
-                    continue
-                raise lsst.pipe.base.TaskError("Reference %s doesn't exist" % (dataId,))
+        patchList = list(patchList)
+        if self.config.numPatchReadThreads > 1 and len(patchList) > 1:
+            catalogs = self._getPatchCatalogsConcurrently(butler, dataset, tract, patchList)
+        else:
+            catalogs = (self.getPatchCatalog(butler, dataset, tract, patch) for patch in patchList)
+        for catalog in catalogs:
+            for source in catalog:
+                yield source
+
+    def getPatchCatalog(self, butler, dataset, tract, patch):
+        """!
+        Return the reference catalog for one patch, from the patch cache if possible.
+
+        @param[in] butler     Butler from which to read the catalog.
+        @param[in] dataset    Name of the reference catalog dataset.
+        @param[in] tract      Tract ID.
+        @param[in] patch      skymap.PatchInfo of the patch.
+
+        @return a SourceCatalog, restricted to the patch's inner bounding box if
+                config.removePatchOverlaps is True, and empty if the catalog does not exist and
+                config.skipMissing is True.  It may be shared with other callers and must not be
+                modified.
+        """
+        key, dataId, catalog = self._lookupPatchCatalog(butler, dataset, tract, patch)
+        if catalog is None:
+            catalog = self._readPatchCatalog(butler, dataset, dataId, patch)
+            self._storePatchCatalog(key, catalog)
+        return catalog
+
+    def _getPatchCatalogsConcurrently(self, butler, dataset, tract, patchList):
+        """!
+        Generator that does the work of getPatchCatalog() for each of patchList, reading the catalogs
+        that are not in the patch cache in a thread pool.
+
+        Catalogs are yielded in the order of patchList, each as soon as it and all its predecessors
+        have been read.  Only the reads run in the pool; the cache and the task metadata are only
+        accessed from the calling thread.
+        """
+        nThreads = min(self.config.numPatchReadThreads, len(patchList))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=nThreads) as executor:
+            pending = []
+            for patch in patchList:
+                key, dataId, catalog = self._lookupPatchCatalog(butler, dataset, tract, patch)
+                if catalog is None:
+                    catalog = executor.submit(self._readPatchCatalog, butler, dataset, dataId, patch,
+                                              checkExists=False)
+                pending.append((key, catalog))
+            for key, catalog in pending:
+                if isinstance(catalog, concurrent.futures.Future):
+                    catalog = catalog.result()
+                    self._storePatchCatalog(key, catalog)
+                yield catalog
+
+    def _lookupPatchCatalog(self, butler, dataset, tract, patch):
+        """Return the cache key (None if caching is disabled) and data ID of a patch catalog, and the
+        catalog if it is in the patch cache (None if it is not), recording the hit or miss.
+
+        The key starts with the butler's _getButlerKey(), so catalogs read from one data repository
+        are never returned for another that uses the same dataset names and data IDs."""
+        dataId = {'tract': tract, 'patch': "%d,%d" % patch.getIndex()}
+        if self.config.filter is not None:
+            dataId['filter'] = self.config.filter
+        if self.config.patchCacheMaxBytes == 0:
+            return None, dataId, None
+        key = (_getButlerKey(butler), dataset, tract, dataId['patch'], self.config.filter,
+               self.config.removePatchOverlaps)
+        catalog = self.patchCache.get(key)
+        if catalog is not None:
+            self.nPatchCacheHits += 1
+            self.metadata.set("patchCacheHits", self.nPatchCacheHits)
+        else:
+            self.nPatchCacheMisses += 1
+            self.metadata.set("patchCacheMisses", self.nPatchCacheMisses)
+        return key, dataId, catalog
+
+    def _storePatchCatalog(self, key, catalog):
+        """Add a catalog returned by _readPatchCatalog() to the patch cache, if caching is enabled."""
+        if key is not None:
+            self.patchCache.put(key, catalog)
+
+    def _readPatchCatalog(self, butler, dataset, dataId, patch, checkExists=True):
+        """!
+        Read one patch catalog and remove its overlaps with other patches if requested.
+
+        @param[in] checkExists  If True, check that the catalog exists before reading it.  If False,
+                                only check whether it exists if reading it fails, saving a round trip
+                                to the data repository in the common case.
+
+        This method does not touch the patch cache or the task metadata, and may be called from
+        several threads at once.
+        """
+        catalog = None
+        if not checkExists:
+            self.log.info("Getting references in %s" % (dataId,))
+            try:
+                catalog = butler.get(dataset, dataId, immediate=True)
+            except Exception:
+                if butler.datasetExists(dataset, dataId):
+                    raise
+        elif butler.datasetExists(dataset, dataId):
             self.log.info("Getting references in %s" % (dataId,))
             catalog = butler.get(dataset, dataId, immediate=True)
-            if self.config.removePatchOverlaps:
-                bbox = lsst.geom.Box2D(patch.getInnerBBox())
-                for source in catalog:
-                    if bbox.contains(source.getCentroid()):
-                        yield source
-            else:
-                for source in catalog:
-                    yield source
+        if catalog is None:
+            if not self.config.skipMissing:
+                raise lsst.pipe.base.TaskError("Reference %s doesn't exist" % (dataId,))
+            return lsst.afw.table.SourceCatalog(self.schema)
+        if self.config.removePatchOverlaps:
+            catalog = _makeContiguous(catalog, self.schema)
+            inner = _boxContains(lsst.geom.Box2D(patch.getInnerBBox()), catalog.getX(), catalog.getY())
+            catalog = catalog.subset(inner)
+            if self.config.patchCacheMaxBytes > 0:
+                # A contiguous copy, so the cache does not hold on to the discarded records.
+                catalog = catalog.copy(deep=True)
+        return catalog
 
     def fetchInBox(self, dataRef, bbox, wcs, pad=0):
         """!
@@ -250,8 +640,8 @@ class CoaddSrcReferencesTask(BaseReferencesTask):
 
         @return an iterable of reference sources
         """
-        skyMap = dataRef.get(self.config.coaddName + "Coadd_skyMap", immediate=True)
-        tract = skyMap[dataRef.dataId["tract"]]
+        tract = self.skyMapCache.getTractInfo(dataRef, self.config.coaddName + "Coadd_skyMap",
+                                              dataRef.dataId["tract"])
         coordList = [wcs.pixelToSky(corner) for corner in lsst.geom.Box2D(bbox).getCorners()]
         self.log.info("Getting references in region with corners %s [degrees]" %
                       ", ".join("(%s)" % (coord.getPosition(lsst.geom.degrees),) for coord in coordList))
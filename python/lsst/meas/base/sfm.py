@@ -29,12 +29,19 @@ slot-eligible fields must be), but non-slot fields may be recorded in other coor
 to avoid information loss (this should, of course, be indicated in the field documentation).
 """
 
+import multiprocessing
+
+import lsst.pex.config
 import lsst.pipe.base as pipeBase
+import lsst.geom
+import lsst.afw.image
+import lsst.afw.table
 
 from .pluginRegistry import PluginRegistry
 from .baseMeasurement import (BaseMeasurementPluginConfig, BaseMeasurementPlugin,
                               BaseMeasurementConfig, BaseMeasurementTask)
 from .noiseReplacer import NoiseReplacer, DummyNoiseReplacer
+from .familyIndex import FamilyIndex
 
 __all__ = ("SingleFramePluginConfig", "SingleFramePlugin",
            "SingleFrameMeasurementConfig", "SingleFrameMeasurementTask")
@@ -140,6 +147,30 @@ class SingleFrameMeasurementConfig(BaseMeasurementConfig):
         default=[],
         doc="Plugins to run on undeblended image"
     )
+    numProcesses = lsst.pex.config.Field(
+        dtype=int, default=1,
+        doc="Number of worker processes among which deblend families are divided for measurement. "
+            "Values greater than one require the 'fork' multiprocessing start method; each worker "
+            "measures its families on its own copy of the noise-replaced exposure."
+    )
+
+    doMeasureInCutouts = lsst.pex.config.Field(
+        dtype=bool, default=False,
+        doc="Measure each deblend family on a padded, noise-replaced cutout of the exposure rather than "
+            "on the full exposure.  Plugins see only the cutout, so each plugin run within the family "
+            "loop must declare how far beyond the Footprints it reads via getCutoutPadding(); if any "
+            "plugin's padding is unknown (the default), the full exposure is measured instead."
+    )
+    cutoutPadding = lsst.pex.config.Field(
+        dtype=int, default=0,
+        doc="Minimum number of pixels by which to grow the family bounding box when doMeasureInCutouts "
+            "is set; the larger of this, the PSF size and the plugins' own padding is used."
+    )
+
+    def validate(self):
+        BaseMeasurementConfig.validate(self)
+        if self.numProcesses < 1:
+            raise ValueError("numProcesses must be at least 1, not %d" % self.numProcesses)
 
 ## @addtogroup LSST_task_documentation
 ## @{
@@ -248,6 +279,10 @@ class SingleFrameMeasurementTask(BaseMeasurementTask):
     NOISE_OFFSET = "NOISE_OFFSET"
     NOISE_EXPOSURE_ID = "NOISE_EXPOSURE_ID"
 
+    # Number of chunks of families handed to each worker process by measureFamiliesInParallel; more
+    # chunks balance the load better when family sizes vary, at the cost of more round trips.
+    _chunksPerProcess = 4
+
     def __init__(self, schema, algMetadata=None, **kwds):
         """!
         Initialize the task. Set up the execution order of the plugins and initialize
@@ -274,7 +309,8 @@ class SingleFrameMeasurementTask(BaseMeasurementTask):
             self.doBlendedness = False
 
     @pipeBase.timeMethod
-    def run(self, measCat, exposure, noiseImage=None, exposureId=None, beginOrder=None, endOrder=None):
+    def run(self, measCat, exposure, noiseImage=None, exposureId=None, beginOrder=None, endOrder=None,
+            noiseReplacer=None):
         """!
         Run single frame measurement over an exposure and source catalog
 
@@ -292,8 +328,42 @@ class SingleFrameMeasurementTask(BaseMeasurementTask):
                                  executionOrder < beginOrder are not executed. None for no limit.
         @param[in] endOrder      ending execution order (exclusive): measurements with
                                  executionOrder >= endOrder are not executed. None for no limit.
+        @param[in] noiseReplacer optional noise replacer returned by makeNoiseReplacer() for the same
+                                 measCat and exposure, to be reused across several calls with
+                                 different execution order ranges.  It is suspended rather than
+                                 ended on return, and the caller must call its end() method once
+                                 the last call is done.  If None, a new one is made and ended here.
+
+        Measuring an exposure in several order ranges with a shared noise replacer looks like:
+        @code
+        noiseReplacer = task.makeNoiseReplacer(measCat, exposure)
+        task.run(measCat, exposure, endOrder=2.0, noiseReplacer=noiseReplacer)
+        # ... the exposure has its original pixels here ...
+        task.run(measCat, exposure, beginOrder=2.0, noiseReplacer=noiseReplacer)
+        noiseReplacer.end()
+        @endcode
         """
         assert measCat.getSchema().contains(self.schema)
+        if noiseReplacer is not None:
+            noiseReplacer.resume()
+            self.runPlugins(noiseReplacer, measCat, exposure, beginOrder, endOrder, endNoiseReplacer=False)
+            return
+        noiseReplacer = self.makeNoiseReplacer(measCat, exposure, noiseImage=noiseImage,
+                                               exposureId=exposureId)
+        self.runPlugins(noiseReplacer, measCat, exposure, beginOrder, endOrder)
+
+    def makeNoiseReplacer(self, measCat, exposure, noiseImage=None, exposureId=None):
+        """!
+        Replace all the sources in measCat with noise, and return the object that inserts them back
+
+        @param[in]      measCat     lsst.afw.table.SourceCatalog of the sources to be measured, with
+                                    Footprints attached.
+        @param[in,out]  exposure    lsst.afw.image.ExposureF whose sources are replaced with noise.
+        @param[in]      noiseImage  optional lsst.afw.image.ImageF, as for run().
+        @param[in]      exposureId  optional unique exposureId, as for run().
+
+        @return a NoiseReplacer, or a DummyNoiseReplacer if config.doReplaceWithNoise is False.
+        """
         footprints = {measRecord.getId(): (measRecord.getParent(), measRecord.getFootprint())
                       for measRecord in measCat}
 
@@ -303,7 +373,8 @@ class SingleFrameMeasurementTask(BaseMeasurementTask):
         # which belong to objects in measCat will be replaced with noise
         if self.config.doReplaceWithNoise:
             noiseReplacer = NoiseReplacer(self.config.noiseReplacer, exposure, footprints,
-                                          noiseImage=noiseImage, log=self.log, exposureId=exposureId)
+                                          noiseImage=noiseImage, log=self.log, exposureId=exposureId,
+                                          maintainMaskPlanes=self.usesNoiseReplacerMaskPlanes())
             algMetadata = measCat.getMetadata()
             if algMetadata is not None:
                 algMetadata.addInt(self.NOISE_SEED_MULTIPLIER, self.config.noiseReplacer.noiseSeedMultiplier)
@@ -313,10 +384,10 @@ class SingleFrameMeasurementTask(BaseMeasurementTask):
                     algMetadata.addLong(self.NOISE_EXPOSURE_ID, exposureId)
         else:
             noiseReplacer = DummyNoiseReplacer()
+        return noiseReplacer
 
-        self.runPlugins(noiseReplacer, measCat, exposure, beginOrder, endOrder)
-
-    def runPlugins(self, noiseReplacer, measCat, exposure, beginOrder=None, endOrder=None):
+    def runPlugins(self, noiseReplacer, measCat, exposure, beginOrder=None, endOrder=None,
+                   endNoiseReplacer=True):
         """Function which calls the defined measument plugins on an exposure
 
         Parameters
@@ -338,10 +409,18 @@ class SingleFrameMeasurementTask(BaseMeasurementTask):
         endOrder : float
             ending execution order (exclusive): measurements with executionOrder >= endOrder are not
             executed. None for no limit.
+
+        endNoiseReplacer : bool
+            If True, end the noiseReplacer when done; otherwise only suspend it, so that it can be
+            resumed for another call.
         """
-        # First, create a catalog of all parentless sources
+        # Recompile the plugin execution plans in case the plugins have been modified since the last run
+        self.clearExecutionPlans()
+
+        # First, index the deblend families and create a catalog of all parentless sources
         # Loop through all the parent sources, first processing the children, then the parent
-        measParentCat = measCat.getChildren(0)
+        familyIndex = FamilyIndex.fromCatalog(measCat)
+        measParentCat = familyIndex.getParents(measCat)
 
         nMeasCat = len(measCat)
         nMeasParentCat = len(measParentCat)
@@ -350,47 +429,266 @@ class SingleFrameMeasurementTask(BaseMeasurementTask):
                       nMeasParentCat, ("" if nMeasParentCat == 1 else "s"),
                       nMeasCat - nMeasParentCat, ("" if nMeasCat - nMeasParentCat == 1 else "ren"))
 
-        for parentIdx, measParentRecord in enumerate(measParentCat):
-            # first get all the children of this parent, insert footprint in turn, and measure
+        cutoutPadding = self.getCutoutPadding(exposure) if self.config.doMeasureInCutouts else None
+        if (isinstance(noiseReplacer, DummyNoiseReplacer) and not self.doBlendedness and
+                self.config.numProcesses == 1):
+            # Without noise replacement the sources need not be measured family by family, so
+            # hand each plugin the whole catalog at once.
+            self.measureAllInBatch(measCat, measParentCat, exposure, beginOrder=beginOrder, endOrder=endOrder,
+                                   familyIndex=familyIndex)
+        else:
+            # Plugins that do not need each source isolated from its neighbors are run over the whole
+            # catalog outside the noise-replacement loop.
+            plan = self.getExecutionPlan(beginOrder, endOrder)
+            self.callMeasureMany(measCat, exposure, beginOrder=beginOrder, endOrder=endOrder,
+                                 tier="catalogBefore")
+            if not (plan.isolated or plan.multi or self.doBlendedness):
+                self.log.debug("No plugins need isolated pixels; skipping the noise-replacement loop")
+            elif self.config.numProcesses > 1 and nMeasParentCat > 1:
+                self.measureFamiliesInParallel(noiseReplacer, measCat, measParentCat, exposure,
+                                               beginOrder=beginOrder, endOrder=endOrder,
+                                               cutoutPadding=cutoutPadding, familyIndex=familyIndex)
+            else:
+                for parentIdx in range(nMeasParentCat):
+                    self.measureFamily(noiseReplacer, measCat, measParentCat, parentIdx, exposure,
+                                       beginOrder=beginOrder, endOrder=endOrder,
+                                       cutoutPadding=cutoutPadding, familyIndex=familyIndex)
+            self.callMeasureMany(measCat, exposure, beginOrder=beginOrder, endOrder=endOrder,
+                                 tier="catalogAfter")
+        # when done, restore the exposure to its original state
+        if endNoiseReplacer:
+            noiseReplacer.end()
+        else:
+            noiseReplacer.suspend()
+
+        # Undeblended plugins only fire if we're running everything
+        if endOrder is None:
+            for source in measCat:
+                for plugin in self.undeblendedPlugins.iter():
+                    self.doMeasurement(plugin, source, exposure)
+
+        # Now we loop over all of the sources one more time to compute the blendedness metrics
+        if self.doBlendedness:
+            for source in measCat:
+                self.blendPlugin.cpp.measureParentPixels(exposure.getMaskedImage(), source)
+
+        if self.config.doPluginMetrics:
+            self.writePluginMetrics()
+
+    def measureFamily(self, noiseReplacer, measCat, measParentCat, parentIdx, exposure,
+                      beginOrder=None, endOrder=None, cutoutPadding=None, familyIndex=None):
+        """Measure a single deblend family: each child in turn, then the parent, then the
+        family as a whole via measureN.  Only the plugins in the "isolated" tier of the execution
+        plan are run on the individual sources; the rest are run over the whole catalog by runPlugins().
+
+        Parameters
+        ----------
+        noiseReplacer : lsst.meas.base.NoiseReplacer
+            noiseReplacer to fill sources not being measured with noise.
+
+        measCat : lsst.afw.table.SourceCatalog
+            SourceCatalog containing the family, sorted by parent.
+
+        measParentCat : lsst.afw.table.SourceCatalog
+            The parentless sources of measCat, as returned by measCat.getChildren(0).
+
+        parentIdx : int
+            Index of the family's parent in measParentCat.
+
+        exposure : lsst.afw.image.ExposureF
+            Exposure contaning the pixel data to be measured and the associated PSF, WCS, etc.
+
+        beginOrder : float
+            beginning execution order (inclusive); None for no limit.
+
+        endOrder : float
+            ending execution order (exclusive); None for no limit.
+
+        cutoutPadding : int
+            If not None, measure the family on a cutout of the exposure grown by this many pixels
+            around the family's Footprints (see makeFamilyCutout()), rather than on the full exposure.
+
+        familyIndex : lsst.meas.base.FamilyIndex
+            Index of the families in measCat, used to find the children without searching measCat.
+            If None, measCat.getChildren() is used instead.
+        """
+        measParentRecord = measParentCat[parentIdx]
+        # first get all the children of this parent, insert footprint in turn, and measure
+        if familyIndex is None:
             measChildCat = measCat.getChildren(measParentRecord.getId())
-            # TODO: skip this loop if there are no plugins configured for single-object mode
+        else:
+            measChildCat = familyIndex.getChildren(measCat, parentIdx)
+        if cutoutPadding is not None:
+            exposure = self.makeFamilyCutout(exposure, measParentRecord, measChildCat, cutoutPadding)
+            noiseReplacer = noiseReplacer.makeCutoutReplacer(exposure)
+        # Plugins that do not need isolated pixels are run by runPlugins() instead
+        isolated = self.getExecutionPlan(beginOrder, endOrder).isolated
+        if isolated or self.doBlendedness:
             for measChildRecord in measChildCat:
                 noiseReplacer.insertSource(measChildRecord.getId())
-                self.callMeasure(measChildRecord, exposure, beginOrder=beginOrder, endOrder=endOrder)
+                self.callMeasure(measChildRecord, exposure, beginOrder=beginOrder, endOrder=endOrder,
+                                 tier="isolated")
 
                 if self.doBlendedness:
                     self.blendPlugin.cpp.measureChildPixels(exposure.getMaskedImage(), measChildRecord)
 
                 noiseReplacer.removeSource(measChildRecord.getId())
 
-            # Then insert the parent footprint, and measure that
-            noiseReplacer.insertSource(measParentRecord.getId())
-            self.callMeasure(measParentRecord, exposure, beginOrder=beginOrder, endOrder=endOrder)
+        # Then insert the parent footprint, and measure that
+        noiseReplacer.insertSource(measParentRecord.getId())
+        self.callMeasure(measParentRecord, exposure, beginOrder=beginOrder, endOrder=endOrder,
+                         tier="isolated")
+
+        if self.doBlendedness:
+            self.blendPlugin.cpp.measureChildPixels(exposure.getMaskedImage(), measParentRecord)
+
+        # Finally, process both the parent and the child set through measureN
+        self.callMeasureN(measParentCat[parentIdx:parentIdx+1], exposure,
+                          beginOrder=beginOrder, endOrder=endOrder)
+        self.callMeasureN(measChildCat, exposure, beginOrder=beginOrder, endOrder=endOrder)
+        noiseReplacer.removeSource(measParentRecord.getId())
+
+    def measureAllInBatch(self, measCat, measParentCat, exposure, beginOrder=None, endOrder=None,
+                          familyIndex=None):
+        """Measure all sources without noise replacement, one plugin at a time.
 
-            if self.doBlendedness:
-                self.blendPlugin.cpp.measureChildPixels(exposure.getMaskedImage(), measParentRecord)
+        Each plugin measures every record in measCat via callMeasureMany(), which lets wrapped C++
+        algorithms loop over the records in C++; any measureN() plugins are then run on each family
+        as in measureFamily().  Only valid when no sources are replaced with noise, since no pixels
+        are modified between records.
 
-                # Finally, process both the parent and the child set through measureN
+        Parameters
+        ----------
+        measCat : lsst.afw.table.SourceCatalog
+            SourceCatalog to be filled with outputs, sorted by parent.
+
+        measParentCat : lsst.afw.table.SourceCatalog
+            Catalog of the parentless records in measCat.
+
+        exposure : lsst.afw.image.ExposureF
+            Exposure contaning the pixel data to be measured and the associated PSF, WCS, etc.
+
+        beginOrder : float
+            beginning execution order (inclusive); None for no limit.
+
+        endOrder : float
+            ending execution order (exclusive); None for no limit.
+
+        familyIndex : lsst.meas.base.FamilyIndex
+            Index of the families in measCat; built from measCat if None.
+        """
+        self.callMeasureMany(measCat, exposure, beginOrder=beginOrder, endOrder=endOrder)
+        if not any(True for _ in self.plugins.iterN()):
+            return
+        if familyIndex is None:
+            familyIndex = FamilyIndex.fromCatalog(measCat)
+        for parentIdx in range(len(measParentCat)):
             self.callMeasureN(measParentCat[parentIdx:parentIdx+1], exposure,
                               beginOrder=beginOrder, endOrder=endOrder)
-            self.callMeasureN(measChildCat, exposure, beginOrder=beginOrder, endOrder=endOrder)
-            noiseReplacer.removeSource(measParentRecord.getId())
-        # when done, restore the exposure to its original state
-        noiseReplacer.end()
+            self.callMeasureN(familyIndex.getChildren(measCat, parentIdx), exposure,
+                              beginOrder=beginOrder, endOrder=endOrder)
 
-        # Undeblended plugins only fire if we're running everything
-        if endOrder is None:
-            for source in measCat:
-                for plugin in self.undeblendedPlugins.iter():
-                    self.doMeasurement(plugin, source, exposure)
+    def getCutoutPadding(self, exposure):
+        """Return the number of pixels by which to grow family bounding boxes for cutout measurement.
 
-        # Now we loop over all of the sources one more time to compute the blendedness metrics
-        if self.doBlendedness:
-            for source in measCat:
-                self.blendPlugin.cpp.measureParentPixels(exposure.getMaskedImage(), source)
+        This is the largest of config.cutoutPadding, half the size of the PSF kernel image
+        (evaluated at the PSF's average position) and the padding requested via getCutoutPadding()
+        by any of the plugins run within the family loop (plugins run over the whole catalog, and
+        undeblended plugins, always see the full exposure).  Returns None, meaning that the full
+        exposure should be measured, if any of those plugins does not know its padding.
+        """
+        padding = self.config.cutoutPadding
+        if exposure.hasPsf():
+            psfDimensions = exposure.getPsf().computeKernelImage().getDimensions()
+            padding = max(padding, max(psfDimensions.getX(), psfDimensions.getY())//2 + 1)
+        plan = self.getExecutionPlan()
+        for plugin in [step.plugin for step in plan.isolated + plan.multi]:
+            pluginPadding = plugin.getCutoutPadding(exposure)
+            if pluginPadding is None:
+                self.log.warn("Plugin %s does not declare how far beyond the Footprints it reads; "
+                              "measuring on the full exposure instead of cutouts", plugin.name)
+                return None
+            padding = max(padding, pluginPadding)
+        return padding
+
+    def makeFamilyCutout(self, exposure, measParentRecord, measChildCat, padding):
+        """Return a deep copy of the region of the exposure that covers a deblend family.
+
+        The cutout covers the union of the Footprint bounding boxes of the parent and its children,
+        grown by padding pixels and clipped to the exposure.  Its pixels are copied, so it may be
+        modified freely, while the Psf, Wcs, Calib and other components are shared with the exposure.
+        """
+        bbox = lsst.geom.Box2I(measParentRecord.getFootprint().getBBox())
+        for measChildRecord in measChildCat:
+            bbox.include(measChildRecord.getFootprint().getBBox())
+        bbox.grow(padding)
+        bbox.clip(exposure.getBBox())
+        return exposure.Factory(exposure, bbox, lsst.afw.image.PARENT, True)
+
+    def measureFamiliesInParallel(self, noiseReplacer, measCat, measParentCat, exposure,
+                                  beginOrder=None, endOrder=None, cutoutPadding=None, familyIndex=None):
+        """Measure all deblend families using a pool of config.numProcesses worker processes.
+
+        The workers are forked after all sources have been replaced with noise, so each
+        starts from an identical copy of the exposure.  The NoiseReplacer fills the pixels
+        shared by a blend with the noise of its parent both at construction and when the
+        parent is removed at the end of measureFamily(), so every family is returned to
+        that initial state after it is measured, and the outputs are bit-identical to
+        those of the serial loop in runPlugins().  Families are dealt out to the workers
+        in interleaved chunks, and the measured records (and, if config.doPluginMetrics
+        is set, the plugin statistics) are copied back as each chunk completes.
+        Arguments are as for measureFamily().
+        """
+        global _parallelState
+        nFamilies = len(measParentCat)
+        nChunks = min(nFamilies, self.config.numProcesses*self._chunksPerProcess)
+        chunks = [range(start, nFamilies, nChunks) for start in range(nChunks)]
+        recordsById = {record.getId(): record for record in measCat}
+        if familyIndex is None:
+            familyIndex = FamilyIndex.fromCatalog(measCat)
+        _parallelState = (self, noiseReplacer, measCat, measParentCat, exposure,
+                          dict(beginOrder=beginOrder, endOrder=endOrder, cutoutPadding=cutoutPadding,
+                               familyIndex=familyIndex))
+        try:
+            context = multiprocessing.get_context("fork")
+            with context.Pool(processes=self.config.numProcesses) as pool:
+                for measured, metrics in pool.imap_unordered(_measureFamilyChunk, chunks):
+                    self.mergePluginMetrics(metrics)
+                    for source in measured:
+                        target = recordsById[source.getId()]
+                        # assign() also copies the (deliberately empty) Footprint, so hang on to ours
+                        footprint = target.getFootprint()
+                        target.assign(source)
+                        target.setFootprint(footprint)
+        finally:
+            _parallelState = None
 
     def measure(self, measCat, exposure):
         """!
         Backwards-compatibility alias for run()
         """
         self.run(measCat, exposure)
+
+
+# State shared with the worker processes forked by SingleFrameMeasurementTask.measureFamiliesInParallel;
+# it is inherited through fork() rather than pickled, and is only set while the pool is alive.
+_parallelState = None
+
+
+def _measureFamilyChunk(parentIndices):
+    """Measure the families with the given parent indices in a worker process, returning deep copies
+    of their records (without Footprints, which the parent process already has) and the plugin
+    statistics accumulated while measuring them.
+    """
+    task, noiseReplacer, measCat, measParentCat, exposure, kwds = _parallelState
+    # Discard the statistics inherited from the parent process or left by earlier chunks
+    task.popPluginMetrics()
+    measured = lsst.afw.table.SourceCatalog(measCat.getSchema())
+    for parentIdx in parentIndices:
+        task.measureFamily(noiseReplacer, measCat, measParentCat, parentIdx, exposure, **kwds)
+        for recordIdx in kwds["familyIndex"].getFamilyIndices(parentIdx):
+            record = measCat[int(recordIdx)]
+            copy = measured.addNew()
+            copy.assign(record)
+            copy.setFootprint(None)
+    return measured, task.popPluginMetrics()
@@ -25,6 +25,15 @@ class WrappedSingleFramePlugin(SingleFramePlugin):
     def measureN(self, measCat, exposure):
         self.cpp.measureN(measCat, exposure)
 
+    def measureMany(self, measCat, exposure):
+        self.cpp.measureMany(measCat, exposure)
+
+    def getCutoutPadding(self, exposure):
+        # Nothing is generally knowable from Python about how far beyond the Footprint a C++
+        # algorithm reads; algorithms that can be measured in cutouts declare their padding
+        # via the cutoutPadding argument to wrapAlgorithm.
+        return None
+
     def fail(self, measRecord, error=None):
         self.cpp.fail(measRecord, error.cpp if error is not None else None)
 
@@ -44,6 +53,9 @@ class WrappedForcedPlugin(ForcedPlugin):
     def measureN(self, measCat, exposure, refCat, refWcs):
         self.cpp.measureNForced(measCat, exposure, refCat, refWcs)
 
+    def measureMany(self, measCat, exposure, refCat, refWcs):
+        self.cpp.measureManyForced(measCat, exposure, refCat, refWcs)
+
     def fail(self, measRecord, error=None):
         self.cpp.fail(measRecord, error.cpp if error is not None else None)
 
@@ -90,7 +102,8 @@ def wrapAlgorithmControl(Base, Control, module=2, hasMeasureN=False):
 
 def wrapAlgorithm(Base, AlgClass, factory, executionOrder, name=None, Control=None,
                   ConfigClass=None, TransformClass=None, doRegister=True, shouldApCorr=False,
-                  apCorrList=(), hasLogName=False, **kwds):
+                  apCorrList=(), hasLogName=False, usesNoiseReplacerMaskPlanes=True, cutoutPadding=None,
+                  **kwds):
     """!
     Wrap a C++ Algorithm class into a Python Plugin class.
 
@@ -129,7 +142,16 @@ def wrapAlgorithm(Base, AlgClass, factory, executionOrder, name=None, Control=No
                                If non-empty and doRegister is True then the names are added to the set
                                retrieved by getApCorrNameSet
     @param[in] hasLogName      Plugin supports a logName as a constructor argument
-
+    @param[in] usesNoiseReplacerMaskPlanes  Whether the algorithm reads the THISDET or OTHERDET mask planes
+                               maintained by the NoiseReplacer (see
+                               BaseMeasurementPlugin.usesNoiseReplacerMaskPlanes).  Defaults to True,
+                               as the NoiseReplacer cannot tell whether a wrapped algorithm does; pass
+                               False only for algorithms known not to read them.
+    @param[in] cutoutPadding   A callable taking (config, exposure) that returns the number of pixels
+                               beyond a source's Footprint (and the PSF size) the algorithm reads (see
+                               BaseMeasurementPlugin.getCutoutPadding()).  If None, the padding is
+                               unknown, and sources are never measured in cutouts when this plugin is
+                               enabled.
 
     @param[in] **kwds          Additional keyword arguments passed to generateAlgorithmControl, including:
                                - hasMeasureN:  Whether the plugin supports fitting multiple objects at once
@@ -153,6 +175,8 @@ def wrapAlgorithm(Base, AlgClass, factory, executionOrder, name=None, Control=No
                     getExecutionOrder=staticmethod(getExecutionOrder))
     if TransformClass:
         typeDict['getTransformClass'] = staticmethod(lambda: TransformClass)
+    if cutoutPadding is not None:
+        typeDict['getCutoutPadding'] = lambda self, exposure: cutoutPadding(self.config, exposure)
     PluginClass = type(AlgClass.__name__ + Base.__name__, (Base,), typeDict)
     if doRegister:
         if name is None:
@@ -161,6 +185,10 @@ def wrapAlgorithm(Base, AlgClass, factory, executionOrder, name=None, Control=No
         if shouldApCorr:
             addApCorrName(name)
     PluginClass.hasLogName = hasLogName
+    PluginClass.usesNoiseReplacerMaskPlanes = usesNoiseReplacerMaskPlanes
+    # Classes that merely mimic the C++ Algorithm interface may lack the batch entry point.
+    PluginClass.hasMeasureMany = hasattr(AlgClass, "measureManyForced" if issubclass(Base, ForcedPlugin)
+                                         else "measureMany")
     return PluginClass
 
 
@@ -481,10 +509,30 @@ class GenericPlugin(BasePlugin):
     """
     ConfigClass = None
 
+    # Set to False in sub-classes whose measure() does not read the pixels of the source being measured
+    # (see BaseMeasurementPlugin.needsIsolatedPixels).
+    needsIsolatedPixels = True
+
+    # Set to False in sub-classes that do not read the THISDET or OTHERDET mask planes
+    # (see BaseMeasurementPlugin.usesNoiseReplacerMaskPlanes).
+    usesNoiseReplacerMaskPlanes = True
+
     @classmethod
     def getExecutionOrder(cls):
         return 0
 
+    def getCutoutPadding(self, exposure):
+        """Return the number of pixels beyond a source's Footprint this plugin reads
+
+        See `BaseMeasurementPlugin.getCutoutPadding`; this default returns `None`, for unknown.
+
+        Parameters
+        ----------
+        exposure : `lsst.afw.image.Exposure`
+            Exposure to be measured.
+        """
+        return None
+
     def __init__(self, config, name, schema, metadata, logName=None):
         """Constructor
 
@@ -572,6 +620,8 @@ class GenericPlugin(BasePlugin):
         @register(name)
         class SingleFrameFromGenericPlugin(SingleFramePlugin):
             ConfigClass = SingleFrameFromGenericConfig
+            needsIsolatedPixels = cls.needsIsolatedPixels
+            usesNoiseReplacerMaskPlanes = cls.usesNoiseReplacerMaskPlanes
 
             def __init__(self, config, name, schema, metadata, logName=None):
                 SingleFramePlugin.__init__(self, config, name, schema, metadata, logName=logName)
@@ -594,6 +644,9 @@ class GenericPlugin(BasePlugin):
             def getTransformClass(self):
                 return self._generic.getTransformClass()
 
+            def getCutoutPadding(self, exposure):
+                return self._generic.getCutoutPadding(exposure)
+
         return SingleFrameFromGenericPlugin
 
     @classmethod
@@ -613,6 +666,8 @@ class GenericPlugin(BasePlugin):
         @register(name)
         class ForcedFromGenericPlugin(ForcedPlugin):
             ConfigClass = ForcedFromGenericConfig
+            needsIsolatedPixels = cls.needsIsolatedPixels
+            usesNoiseReplacerMaskPlanes = cls.usesNoiseReplacerMaskPlanes
 
             def __init__(self, config, name, schemaMapper, metadata, logName=None):
                 ForcedPlugin.__init__(self, config, name, schemaMapper, metadata, logName=logName)
@@ -21,6 +21,10 @@
  * see <http://www.lsstcorp.org/LegalNotices/>.
  */
 
+#include <new>
+
+#include "boost/format.hpp"
+
 #include "lsst/afw/table/Source.h"
 #include "lsst/meas/base/Algorithm.h"
 
@@ -28,11 +32,47 @@ namespace lsst {
 namespace meas {
 namespace base {
 
+namespace {
+
+/*
+ *  Call measureOne(i) for each record i of measCat, handling exceptions the way
+ *  BaseMeasurementTask.doMeasurement does in Python.
+ */
+template <typename MeasureOne>
+void measureEach(BaseAlgorithm const& algorithm, afw::table::SourceCatalog const& measCat,
+                 MeasureOne const& measureOne) {
+    for (std::size_t i = 0; i < measCat.size(); ++i) {
+        afw::table::SourceRecord& measRecord = measCat[i];
+        try {
+            measureOne(i);
+        } catch (FatalAlgorithmError&) {
+            throw;
+        } catch (std::bad_alloc&) {
+            throw;
+        } catch (MeasurementError& error) {
+            LOGLS_DEBUG(algorithm.getLogName(),
+                        "MeasurementError on record " << measRecord.getId() << ": " << error.what());
+            algorithm.fail(measRecord, &error);
+        } catch (std::exception& error) {
+            LOGLS_DEBUG(algorithm.getLogName(),
+                        "Exception on record " << measRecord.getId() << ": " << error.what());
+            algorithm.fail(measRecord);
+        }
+    }
+}
+
+}  // namespace
+
 void SingleFrameAlgorithm::measureN(afw::table::SourceCatalog const& measCat,
                                     afw::image::Exposure<float> const& exposure) const {
     throw LSST_EXCEPT(pex::exceptions::LogicError, "measureN not implemented for this algorithm");
 }
 
+void SingleFrameAlgorithm::measureMany(afw::table::SourceCatalog const& measCat,
+                                       afw::image::Exposure<float> const& exposure) const {
+    measureEach(*this, measCat, [&](std::size_t i) { measure(measCat[i], exposure); });
+}
+
 void ForcedAlgorithm::measureNForced(afw::table::SourceCatalog const& measCat,
                                      afw::image::Exposure<float> const& exposure,
                                      afw::table::SourceCatalog const& refRecord,
@@ -40,6 +80,20 @@ void ForcedAlgorithm::measureNForced(afw::table::SourceCatalog const& measCat,
     throw LSST_EXCEPT(pex::exceptions::LogicError, "measureN not implemented for this algorithm");
 }
 
+void ForcedAlgorithm::measureManyForced(afw::table::SourceCatalog const& measCat,
+                                        afw::image::Exposure<float> const& exposure,
+                                        afw::table::SourceCatalog const& refCat,
+                                        afw::geom::SkyWcs const& refWcs) const {
+    if (measCat.size() != refCat.size()) {
+        throw LSST_EXCEPT(pex::exceptions::LengthError,
+                          (boost::format("Measurement catalog has %d records but reference catalog has %d") %
+                           measCat.size() % refCat.size())
+                                  .str());
+    }
+    measureEach(*this, measCat,
+                [&](std::size_t i) { measureForced(measCat[i], exposure, refCat[i], refWcs); });
+}
+
 }  // namespace base
 }  // namespace meas
 }  // namespace lsst
@@ -137,6 +137,7 @@ class CatalogCalculationTest(unittest.TestCase):
         catCalcConfig = catCalc.CatalogCalculationConfig()
         catCalcConfig.plugins.names = ["FailcatalogCalculation", "singleRecordCatalogCalculation",
                                        "multiRecordCatalogCalculation", "dependentCatalogCalulation"]
+        catCalcConfig.doPluginMetrics = True
         catCalcTask = catCalc.CatalogCalculationTask(schema=schema, config=catCalcConfig)
         # Create a catalog with five sources as input to the task
         self.catalog = afwTable.SourceCatalog(schema)
@@ -146,6 +147,7 @@ class CatalogCalculationTest(unittest.TestCase):
             rec.set("start", float(i + 1))
         # Run the catalogCalculation task, outputs will be checked in test methods
         catCalcTask.run(self.catalog)
+        self.metadata = catCalcTask.metadata
 
     def testCatalogCalculation(self):
         # Verify the failure flag got set for the plugin expected to fail
@@ -165,8 +167,22 @@ class CatalogCalculationTest(unittest.TestCase):
         for rec in self.catalog:
             self.assertAlmostEqual(rec.get("start"), rec.get("dependentCatalogCalulation_sqrt"), 4)
 
+    def testPluginMetrics(self):
+        prefix = "pluginMetrics."
+        self.assertEqual(self.metadata.get(prefix + "singleRecordCatalogCalculation.nCalls"), self.numObjects)
+        # Whole-catalog calls are counted separately, and never listed among the slowest calls
+        self.assertEqual(self.metadata.get(prefix + "multiRecordCatalogCalculation.nCalls"), 0)
+        self.assertEqual(self.metadata.get(prefix + "multiRecordCatalogCalculation.nBatchCalls"), 1)
+        self.assertFalse(self.metadata.exists(prefix + "multiRecordCatalogCalculation.slowestIds"))
+        self.assertEqual(self.metadata.get(prefix + "FailcatalogCalculation.nMeasurementErrors"),
+                         self.numObjects)
+        self.assertEqual(self.metadata.get(prefix + "FailcatalogCalculation.nExceptions"), 0)
+        self.assertEqual(len(self.metadata.getArray(prefix + "singleRecordCatalogCalculation.slowestIds")),
+                         self.numObjects)
+        self.assertGreaterEqual(self.metadata.get(prefix + "dependentCatalogCalulation.wallTime"), 0.0)
+
     def tearDown(self):
-        del self.catalog, self.numObjects,
+        del self.catalog, self.numObjects, self.metadata
 
 
 class TestMemory(lsst.utils.tests.MemoryTestCase):
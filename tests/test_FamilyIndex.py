@@ -0,0 +1,105 @@
+#
+# LSST Data Management System
+# Copyright 2008-2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+import unittest
+
+import numpy as np
+
+import lsst.afw.table
+import lsst.meas.base
+import lsst.utils.tests
+
+
+class FamilyIndexTestCase(lsst.utils.tests.TestCase):
+
+    def setUp(self):
+        # Two families with children, one isolated source, and a grandchild
+        self.ids = [1, 2, 3, 4, 5, 6, 7]
+        self.parents = [0, 1, 0, 1, 3, 0, 4]
+        self.catalog = lsst.afw.table.SourceCatalog(lsst.afw.table.SourceTable.makeMinimalSchema())
+        for id, parent in zip(self.ids, self.parents):
+            record = self.catalog.addNew()
+            record.setId(id)
+            record.setParent(parent)
+
+    def tearDown(self):
+        del self.catalog
+
+    def checkFamilies(self, catalog):
+        """Check that a FamilyIndex agrees with getChildren() on a catalog sorted by parent."""
+        familyIndex = lsst.meas.base.FamilyIndex.fromCatalog(catalog)
+        sortedCatalog = catalog.copy(deep=True)
+        sortedCatalog.sort(lsst.afw.table.SourceTable.getParentKey())
+        parents = familyIndex.getParents(catalog)
+        self.assertEqual(sorted(r.getId() for r in parents),
+                         sorted(r.getId() for r in sortedCatalog.getChildren(0)))
+        self.assertEqual(len(familyIndex), len(parents))
+        for parentIdx, parent in enumerate(parents):
+            self.assertEqual(sorted(r.getId() for r in familyIndex.getChildren(catalog, parentIdx)),
+                             sorted(r.getId() for r in sortedCatalog.getChildren(parent.getId())))
+            self.assertEqual([catalog[int(i)].getId() for i in familyIndex.getFamilyIndices(parentIdx)],
+                             [r.getId() for r in familyIndex.getChildren(catalog, parentIdx)] +
+                             [parent.getId()])
+
+    def testUnsorted(self):
+        familyIndex = lsst.meas.base.FamilyIndex(self.ids, self.parents)
+        self.assertFalse(familyIndex.isSorted)
+        self.checkFamilies(self.catalog)
+
+    def testSorted(self):
+        self.catalog.sort(lsst.afw.table.SourceTable.getParentKey())
+        familyIndex = lsst.meas.base.FamilyIndex.fromCatalog(self.catalog)
+        self.assertTrue(familyIndex.isSorted)
+        self.checkFamilies(self.catalog)
+
+    def testParentChains(self):
+        familyIndex = lsst.meas.base.FamilyIndex(self.ids, self.parents)
+        self.assertFalse(familyIndex.findBrokenChains().any())
+        familyIndex.validate()
+        self.assertEqual(list(familyIndex.getAncestorIds()), [1, 1, 3, 1, 3, 6, 1])
+        stop = np.array([id == 4 for id in self.ids])
+        self.assertEqual(list(familyIndex.getAncestorIds(stop=stop)), [1, 1, 3, 4, 3, 6, 4])
+        # Remove source 4, breaking the chain of its child
+        keep = np.array([id != 4 for id in self.ids])
+        familyIndex = lsst.meas.base.FamilyIndex(np.array(self.ids)[keep], np.array(self.parents)[keep])
+        self.assertEqual(list(familyIndex.findBrokenChains()), [False]*5 + [True])
+        with self.assertRaises(RuntimeError):
+            familyIndex.validate()
+
+    def testEmpty(self):
+        familyIndex = lsst.meas.base.FamilyIndex([], [])
+        self.assertEqual(len(familyIndex), 0)
+        self.assertEqual(len(familyIndex.findBrokenChains()), 0)
+        familyIndex.validate()
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
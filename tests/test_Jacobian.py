@@ -84,6 +84,28 @@ class JacobianTestCase(AlgorithmTestCase, lsst.utils.tests.TestCase):
         self.assertFalse(record.get("base_Jacobian_flag"))
         self.assertAlmostEqual(record.get("base_Jacobian_value"), 1.0200183929088285, 4)
 
+    def testMeasureMany(self):
+        """Test that the batched measurement agrees with measuring each record, including those
+        that must fall back to the per-record code."""
+        self.dataset.addSource(80000.0, lsst.geom.Point2D(10.3, 95.2))
+        self.dataset.addSource(90000.0, lsst.geom.Point2D(100.7, -12.4))
+        config = SingleFrameMeasurementConfig()
+        config.plugins.names |= ['base_Jacobian']
+        config.plugins['base_Jacobian'].pixelScale = 0.2
+        task = self.makeSingleFrameMeasurementTask(config=config)
+        exposure, catalog = self.dataset.realize(10.0, task.schema, randomSeed=0)
+        exposure.setWcs(self.wcs)
+        task.run(catalog, exposure)
+        catalog[1].set(catalog.getCentroidKey().getX(), float("nan"))
+        plugin = task.plugins['base_Jacobian']
+        plugin.measureMany(catalog, exposure)
+        batchValues = catalog["base_Jacobian_value"].copy()
+        for record in catalog:
+            plugin.measure(record, exposure)
+        self.assertFloatsAlmostEqual(batchValues, catalog["base_Jacobian_value"], rtol=1E-8,
+                                     ignoreNaNs=True)
+        self.assertFalse(catalog[0].get("base_Jacobian_flag"))
+
 
 class TestMemory(lsst.utils.tests.MemoryTestCase):
     pass
@@ -0,0 +1,219 @@
+#
+# LSST Data Management System
+# Copyright 2008-2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+import unittest
+
+import numpy as np
+
+import lsst.geom
+import lsst.afw.geom
+import lsst.meas.base.tests
+import lsst.utils.tests
+
+
+class MeasureManyTestCase(lsst.meas.base.tests.AlgorithmTestCase, lsst.utils.tests.TestCase):
+
+    plugins = ("base_SdssCentroid", "base_PsfFlux", "base_GaussianFlux", "base_SdssShape")
+
+    def setUp(self):
+        self.bbox = lsst.geom.Box2I(lsst.geom.Point2I(-20, -30),
+                                    lsst.geom.Extent2I(240, 260))
+        self.dataset = lsst.meas.base.tests.TestDataset(self.bbox)
+        self.dataset.addSource(100000.0, lsst.geom.Point2D(50.1, 49.8))
+        # This source is close enough to the edge for some of the plugins to fail.
+        self.dataset.addSource(90000.0, lsst.geom.Point2D(-19.6, 100.2))
+        with self.dataset.addBlend() as family:
+            family.addChild(110000.0, lsst.geom.Point2D(65.2, 150.7),
+                            lsst.afw.geom.Quadrupole(7, 5, -1))
+            family.addChild(140000.0, lsst.geom.Point2D(72.3, 149.1))
+
+    def tearDown(self):
+        del self.bbox
+        del self.dataset
+
+    def assertCatalogsEqual(self, catalog1, catalog2):
+        self.assertEqual(len(catalog1), len(catalog2))
+        for item in catalog1.schema:
+            name = item.field.getName()
+            if not name.startswith(self.plugins) or item.field.getTypeString() not in ("D", "F", "Flag"):
+                continue
+            column1 = np.array([record.get(item.key) for record in catalog1])
+            column2 = np.array([record.get(item.key) for record in catalog2])
+            np.testing.assert_array_equal(column1, column2, err_msg=name)
+
+    def testSingleFrame(self):
+        """Test that measuring the whole catalog at once matches measuring one record at a time."""
+        config = self.makeSingleFrameMeasurementConfig(self.plugins[0], dependencies=self.plugins[1:])
+        config.doReplaceWithNoise = False
+        task = self.makeSingleFrameMeasurementTask(config=config)
+        exposure, batchCatalog = self.dataset.realize(10.0, task.schema, randomSeed=0)
+        task.run(batchCatalog, exposure)
+        exposure, loopCatalog = self.dataset.realize(10.0, task.schema, randomSeed=0)
+        for record in loopCatalog:
+            task.callMeasure(record, exposure)
+        self.assertCatalogsEqual(batchCatalog, loopCatalog)
+
+    def testForced(self):
+        """Test that forced measurement of the whole catalog at once matches the per-record loop."""
+        measWcs = self.dataset.makePerturbedWcs(self.dataset.exposure.getWcs(), randomSeed=2)
+        measDataset = self.dataset.transform(measWcs)
+        config = self.makeForcedMeasurementConfig(self.plugins[0], dependencies=self.plugins[1:])
+        config.doReplaceWithNoise = False
+        task = self.makeForcedMeasurementTask(config=config)
+        exposure, _ = measDataset.realize(10.0, measDataset.makeMinimalSchema(), randomSeed=2)
+        refWcs = self.dataset.exposure.getWcs()
+        refCatalog = self.dataset.catalog
+        batchCatalog = task.generateMeasCat(exposure, refCatalog, refWcs)
+        task.attachTransformedFootprints(batchCatalog, refCatalog, exposure, refWcs)
+        task.run(batchCatalog, exposure, refCatalog, refWcs)
+        loopCatalog = task.generateMeasCat(exposure, refCatalog, refWcs)
+        task.attachTransformedFootprints(loopCatalog, refCatalog, exposure, refWcs)
+        for measRecord, refRecord in zip(loopCatalog, refCatalog):
+            task.callMeasure(measRecord, exposure, refRecord, refWcs)
+        self.assertCatalogsEqual(batchCatalog, loopCatalog)
+
+    def testGenerateMeasCat(self):
+        """Test that generating the forced catalog from a SourceCatalog matches generating it from
+        a sequence of records."""
+        task = self.makeForcedMeasurementTask("base_PsfFlux")
+        refWcs = self.dataset.exposure.getWcs()
+        refCatalog = self.dataset.catalog
+        batchCatalog = task.generateMeasCat(self.dataset.exposure, refCatalog, refWcs)
+        loopCatalog = task.generateMeasCat(self.dataset.exposure, list(refCatalog), refWcs)
+        self.assertTrue(batchCatalog.isContiguous())
+        self.assertEqual(len(batchCatalog), len(refCatalog))
+        for batchRecord, loopRecord, refRecord in zip(batchCatalog, loopCatalog, refCatalog):
+            self.assertEqual(batchRecord.getId(), loopRecord.getId())
+            # The forced catalog's own parent field is not mapped; the reference IDs are copied
+            # to the objectId and parentObjectId columns instead.
+            self.assertEqual(batchRecord.get("objectId"), refRecord.getId())
+            self.assertEqual(batchRecord.get("parentObjectId"), refRecord.getParent())
+            self.assertEqual(loopRecord.get("parentObjectId"), refRecord.getParent())
+            self.assertEqual(batchRecord.getCoord(), refRecord.getCoord())
+
+    def testTransformedReferences(self):
+        """Test the batched reference centroid and shape transforms against the per-record versions,
+        both for a different WCS and for the reference WCS itself."""
+        task = self.makeForcedMeasurementTask("base_PsfFlux")
+        refWcs = self.dataset.exposure.getWcs()
+        refCatalog = self.dataset.catalog
+        centroidPlugin = task.plugins["base_TransformedCentroid"]
+        shapePlugin = task.plugins["base_TransformedShape"]
+        names = ("base_TransformedCentroid_x", "base_TransformedCentroid_y",
+                 "base_TransformedShape_xx", "base_TransformedShape_yy", "base_TransformedShape_xy")
+        for measWcs in (self.dataset.makePerturbedWcs(refWcs, randomSeed=2), refWcs):
+            exposure, _ = self.dataset.transform(measWcs).realize(10.0, self.dataset.makeMinimalSchema(),
+                                                                  randomSeed=2)
+            batchCatalog = task.generateMeasCat(exposure, refCatalog, refWcs)
+            loopCatalog = task.generateMeasCat(exposure, refCatalog, refWcs)
+            for plugin in (centroidPlugin, shapePlugin):
+                plugin.measureMany(batchCatalog, exposure, refCatalog, refWcs)
+                for measRecord, refRecord in zip(loopCatalog, refCatalog):
+                    plugin.measure(measRecord, exposure, refRecord, refWcs)
+            for name in names:
+                self.assertFloatsAlmostEqual(batchCatalog[name], loopCatalog[name], rtol=1E-6)
+
+    def testExecutionPlan(self):
+        """Test that execution plans select the right plugins and are cached between calls."""
+        task = self.makeSingleFrameMeasurementTask(self.plugins[0], dependencies=self.plugins[1:])
+        plan = task.getExecutionPlan()
+        self.assertEqual([step.plugin.name for step in plan.single], list(task.plugins.keys()))
+        self.assertEqual(plan.multi, ())
+        self.assertIs(task.getExecutionPlan(), plan)
+        fluxOrder = lsst.meas.base.BasePlugin.FLUX_ORDER
+        self.assertEqual([step.plugin.name for step in task.getExecutionPlan(endOrder=fluxOrder).single],
+                         ["base_SdssCentroid", "base_SdssShape"])
+        self.assertEqual([step.plugin.name for step in task.getExecutionPlan(beginOrder=fluxOrder).single],
+                         ["base_GaussianFlux", "base_PsfFlux"])
+        task.clearExecutionPlans()
+        self.assertIsNot(task.getExecutionPlan(), plan)
+
+    def testPluginMetrics(self):
+        """Test that per-plugin statistics are written to the task metadata when requested."""
+        config = self.makeSingleFrameMeasurementConfig(self.plugins[0], dependencies=self.plugins[1:])
+        config.doPluginMetrics = True
+        task = self.makeSingleFrameMeasurementTask(config=config)
+        exposure, catalog = self.dataset.realize(10.0, task.schema, randomSeed=0)
+        task.run(catalog, exposure)
+        for name in self.plugins:
+            self.assertEqual(task.metadata.get("pluginMetrics.%s.nCalls" % name), len(catalog))
+            self.assertGreaterEqual(task.metadata.get("pluginMetrics.%s.cpuTime" % name), 0.0)
+            slowestIds = task.metadata.getArray("pluginMetrics.%s.slowestIds" % name)
+            self.assertLessEqual(set(slowestIds), set(catalog["id"]))
+        # Without noise replacement, each plugin measures the whole catalog in one batch call, which
+        # is not attributed to any one source.
+        config.doReplaceWithNoise = False
+        task = self.makeSingleFrameMeasurementTask(config=config)
+        exposure, catalog = self.dataset.realize(10.0, task.schema, randomSeed=0)
+        task.run(catalog, exposure)
+        for name in self.plugins:
+            base = "pluginMetrics.%s.measureMany." % name
+            self.assertEqual(task.metadata.get(base + "nBatchCalls"), 1)
+            self.assertEqual(task.metadata.get(base + "nCalls"), 0)
+            self.assertFalse(task.metadata.exists(base + "slowestIds"))
+        # Plugins without measureMany() are still timed and counted per record
+        config = self.makeSingleFrameMeasurementConfig("base_PeakCentroid")
+        config.doReplaceWithNoise = False
+        config.doPluginMetrics = True
+        task = self.makeSingleFrameMeasurementTask(config=config)
+        exposure, catalog = self.dataset.realize(10.0, task.schema, randomSeed=0)
+        task.run(catalog, exposure)
+        self.assertEqual(task.metadata.get("pluginMetrics.base_PeakCentroid.nCalls"), len(catalog))
+        self.assertFalse(task.metadata.exists("pluginMetrics.base_PeakCentroid.measureMany.nBatchCalls"))
+
+    def testExecutionTiers(self):
+        """Test that plugins which do not need isolated pixels are run outside the noise-replacement loop."""
+        config = self.makeSingleFrameMeasurementConfig("base_SdssCentroid",
+                                                       dependencies=("base_PsfFlux", "base_SkyCoord",
+                                                                     "base_Jacobian"))
+        config.slots.centroid = "base_SdssCentroid"
+        task = self.makeSingleFrameMeasurementTask(config=config)
+        plan = task.getExecutionPlan()
+        self.assertEqual([step.plugin.name for step in plan.isolated], ["base_SdssCentroid", "base_PsfFlux"])
+        self.assertEqual(plan.catalogBefore, ())
+        self.assertEqual([step.plugin.name for step in plan.catalogAfter], ["base_Jacobian", "base_SkyCoord"])
+        exposure, catalog = self.dataset.realize(10.0, task.schema, randomSeed=0)
+        task.run(catalog, exposure)
+        for record in catalog:
+            self.assertTrue(np.isfinite(record.get("base_Jacobian_value")))
+            self.assertFalse(record.get("base_Jacobian_flag"))
+
+        forcedTask = self.makeForcedMeasurementTask("base_PsfFlux")
+        forcedPlan = forcedTask.getExecutionPlan()
+        self.assertEqual([step.plugin.name for step in forcedPlan.isolated], ["base_PsfFlux"])
+        self.assertEqual([step.plugin.name for step in forcedPlan.catalogBefore],
+                         ["base_TransformedCentroid", "base_TransformedShape"])
+        self.assertEqual(forcedPlan.catalogAfter, ())
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
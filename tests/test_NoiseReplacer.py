@@ -27,6 +27,8 @@ import numpy as np
 import lsst.geom
 import lsst.afw.geom
 import lsst.afw.detection
+import lsst.afw.image
+import lsst.afw.math
 import lsst.afw.table
 import lsst.meas.base.tests
 import lsst.utils.tests
@@ -90,6 +92,224 @@ class NoiseReplacerTestCase(lsst.meas.base.tests.AlgorithmTestCase, lsst.utils.t
             # some RNG seeds may cause it to fail (indeed, 67% should)
             self.assertLess(record.get("test_NoiseReplacer_outside"), np.sqrt(sumVariance))
 
+    def testLazyNoise(self):
+        """Test that regenerating the noise for each source on demand is reproducible, and that the
+        original image is restored exactly."""
+        config = self.makeSingleFrameMeasurementConfig("test_NoiseReplacer")
+        config.noiseReplacer.lazyNoise = True
+        task = self.makeSingleFrameMeasurementTask(config=config)
+        exposure, catalog = self.dataset.realize(1.0, task.schema, randomSeed=0)
+        original = exposure.getMaskedImage().getImage().getArray().copy()
+        footprints = {record.getId(): (record.getParent(), record.getFootprint()) for record in catalog}
+        noiseReplacer = lsst.meas.base.NoiseReplacer(config.noiseReplacer, exposure, footprints)
+        self.assertEqual(len(noiseReplacer.heavyNoise), 0)
+        for record in catalog:
+            noiseReplacer.insertSource(record.getId())
+            noiseReplacer.removeSource(record.getId())
+        noiseReplacer.end()
+        np.testing.assert_array_equal(exposure.getMaskedImage().getImage().getArray(), original)
+
+        task.run(catalog, exposure)
+        exposure, catalog2 = self.dataset.realize(1.0, task.schema, randomSeed=0)
+        task.run(catalog2, exposure)
+        for record, record2 in zip(catalog, catalog2):
+            self.assertEqual(record.get("test_NoiseReplacer_inside"),
+                             record2.get("test_NoiseReplacer_inside"))
+            self.assertEqual(record.get("test_NoiseReplacer_outside"),
+                             record2.get("test_NoiseReplacer_outside"))
+            self.assertFloatsAlmostEqual(record.get("test_NoiseReplacer_inside"),
+                                         record.get("truth_instFlux"), rtol=1E-3)
+
+    def testPixelStore(self):
+        """Test that saving the original pixels in a memory-mapped file, and inserting them without
+        precomputed pixel indices, give the same results as the default."""
+        catalogs = []
+        for maxMemory, precompute in ((None, True), (0, True), (None, False)):
+            config = self.makeSingleFrameMeasurementConfig("test_NoiseReplacer")
+            config.noiseReplacer.maxPixelStoreMemory = maxMemory
+            config.noiseReplacer.precomputePixelIndices = precompute
+            task = self.makeSingleFrameMeasurementTask(config=config)
+            exposure, catalog = self.dataset.realize(1.0, task.schema, randomSeed=0)
+            original = exposure.getMaskedImage().getImage().getArray().copy()
+            task.run(catalog, exposure)
+            np.testing.assert_array_equal(exposure.getMaskedImage().getImage().getArray(), original)
+            catalogs.append(catalog)
+        for catalog in catalogs[1:]:
+            for record1, record2 in zip(catalogs[0], catalog):
+                self.assertEqual(record1.get("test_NoiseReplacer_inside"),
+                                 record2.get("test_NoiseReplacer_inside"))
+                self.assertEqual(record1.get("test_NoiseReplacer_outside"),
+                                 record2.get("test_NoiseReplacer_outside"))
+        # The precomputed pixel indices count toward the memory limit
+        spans = lsst.afw.geom.SpanSet(lsst.geom.Box2I(lsst.geom.Point2I(0, 0), lsst.geom.Extent2I(10, 10)))
+        for bbox, isMapped in ((None, False), (self.bbox, True)):
+            store = lsst.meas.base.noiseReplacer.PixelStore({1: spans}, dtype=np.float32, maxBytes=600,
+                                                            bbox=bbox)
+            self.assertEqual(store.isMapped, isMapped)
+            store.close()
+
+    def testCounterNoise(self):
+        """Test that the noise drawn with the counter-based generator does not depend on the order
+        or subset of the sources."""
+        config = lsst.meas.base.NoiseReplacerConfig()
+        config.noiseRandomGenerator = "counter"
+        config.noiseSource = "variance"
+        schema = lsst.afw.table.SourceTable.makeMinimalSchema()
+        images = []
+        for reverse in (False, True):
+            exposure, catalog = self.dataset.realize(1.0, schema, randomSeed=0)
+            records = sorted(catalog, key=lambda record: record.getId(), reverse=reverse)
+            footprints = {record.getId(): (record.getParent(), record.getFootprint()) for record in records}
+            noiseReplacer = lsst.meas.base.NoiseReplacer(config, exposure, footprints, exposureId=5)
+            images.append(exposure.getMaskedImage().getImage().getArray().copy())
+            noiseReplacer.end()
+        np.testing.assert_array_equal(images[0], images[1])
+        # The noise for each family alone matches the noise for that family within the whole image;
+        # in particular, a blend holds the noise of its parent, not of whichever child came last.
+        for parent in catalog.getChildren(0):
+            footprints = {parent.getId(): (0, parent.getFootprint())}
+            noiseReplacer = lsst.meas.base.NoiseReplacer(config, exposure, footprints, exposureId=5)
+            pixels = np.zeros(parent.getFootprint().getArea(), dtype=images[0].dtype)
+            parent.getFootprint().spans.flatten(pixels, images[0], exposure.getXY0())
+            np.testing.assert_array_equal(noiseReplacer.heavyNoise[parent.getId()], pixels)
+            noiseReplacer.end()
+
+    def testVariancePlaneNoise(self):
+        """Test that the noise drawn according to the variance plane is scaled by the standard deviation
+        of the pixels within the requested bounding box."""
+        schema = lsst.afw.table.SourceTable.makeMinimalSchema()
+        exposure, catalog = self.dataset.realize(1.0, schema, randomSeed=0)
+        variance = exposure.getMaskedImage().getVariance()
+        noiseGenerator = lsst.meas.base.noiseReplacer.VariancePlaneNoiseGenerator(
+            variance, rand=lsst.afw.math.Random(lsst.afw.math.Random.MT19937, 3))
+        rand = lsst.afw.math.Random(lsst.afw.math.Random.MT19937, 3)
+        for record in catalog:
+            bbox = record.getFootprint().getBBox()
+            deviates = lsst.afw.image.ImageF(bbox)
+            lsst.afw.math.randomGaussianImage(deviates, rand)
+            stdev = np.sqrt(lsst.afw.image.ImageF(variance, bbox, lsst.afw.image.PARENT, True).getArray())
+            self.assertFloatsAlmostEqual(noiseGenerator.getImage(bbox).getArray(),
+                                         deviates.getArray()*stdev, rtol=1E-6)
+
+    def testNoiseStatistics(self):
+        """Test measuring the image-wide noise statistics from a subsample, and caching them in the
+        exposure metadata."""
+        schema = lsst.afw.table.SourceTable.makeMinimalSchema()
+        exposure, catalog = self.dataset.realize(1.0, schema, randomSeed=0)
+        footprints = {record.getId(): (record.getParent(), record.getFootprint()) for record in catalog}
+        config = lsst.meas.base.NoiseReplacerConfig()
+        noiseReplacer = lsst.meas.base.NoiseReplacer(config, exposure, footprints)
+        noiseReplacer.end()
+        config.noiseStatisticsSampleSize = 5000
+        config.cacheNoiseStatistics = True
+        sampledReplacer = lsst.meas.base.NoiseReplacer(config, exposure, footprints)
+        sampledReplacer.end()
+        self.assertFloatsAlmostEqual(sampledReplacer.noiseGenStd, noiseReplacer.noiseGenStd, rtol=0.05)
+        metadata = exposure.getMetadata()
+        self.assertLessEqual(metadata.getAsInt("NOISE_MEASURED_NPIX"), 5000)
+        self.assertEqual(metadata.getAsDouble("NOISE_MEASURED_STDEV"), sampledReplacer.noiseGenStd)
+        # A second NoiseReplacer reads the statistics from the metadata
+        metadata.set("NOISE_MEASURED_STDEV", 123.0)
+        cachedReplacer = lsst.meas.base.NoiseReplacer(config, exposure, footprints)
+        cachedReplacer.end()
+        self.assertEqual(cachedReplacer.noiseGenStd, 123.0)
+
+    def testReusedNoiseReplacer(self):
+        """Test that measuring in two execution order ranges with one NoiseReplacer matches a single
+        run, and that the exposure has its original pixels between and after the calls."""
+        config = self.makeSingleFrameMeasurementConfig("test_NoiseReplacer",
+                                                       dependencies=("base_SdssCentroid",))
+        task = self.makeSingleFrameMeasurementTask(config=config)
+        exposure, catalog = self.dataset.realize(1.0, task.schema, randomSeed=0)
+        task.run(catalog, exposure)
+        exposure, splitCatalog = self.dataset.realize(1.0, task.schema, randomSeed=0)
+        original = exposure.getMaskedImage().getImage().getArray().copy()
+        noiseReplacer = task.makeNoiseReplacer(splitCatalog, exposure)
+        task.run(splitCatalog, exposure, endOrder=2.0, noiseReplacer=noiseReplacer)
+        np.testing.assert_array_equal(exposure.getMaskedImage().getImage().getArray(), original)
+        task.run(splitCatalog, exposure, beginOrder=2.0, noiseReplacer=noiseReplacer)
+        noiseReplacer.end()
+        np.testing.assert_array_equal(exposure.getMaskedImage().getImage().getArray(), original)
+        for record, splitRecord in zip(catalog, splitCatalog):
+            for name in ("base_SdssCentroid_x", "base_SdssCentroid_y", "test_NoiseReplacer_inside",
+                         "test_NoiseReplacer_outside"):
+                self.assertEqual(record.get(name), splitRecord.get(name))
+
+    def testMaskPlanes(self):
+        """Test that the THISDET and OTHERDET mask planes are only maintained if a plugin uses them."""
+        task = self.makeSingleFrameMeasurementTask("base_PsfFlux")
+        self.assertFalse(task.usesNoiseReplacerMaskPlanes())
+        task = self.makeSingleFrameMeasurementTask("test_NoiseReplacer")
+        self.assertTrue(task.usesNoiseReplacerMaskPlanes())
+        catalogs = []
+        for maintainMaskPlanes in (True, False):
+            exposure, catalog = self.dataset.realize(1.0, task.schema, randomSeed=0)
+            footprints = {record.getId(): (record.getParent(), record.getFootprint()) for record in catalog}
+            noiseReplacer = lsst.meas.base.NoiseReplacer(task.config.noiseReplacer, exposure, footprints,
+                                                         maintainMaskPlanes=maintainMaskPlanes)
+            planes = exposure.getMaskedImage().getMask().getMaskPlaneDict()
+            self.assertEqual("THISDET" in planes, maintainMaskPlanes)
+            self.assertEqual("OTHERDET" in planes, maintainMaskPlanes)
+            task.runPlugins(noiseReplacer, catalog, exposure)
+            catalogs.append(catalog)
+        for record1, record2 in zip(*catalogs):
+            self.assertEqual(record1.get("test_NoiseReplacer_inside"),
+                             record2.get("test_NoiseReplacer_inside"))
+
+    def testNoiseReplacerList(self):
+        """Test that a NoiseReplacerList inserts and removes each source in every exposure it lands on,
+        exactly as separate NoiseReplacers would."""
+        config = lsst.meas.base.NoiseReplacerConfig()
+        schema = lsst.afw.table.SourceTable.makeMinimalSchema()
+        for numThreads in (1, 2):
+            expected = {}
+            exposuresById = {}
+            footprintsByExp = {}
+            for expId in (1, 2):
+                exposure, catalog = self.dataset.realize(1.0, schema, randomSeed=expId)
+                footprints = {record.getId(): (record.getParent(), record.getFootprint())
+                              for record in catalog}
+                if expId == 2:
+                    # The first (isolated) source does not land on the second exposure
+                    del footprints[catalog[0].getId()]
+                footprintsByExp[expId] = footprints
+                exposuresById[expId] = exposure
+                single = exposure.clone()
+                noiseReplacer = lsst.meas.base.NoiseReplacer(config, single, footprints, exposureId=expId)
+                noiseReplacer.insertSource(catalog[1].getId())
+                expected[expId] = single.getMaskedImage().getImage().getArray().copy()
+                noiseReplacer.end()
+            noiseReplacers = lsst.meas.base.NoiseReplacerList(config, exposuresById, footprintsByExp,
+                                                              numThreads=numThreads)
+            self.assertEqual(noiseReplacers.getExposureIds(catalog[0].getId()), [1])
+            noiseReplacers.insertSource(catalog[0].getId())
+            noiseReplacers.removeSource(catalog[0].getId())
+            noiseReplacers.insertSource(catalog[1].getId())
+            for expId, exposure in exposuresById.items():
+                np.testing.assert_array_equal(exposure.getMaskedImage().getImage().getArray(),
+                                              expected[expId])
+            noiseReplacers.end()
+
+    def testNoiseBank(self):
+        """Test that noise taken from a noise bank is addressed by pixel coordinates, with either
+        random number generator."""
+        schema = lsst.afw.table.SourceTable.makeMinimalSchema()
+        for noiseRandomGenerator in ("sequential", "counter"):
+            config = lsst.meas.base.NoiseReplacerConfig()
+            config.noiseBankSize = 64
+            config.noiseRandomGenerator = noiseRandomGenerator
+            exposure, catalog = self.dataset.realize(1.0, schema, randomSeed=0)
+            footprints = {record.getId(): (record.getParent(), record.getFootprint()) for record in catalog}
+            noiseReplacer = lsst.meas.base.NoiseReplacer(config, exposure, footprints)
+            bank = noiseReplacer.noiseGenerator.bank
+            self.assertEqual(bank.shape, (64, 64))
+            for record in catalog.getChildren(0):
+                ys, xs = record.getFootprint().spans.indices()
+                expected = bank[ys % 64, xs % 64]*noiseReplacer.noiseGenStd + noiseReplacer.noiseGenMean
+                self.assertFloatsAlmostEqual(noiseReplacer.heavyNoise[record.getId()], expected,
+                                             rtol=1E-5, atol=1E-5)
+            noiseReplacer.end()
+
     def tearDown(self):
         del self.bbox
         del self.dataset
@@ -0,0 +1,181 @@
+#
+# LSST Data Management System
+# Copyright 2008-2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+import unittest
+
+import numpy as np
+
+import lsst.geom
+import lsst.afw.geom
+import lsst.meas.base.tests
+import lsst.utils.tests
+
+
+@lsst.meas.base.register("test_ParallelMeasurement")
+class ImageSumPlugin(lsst.meas.base.SingleFramePlugin):
+    """A measurement plugin that sums the whole image, and so sees the state of every other source."""
+
+    @staticmethod
+    def getExecutionOrder():
+        return 2.0
+
+    def __init__(self, config, name, schema, metadata):
+        lsst.meas.base.SingleFramePlugin.__init__(self, config, name, schema, metadata)
+        self.sumKey = schema.addField("%s_sum" % (name,), type=np.float64, doc="sum of the image")
+
+    def measure(self, measRecord, exposure):
+        measRecord.set(self.sumKey, float(exposure.getMaskedImage().getImage().getArray().sum()))
+
+
+class ParallelMeasurementTestCase(lsst.meas.base.tests.AlgorithmTestCase, lsst.utils.tests.TestCase):
+
+    def setUp(self):
+        self.bbox = lsst.geom.Box2I(lsst.geom.Point2I(-20, -30),
+                                    lsst.geom.Extent2I(240, 260))
+        self.dataset = lsst.meas.base.tests.TestDataset(self.bbox)
+        self.dataset.addSource(100000.0, lsst.geom.Point2D(50.1, 49.8))
+        self.dataset.addSource(120000.0, lsst.geom.Point2D(149.9, 50.3),
+                               lsst.afw.geom.Quadrupole(8, 9, 3))
+        with self.dataset.addBlend() as family:
+            family.addChild(110000.0, lsst.geom.Point2D(65.2, 150.7),
+                            lsst.afw.geom.Quadrupole(7, 5, -1))
+            family.addChild(140000.0, lsst.geom.Point2D(72.3, 149.1))
+            family.addChild(90000.0, lsst.geom.Point2D(68.5, 156.9))
+        with self.dataset.addBlend() as family:
+            family.addChild(80000.0, lsst.geom.Point2D(160.4, 170.2))
+            family.addChild(70000.0, lsst.geom.Point2D(166.7, 175.5),
+                            lsst.afw.geom.Quadrupole(6, 4, 1))
+
+    def tearDown(self):
+        del self.bbox
+        del self.dataset
+
+    def measure(self, numProcesses, doMeasureInCutouts=False,
+                dependencies=("base_SdssCentroid", "base_SdssShape", "base_GaussianFlux")):
+        config = self.makeSingleFrameMeasurementConfig("base_PsfFlux", dependencies=dependencies)
+        config.numProcesses = numProcesses
+        config.doMeasureInCutouts = doMeasureInCutouts
+        config.cutoutPadding = 20
+        task = self.makeSingleFrameMeasurementTask(config=config)
+        exposure, catalog = self.dataset.realize(10.0, task.schema, randomSeed=0)
+        task.run(catalog, exposure, exposureId=1234)
+        return catalog
+
+    def testBitIdentical(self):
+        """Test that measuring families in worker processes reproduces the serial outputs exactly."""
+        serial = self.measure(numProcesses=1)
+        parallel = self.measure(numProcesses=3)
+        self.assertEqual(len(serial), len(parallel))
+        for item in serial.schema:
+            if item.field.getTypeString() not in ("D", "F", "I", "L", "Flag"):
+                continue
+            serialColumn = np.array([record.get(item.key) for record in serial])
+            parallelColumn = np.array([record.get(item.key) for record in parallel])
+            np.testing.assert_array_equal(serialColumn, parallelColumn, err_msg=item.field.getName())
+        for serialRecord, parallelRecord in zip(serial, parallel):
+            self.assertEqual(serialRecord.getFootprint().getArea(), parallelRecord.getFootprint().getArea())
+
+    def testAdjacentBlends(self):
+        """Test that worker processes see neighboring blends in the same state as the serial loop."""
+        self.dataset = lsst.meas.base.tests.TestDataset(self.bbox)
+        for i in range(4):
+            with self.dataset.addBlend() as family:
+                family.addChild(100000.0, lsst.geom.Point2D(20.0 + 45.0*i, 100.0),
+                                lsst.afw.geom.Quadrupole(8, 6, 1))
+                family.addChild(80000.0, lsst.geom.Point2D(34.0 + 45.0*i, 104.0))
+        catalogs = []
+        metrics = []
+        for numProcesses in (1, 3):
+            config = self.makeSingleFrameMeasurementConfig("test_ParallelMeasurement")
+            config.numProcesses = numProcesses
+            config.doPluginMetrics = True
+            task = self.makeSingleFrameMeasurementTask(config=config)
+            exposure, catalog = self.dataset.realize(10.0, task.schema, randomSeed=0)
+            task.run(catalog, exposure, exposureId=1234)
+            catalogs.append(catalog)
+            metrics.append(task.metadata.get("pluginMetrics.test_ParallelMeasurement.nCalls"))
+        np.testing.assert_array_equal(np.array([record.get("test_ParallelMeasurement_sum")
+                                                for record in catalogs[0]]),
+                                      np.array([record.get("test_ParallelMeasurement_sum")
+                                                for record in catalogs[1]]))
+        # Statistics gathered in the worker processes are merged back
+        self.assertEqual(metrics, [len(catalogs[0])]*2)
+
+    def testCutoutPadding(self):
+        """Test that cutouts are padded to cover a background annulus, and that a wrapped algorithm
+        that does not declare its padding disables cutouts."""
+        config = self.makeSingleFrameMeasurementConfig("base_LocalBackground")
+        config.doMeasureInCutouts = True
+        task = self.makeSingleFrameMeasurementTask(config=config)
+        exposure, catalog = self.dataset.realize(10.0, task.schema, randomSeed=0)
+        sigma = exposure.getPsf().computeShape().getDeterminantRadius()
+        outer = config.plugins["base_LocalBackground"].annulusOuter
+        self.assertGreaterEqual(task.getCutoutPadding(exposure), int(np.ceil(outer*sigma)))
+        plugin = task.plugins["base_LocalBackground"]
+        plugin.getCutoutPadding = lambda exposure: None
+        self.assertIsNone(task.getCutoutPadding(exposure))
+        # Python plugins must declare their padding too, unless they are run over the whole catalog
+        task = self.makeSingleFrameMeasurementTask("base_PsfFlux", dependencies=("test_ParallelMeasurement",))
+        self.assertIsNone(task.getCutoutPadding(exposure))
+        task = self.makeSingleFrameMeasurementTask("base_PsfFlux", dependencies=("base_PeakCentroid",
+                                                                                 "base_Variance"))
+        self.assertIsNotNone(task.getCutoutPadding(exposure))
+        # Adaptive moments may read arbitrarily far beyond the Footprint
+        for name in ("base_SdssShape", "base_GaussianFlux", "base_Blendedness"):
+            task = self.makeSingleFrameMeasurementTask(name)
+            self.assertIsNone(task.getCutoutPadding(exposure), msg=name)
+
+    def testCutouts(self):
+        """Test that measuring families on padded cutouts agrees with measuring on the full exposure,
+        both for plugins that declare their padding and for those that fall back to the full exposure."""
+        for dependencies in (("base_SdssCentroid",),
+                             ("base_SdssCentroid", "base_SdssShape", "base_GaussianFlux")):
+            full = self.measure(numProcesses=1, dependencies=dependencies)
+            for numProcesses in (1, 3):
+                cutout = self.measure(numProcesses=numProcesses, doMeasureInCutouts=True,
+                                      dependencies=dependencies)
+                self.assertEqual(len(full), len(cutout))
+                for item in full.schema:
+                    name = item.field.getName()
+                    if not name.startswith(("base_PsfFlux", "base_SdssCentroid", "base_SdssShape",
+                                            "base_GaussianFlux")):
+                        continue
+                    fullColumn = np.array([record.get(item.key) for record in full])
+                    cutoutColumn = np.array([record.get(item.key) for record in cutout])
+                    if item.field.getTypeString() == "Flag":
+                        np.testing.assert_array_equal(fullColumn, cutoutColumn, err_msg=name)
+                    elif item.field.getTypeString() in ("D", "F"):
+                        np.testing.assert_allclose(fullColumn, cutoutColumn, rtol=1E-6, err_msg=name)
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,318 @@
+#
+# LSST Data Management System
+# Copyright 2008-2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+import gc
+import types
+import unittest
+
+import numpy as np
+
+import lsst.geom
+import lsst.afw.geom
+import lsst.afw.table
+from lsst.meas.base.references import (CoaddSrcReferencesTask, PatchCatalogCache, SkyMapCache,
+                                       _makeContiguous)
+import lsst.pipe.base
+import lsst.utils.tests
+
+
+class PatchCatalogCacheTestCase(lsst.utils.tests.TestCase):
+
+    def setUp(self):
+        self.schema = lsst.afw.table.SourceTable.makeMinimalSchema()
+
+    def makeCatalog(self, nRecords):
+        catalog = lsst.afw.table.SourceCatalog(self.schema)
+        for i in range(nRecords):
+            catalog.addNew().setId(i + 1)
+        return catalog
+
+    def testLeastRecentlyUsed(self):
+        cache = PatchCatalogCache(maxBytes=300)
+        catalogs = [self.makeCatalog(n) for n in (1, 2, 3)]
+        for i, catalog in enumerate(catalogs[:2]):
+            cache.put(i, catalog, nBytes=100)
+        self.assertIs(cache.get(0), catalogs[0])
+        self.assertIsNone(cache.get(2))
+        self.assertEqual((cache.nHits, cache.nMisses), (1, 1))
+        # Adding a third catalog that does not fit evicts the least recently used one (1, not 0)
+        cache.put(2, catalogs[2], nBytes=150)
+        self.assertIn(0, cache)
+        self.assertNotIn(1, cache)
+        self.assertIn(2, cache)
+        self.assertEqual(cache.nBytes, 250)
+        # Catalogs larger than the cache are not cached
+        cache.put(3, catalogs[2], nBytes=400)
+        self.assertNotIn(3, cache)
+        self.assertEqual(len(cache), 2)
+        # Shrinking the cache evicts catalogs
+        cache.setMaxBytes(200)
+        self.assertEqual(len(cache), 1)
+        self.assertIn(2, cache)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.nBytes, 0)
+
+    def testEstimateBytes(self):
+        small = PatchCatalogCache.estimateBytes(self.makeCatalog(2))
+        large = PatchCatalogCache.estimateBytes(self.makeCatalog(20))
+        self.assertEqual(small, 2*self.schema.getRecordSize())
+        self.assertEqual(large, 10*small)
+
+    def testDisabled(self):
+        cache = PatchCatalogCache()
+        cache.put("patch", self.makeCatalog(1))
+        self.assertEqual(len(cache), 0)
+        self.assertIsNone(cache.get("patch"))
+
+
+class InMemoryButler:
+    """A minimal stand-in for a butler that serves reference catalogs keyed by patch."""
+
+    def __init__(self, catalogs):
+        self.catalogs = catalogs
+        self.nGets = 0
+
+    def datasetExists(self, dataset, dataId):
+        return dataId["patch"] in self.catalogs
+
+    def get(self, dataset, dataId, immediate=False):
+        self.nGets += 1
+        if dataId["patch"] not in self.catalogs:
+            raise RuntimeError("No catalog for %s" % (dataId,))
+        return self.catalogs[dataId["patch"]]
+
+
+class Patch:
+    """A minimal stand-in for skymap.PatchInfo."""
+
+    def __init__(self, index, innerBBox):
+        self.index = index
+        self.innerBBox = innerBBox
+
+    def getIndex(self):
+        return self.index
+
+    def getInnerBBox(self):
+        return self.innerBBox
+
+
+class FetchInPatchesTestCase(lsst.utils.tests.TestCase):
+
+    def setUp(self):
+        self.schema = lsst.afw.table.SourceTable.makeMinimalSchema()
+        self.centroidKey = lsst.afw.table.Point2DKey.addFields(self.schema, "centroid", "centroid",
+                                                               "pixel")
+        self.schema.getAliasMap().set("slot_Centroid", "centroid")
+        # Four patches of 100x100 pixels in a row, each with 10 sources including a 10-pixel overlap
+        # on either side; the third patch is missing.
+        self.patches = []
+        catalogs = {}
+        for i in range(4):
+            innerBBox = lsst.geom.Box2I(lsst.geom.Point2I(100*i, 0), lsst.geom.Extent2I(100, 100))
+            self.patches.append(Patch((i, 0), innerBBox))
+            if i == 2:
+                continue
+            catalog = lsst.afw.table.SourceCatalog(self.schema)
+            for j in range(10):
+                record = catalog.addNew()
+                record.setId(100*i + j + 1)
+                record.set(self.centroidKey, lsst.geom.Point2D(100*i - 10 + 12*j, 50.0))
+            catalogs["%d,0" % i] = catalog
+        self.butler = InMemoryButler(catalogs)
+        self.dataRef = types.SimpleNamespace(dataId={"tract": 0},
+                                             butlerSubset=types.SimpleNamespace(butler=self.butler))
+
+    def tearDown(self):
+        CoaddSrcReferencesTask.patchCache.clear()
+
+    def makeTask(self, **kwds):
+        config = CoaddSrcReferencesTask.ConfigClass()
+        config.filter = "r"
+        config.skipMissing = True
+        for name, value in kwds.items():
+            setattr(config, name, value)
+        return CoaddSrcReferencesTask(schema=self.schema, config=config)
+
+    def fetchIds(self, task):
+        return [record.getId() for record in task.fetchInPatches(self.dataRef, self.patches)]
+
+    def testConcurrentReads(self):
+        expected = self.fetchIds(self.makeTask())
+        self.assertEqual(len(expected), 27)
+        self.assertEqual(self.fetchIds(self.makeTask(numPatchReadThreads=4)), expected)
+        self.assertEqual(self.fetchIds(self.makeTask(numPatchReadThreads=4, removePatchOverlaps=False)),
+                         [id for i in (0, 1, 3) for id in range(100*i + 1, 100*i + 11)])
+        task = self.makeTask(numPatchReadThreads=4, skipMissing=False)
+        with self.assertRaises(lsst.pipe.base.TaskError):
+            self.fetchIds(task)
+
+    def testPatchCache(self):
+        expected = self.fetchIds(self.makeTask())
+        for numPatchReadThreads in (1, 4):
+            CoaddSrcReferencesTask.patchCache.clear()
+            task = self.makeTask(patchCacheMaxBytes=1 << 20, numPatchReadThreads=numPatchReadThreads)
+            self.assertEqual(self.fetchIds(task), expected)
+            nGets = self.butler.nGets
+            self.assertGreater(nGets, 0)
+            # A second task reuses the catalogs read by the first, including the missing one
+            task = self.makeTask(patchCacheMaxBytes=1 << 20, numPatchReadThreads=numPatchReadThreads)
+            self.assertEqual(self.fetchIds(task), expected)
+            self.assertEqual(self.butler.nGets, nGets)
+            self.assertEqual(task.metadata.get("patchCacheHits"), 4)
+            self.assertFalse(task.metadata.exists("patchCacheMisses"))
+            # Constructing a task that does not use the cache leaves it intact
+            self.makeTask()
+            self.assertEqual(len(CoaddSrcReferencesTask.patchCache), 4)
+            # Catalogs are not shared between butlers
+            otherButler = InMemoryButler(self.butler.catalogs)
+            self.dataRef.butlerSubset.butler = otherButler
+            task = self.makeTask(patchCacheMaxBytes=1 << 20, numPatchReadThreads=numPatchReadThreads)
+            self.assertEqual(self.fetchIds(task), expected)
+            self.assertGreater(otherButler.nGets, 0)
+            self.assertEqual(task.metadata.get("patchCacheMisses"), 4)
+            self.dataRef.butlerSubset.butler = self.butler
+            # Catalogs read through a butler are dropped once it is garbage collected
+            self.assertEqual(len(CoaddSrcReferencesTask.patchCache), 8)
+            del otherButler
+            gc.collect()
+            self.assertEqual(len(CoaddSrcReferencesTask.patchCache), 4)
+
+
+class SubsetTestCase(lsst.utils.tests.TestCase):
+
+    def setUp(self):
+        self.schema = lsst.afw.table.SourceTable.makeMinimalSchema()
+        self.wcs = lsst.afw.geom.makeSkyWcs(
+            crpix=lsst.geom.Point2D(0.0, 0.0),
+            crval=lsst.geom.SpherePoint(45.0, 30.0, lsst.geom.degrees),
+            cdMatrix=lsst.afw.geom.makeCdMatrix(scale=0.2*lsst.geom.arcseconds))
+        # 100 families of a parent and up to 3 children, scattered over a 400x400 pixel region, with
+        # children placed far from their parents, so they would not be selected on their own.
+        rng = np.random.RandomState(5)
+        self.catalog = lsst.afw.table.SourceCatalog(self.schema)
+        for i in range(100):
+            parent = self.catalog.addNew()
+            parent.setId(100*(i + 1))
+            parent.setCoord(self.wcs.pixelToSky(*rng.uniform(-100.0, 300.0, size=2)))
+            for j in range(rng.randint(4)):
+                child = self.catalog.addNew()
+                child.setId(parent.getId() + j + 1)
+                child.setParent(parent.getId())
+                child.setCoord(self.wcs.pixelToSky(*rng.uniform(1000.0, 2000.0, size=2)))
+        self.task = CoaddSrcReferencesTask(schema=self.schema,
+                                           config=CoaddSrcReferencesTask.ConfigClass(filter="r"))
+
+    def testSubset(self):
+        bbox = lsst.geom.Box2I(lsst.geom.Point2I(0, 0), lsst.geom.Extent2I(200, 200))
+        boxD = lsst.geom.Box2D(bbox)
+        selectedParents = set(record.getId() for record in self.catalog if record.getParent() == 0 and
+                              boxD.contains(self.wcs.skyToPixel(record.getCoord())))
+        expected = [record.getId() for record in self.catalog
+                    if record.getId() in selectedParents or record.getParent() in selectedParents]
+        self.assertGreater(len(selectedParents), 0)
+        self.assertLess(len(selectedParents), 100)
+        # Both from a catalog and from an arbitrary iterable
+        for sources in (self.catalog, iter(list(self.catalog))):
+            subset = self.task.subset(sources, bbox, self.wcs)
+            self.assertEqual([record.getId() for record in subset], expected)
+        self.assertEqual(len(self.task.subset([], bbox, self.wcs)), 0)
+
+    def testMakeContiguous(self):
+        contiguous = self.catalog.copy(deep=True)
+        self.assertIs(_makeContiguous(contiguous, self.schema), contiguous)
+        everyOther = self.catalog[::2]
+        for sources, expected in ((everyOther, everyOther), (iter(list(self.catalog)), self.catalog)):
+            catalog = _makeContiguous(sources, self.schema)
+            self.assertTrue(catalog.isContiguous())
+            self.assertEqual(list(catalog["id"]), [record.getId() for record in expected])
+
+
+class Tract:
+    """A minimal stand-in for skymap.TractInfo."""
+
+    def __init__(self, id):
+        self.id = id
+
+    def getWcs(self):
+        return "wcs%d" % self.id
+
+    def getPatchInfo(self, index):
+        return Patch(index, None)
+
+
+class SkyMapSource:
+    """A minimal stand-in for a butler that serves one skymap under any dataset name."""
+
+    def __init__(self, nTracts):
+        self.skyMap = {id: Tract(id) for id in range(nTracts)}
+        self.nGets = 0
+
+    def get(self, datasetName, immediate=False):
+        self.nGets += 1
+        return self.skyMap
+
+
+class SkyMapCacheTestCase(lsst.utils.tests.TestCase):
+
+    def testSkyMapCache(self):
+        cache = SkyMapCache()
+        source = SkyMapSource(3)
+        self.assertIs(cache.getSkyMap(source, "deepCoadd_skyMap"), source.skyMap)
+        self.assertIs(cache.getTractInfo(source, "deepCoadd_skyMap", 1), source.skyMap[1])
+        self.assertEqual(cache.getWcs(source, "deepCoadd_skyMap", 2), "wcs2")
+        patchInfo = cache.getPatchInfo(source, "deepCoadd_skyMap", 1, "3,4")
+        self.assertEqual(patchInfo.getIndex(), (3, 4))
+        self.assertIs(cache.getPatchInfo(source, "deepCoadd_skyMap", 1, (3, 4)), patchInfo)
+        self.assertEqual(source.nGets, 1)
+        # Skymaps are cached by dataset name
+        cache.getSkyMap(source, "goodSeeingCoadd_skyMap")
+        self.assertEqual(source.nGets, 2)
+        cache.clear()
+        cache.getWcs(source, "deepCoadd_skyMap", 2)
+        self.assertEqual(source.nGets, 3)
+        # ...and by butler, whether it is passed directly or through a data reference
+        other = SkyMapSource(2)
+        dataRef = types.SimpleNamespace(butlerSubset=types.SimpleNamespace(butler=other), get=other.get)
+        self.assertIs(cache.getTractInfo(dataRef, "deepCoadd_skyMap", 1), other.skyMap[1])
+        self.assertIs(cache.getSkyMap(other, "deepCoadd_skyMap"), other.skyMap)
+        self.assertEqual(other.nGets, 1)
+        self.assertIs(cache.getTractInfo(source, "deepCoadd_skyMap", 1), source.skyMap[1])
+        # Entries are dropped when their butler is garbage collected
+        del dataRef, other
+        gc.collect()
+        cache.getSkyMap(source, "deepCoadd_skyMap")
+        self.assertEqual(len(cache._skyMaps), 1)
+        self.assertEqual(source.nGets, 3)
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()